@@ -9,5 +9,7 @@ logger = logging.getLogger(__name__)
 pg = PG() 
 mongo_client = Mongo(serverSelectionTimeoutMS=1500).mongo
 to_json = json.loads
+# name -> cache with stats() method, reported by /api/cache/
+caches = {}
 
 is_debug = True
@@ -0,0 +1,120 @@
+"""
+Indexes of statistics collections used by api resources and a check that every
+query shape of TagViews is served by an index.
+
+python -m api.indexes           creates indexes
+python -m api.indexes --check   creates indexes and fails if any query does a collection scan
+"""
+from pymongo import ASCENDING, DESCENDING
+
+import logging
+logger = logging.getLogger(__name__)
+
+indexes = {
+    'activity': [
+        [('uid', ASCENDING), ('site', ASCENDING), ('type', ASCENDING), ('views', DESCENDING)],
+        [('uid', ASCENDING), ('site', ASCENDING), ('views', DESCENDING)],
+        [('uid', ASCENDING), ('type', ASCENDING), ('id', ASCENDING), ('method', ASCENDING), ('site', ASCENDING)],
+        [('suida', ASCENDING), ('site', ASCENDING), ('type', ASCENDING), ('id', ASCENDING)],
+    ],
+    'cookies': [
+        [('suid', ASCENDING), ('site', ASCENDING)],
+        [('suida', ASCENDING), ('site', ASCENDING)],
+    ],
+    'activity_percentiles': [
+        [('site', ASCENDING), ('id', ASCENDING), ('value', ASCENDING)],
+    ],
+}
+
+# (name, collection, filter, sort) of reads and (name, collection, filter, update) of upserts made by TagViews
+find_shapes = [
+    ('top views', 'activity',
+     {'uid': 'uid', 'site': 'common', 'is_removed': {'$ne': True}}, [('views', DESCENDING)]),
+    ('top views by type', 'activity',
+     {'uid': 'uid', 'type': 'tag', 'site': 'common', 'is_removed': {'$ne': True}}, [('views', DESCENDING)]),
+    ('cookies by suid', 'cookies', {'suid': 'suid', 'site': 'common'}, None),
+    ('cookies by suida', 'cookies', {'suida': 'suida', 'site': 'common'}, None),
+    ('percentiles', 'activity_percentiles', {'site': 'common', 'id': {'$in': [1, 2, 3]}}, None),
+]
+update_shapes = [
+    ('add views', 'activity',
+     {'uid': 'uid', 'type': 'tag', 'id': 1, 'method': 'views', 'site': 'common'},
+     {'$set': {'time': 0}, '$inc': {'views': 1}}),
+    ('remove object', 'activity',
+     {'suida': 'uid', 'type': 'tag', 'site': 'common', 'id': 1, 'method': 'views'},
+     {'$set': {'is_removed': True}}),
+]
+
+
+class QueryPlanError(Exception):
+    pass
+
+
+def ensure_indexes(db):
+    """
+    Creates indexes, existing ones are left as is
+    :param db: pymongo database, statistics
+    """
+    for collection, keys_list in indexes.items():
+        for keys in keys_list:
+            name = db[collection].create_index(keys, background=True)
+            logger.info('Index {0}.{1}'.format(collection, name))
+
+
+def _has_collscan(plan):
+    if isinstance(plan, dict):
+        if plan.get('stage') == 'COLLSCAN':
+            return True
+        return any(_has_collscan(v) for v in plan.values())
+    if isinstance(plan, list):
+        return any(_has_collscan(v) for v in plan)
+    return False
+
+
+def _winning_plans(explain):
+    if isinstance(explain, dict):
+        for k, v in explain.items():
+            if k == 'winningPlan':
+                yield v
+            elif k != 'rejectedPlans':
+                yield from _winning_plans(v)
+    elif isinstance(explain, list):
+        for v in explain:
+            yield from _winning_plans(v)
+
+
+def check_query_plans(db):
+    """
+    Explains every TagViews query shape, raises QueryPlanError listing shapes whose winning plan
+    is a collection scan. Works with a mongod or a mock supporting explain
+    :param db: pymongo database, statistics
+    """
+    failed = []
+    for name, collection, filter_, sort in find_shapes:
+        cursor = db[collection].find(filter_)
+        if sort is not None:
+            cursor = cursor.sort(sort).limit(100)
+        if any(_has_collscan(plan) for plan in _winning_plans(cursor.explain())):
+            failed.append(name)
+    for name, collection, filter_, update in update_shapes:
+        explain = db.command(
+            'explain', {'update': collection, 'updates': [{'q': filter_, 'u': update, 'upsert': True}]},
+            verbosity='queryPlanner'
+        )
+        if any(_has_collscan(plan) for plan in _winning_plans(explain)):
+            failed.append(name)
+    if failed:
+        raise QueryPlanError('Collection scan in: {0}'.format(', '.join(failed)))
+
+
+if __name__ == '__main__':
+    import argparse
+    from api import mongo_client
+    arg_parser = argparse.ArgumentParser(description='Creates statistics indexes')
+    arg_parser.add_argument('--check', action='store_true', help='Fail if any query does a collection scan')
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    statistics = mongo_client.statistics
+    ensure_indexes(statistics)
+    if args.check:
+        check_query_plans(statistics)
@@ -1,7 +1,38 @@
 from api import *
+from common.cache import TTLCache
+from common.config import uid_cache_config, write_behind_config, response_cache_config
+from api.writebehind import ViewBuffer
+from api.response_cache import from_config as response_cache_from_config
 from datetime import datetime
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 import uuid
 
+# (site, suida, suid) -> uid, links between cookies and uid are never changed, only added
+uid_cache = TTLCache(uid_cache_config['size'], uid_cache_config['ttl'])
+caches['uid'] = uid_cache
+
+# created by setup, importing the module doesn't start threads, open journals or connect to caches
+views_cache = None
+view_buffer = None
+
+
+def setup(workers=1):
+    """
+    Creates response cache and write-behind buffer of this process from config, called once by the app
+    :param workers: number of api processes, a cache of several processes must be shared
+    """
+    global views_cache, view_buffer
+    if views_cache is None:
+        views_cache = response_cache_from_config(response_cache_config, workers)
+        if views_cache is not None:
+            caches['views'] = views_cache
+    if write_behind_config['enabled'] and view_buffer is None:
+        view_buffer = ViewBuffer(
+            mongo_client.statistics.activity, flush_interval=write_behind_config['flush_interval'],
+            max_size=write_behind_config['max_size'], journal=write_behind_config['journal']
+        ).start()
+
 
 class TagViews(flask_resource):
     def __init__(self, site='common'):
@@ -19,6 +50,16 @@ class TagViews(flask_resource):
         self.mongo_cookies = mongo_client.statistics.cookies
 
     def get_uid(self, suida, suid=None):
+        key = (self.site, suida, suid)
+        uid = uid_cache.get(key)
+        if uid is not None:
+            return uid, False
+        uid, is_new = self._resolve_uid(suida, suid)
+        # after resolving the pair is always linked to uid in cookies collection
+        uid_cache.set(key, uid)
+        return uid, is_new
+
+    def _resolve_uid(self, suida, suid=None):
         uid = None
         is_new = False
         if suid is not None:
@@ -54,53 +95,125 @@ class TagViews(flask_resource):
         else:
             return uid, is_new
 
+    @staticmethod
+    def _failed_ids(object_id, error):
+        return [object_id[err['index']] for err in error.details.get('writeErrors', [])]
+
     def add_data(self, uid, object_type, object_id):
+        now = datetime.now()
+        if view_buffer is not None:
+            view_buffer.add(uid, self.site, object_type, object_id, now)
+            self.invalidate_data(uid, object_type)
+            return None
+        operations = [
+            UpdateOne(
+                {'uid': uid, 'type': object_type, 'id': oid, 'method': 'views', 'site': self.site},
+                {'$set': {'time': now}, '$inc': {'views': 1}},
+                upsert=True
+            ) for oid in object_id
+        ]
         try:
-            for oid in object_id:
-                self.mongo_activity.update(
-                    {'uid': uid, 'type': object_type, 'id': oid,
-                     'method': 'views', 'site': self.site},
-                    {'$set': {'time': datetime.now()}, '$inc': {'views': 1}},
-                    upsert=True, multi=False
-                )
+            if operations:
+                self.mongo_activity.bulk_write(operations, ordered=False)
+            self.invalidate_data(uid, object_type)
             return None
+        except BulkWriteError as e:
+            self.invalidate_data(uid, object_type)
+            failed = self._failed_ids(object_id, e)
+            logger.error('Views update failed for {0}: {1}'.format(failed, e.details.get('writeErrors')))
+            return Exception('Views update failed for objects {0}'.format(failed))
         except Exception as e:
             return e
 
     def get_data(self, uid, object_type=None, percentiles=False):
+        if views_cache is not None:
+            tag = (self.site, uid, object_type)
+            # generation is read before loading, so data loaded before invalidation is cached under the old one
+            key = tag + (bool(percentiles), views_cache.generation(tag))
+            d = views_cache.get(key)
+            if d is not None:
+                return d
         try:
-            if object_type is None:
-                d = list(self.mongo_activity.find(
-                    {'uid': uid, 'site': self.site,  'is_removed': {'$ne': True}},
-                    {'_id': 0, 'id': 1, 'views': 1}
-                ).sort('views', -1).limit(100))
-            else:
-                d = list(self.mongo_activity.find(
-                    {'uid': uid, 'type': object_type, 'site': self.site,  'is_removed': {'$ne': True}},
-                    {'_id': 0, 'id': 1, 'views': 1}
-                ).sort('views', -1).limit(100))
-            
-            if percentiles:
-                for i, obj in enumerate(d):
-                    try:
-                        d[i]['percentile'] = self.mongo_percentiles.find_one(
-                            {'site': self.site, 'id': obj['id'], 'value': {'$lte': obj['views']}},
-                            {'_id': 0, 'percentile': 1}
-                        )['percentile']
-                    except (KeyError, TypeError):
-                        d[i]['percentile'] = 0
-            return d
+            d = self._load_data(uid, object_type, percentiles)
         except Exception as e:
             logger.error(e)
             return []
+        if views_cache is not None:
+            views_cache.set(key, d)
+        return d
+
+    def invalidate_data(self, uid, object_type):
+        """Drops cached get_data results which can include objects of object_type"""
+        if views_cache is None:
+            return
+        for t in {object_type, None}:
+            views_cache.invalidate((self.site, uid, t))
+
+    def _load_data(self, uid, object_type=None, percentiles=False):
+        if object_type is None:
+            d = list(self.mongo_activity.find(
+                {'uid': uid, 'site': self.site,  'is_removed': {'$ne': True}},
+                {'_id': 0, 'id': 1, 'views': 1}
+            ).sort('views', -1).limit(100))
+        else:
+            d = list(self.mongo_activity.find(
+                {'uid': uid, 'type': object_type, 'site': self.site,  'is_removed': {'$ne': True}},
+                {'_id': 0, 'id': 1, 'views': 1}
+            ).sort('views', -1).limit(100))
+
+        if view_buffer is not None:
+            d = view_buffer.merge_into(d, uid, self.site, object_type)
+        if percentiles:
+            self.add_percentiles(d)
+        return d
+
+    def add_percentiles(self, objects):
+        """
+        Sets percentile of views for every object using one query for all of them.
+        Like find_one with value $lte views, takes the first matching document in returned order
+        """
+        ids = list({obj['id'] for obj in objects if 'id' in obj})
+        thresholds = {}
+        if ids:
+            for doc in self.mongo_percentiles.find(
+                {'site': self.site, 'id': {'$in': ids}},
+                {'_id': 0, 'id': 1, 'value': 1, 'percentile': 1}
+            ):
+                thresholds.setdefault(doc['id'], []).append(doc)
+        for obj in objects:
+            obj['percentile'] = 0
+            try:
+                views = obj['views']
+                for doc in thresholds.get(obj['id'], ()):
+                    value = doc.get('value')
+                    if isinstance(value, (int, float)) and value <= views:
+                        obj['percentile'] = doc['percentile']
+                        break
+            except (KeyError, TypeError):
+                pass
 
     def remove_object(self, uid, object_type, object_id):
-        for oid in object_id:
-            self.mongo_activity.update(
+        operations = [
+            UpdateOne(
                 {'suida': uid, 'type': object_type, 'site': self.site, 'id': oid, 'method': 'views'},
                 {'$set': {'is_removed': True}},
-                True, False
-            )
+                upsert=True
+            ) for oid in object_id
+        ]
+        if not operations:
+            return
+        try:
+            self.mongo_activity.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            failed = self._failed_ids(object_id, e)
+            if view_buffer is not None:
+                view_buffer.discard(uid, self.site, object_type, [oid for oid in object_id if oid not in failed])
+            self.invalidate_data(uid, object_type)
+            logger.error('Remove failed for {0}: {1}'.format(failed, e.details.get('writeErrors')))
+            raise
+        if view_buffer is not None:
+            view_buffer.discard(uid, self.site, object_type, object_id)
+        self.invalidate_data(uid, object_type)
 
     def get(self):
         try:
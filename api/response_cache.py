@@ -0,0 +1,124 @@
+from common.cache import TTLCache
+from itertools import count
+import threading
+import uuid
+
+import logging
+logger = logging.getLogger(__name__)
+
+# backends seen by all api processes, invalidation in one process reaches the others
+shared_backends = ('redis',)
+
+
+class ResponseCache(object):
+    """
+    Read-through cache of resource results with a pluggable backend:
+    lru - in-process TTLCache, simple - cachelib SimpleCache (local stand-in of a shared cache),
+    redis - cachelib RedisCache shared by all api processes.
+    Keys of cached values include generation of their tag, invalidate moves the tag to a new generation,
+    so a value loaded before invalidation and set after it is never read
+    """
+
+    def __init__(self, backend='lru', size=10000, ttl=60, prefix='api', **backend_kwargs):
+        self.backend = backend
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        if backend == 'lru':
+            self._cache = TTLCache(size, ttl)
+            # generations outlive values, an evicted generation is replaced by a never used one
+            self._generations = TTLCache(size, ttl * 2)
+            self._counter = count(1)
+            self._lock = threading.Lock()
+        elif backend == 'simple':
+            from cachelib import SimpleCache
+            self._cache = SimpleCache(threshold=size, default_timeout=ttl)
+        elif backend == 'redis':
+            from cachelib import RedisCache
+            self._cache = RedisCache(default_timeout=ttl, key_prefix=prefix, **backend_kwargs)
+        else:
+            raise ValueError('Unknown cache backend {0}'.format(backend))
+
+    def _key(self, key):
+        return key if self.backend == 'lru' else ':'.join(str(k) for k in key)
+
+    def get(self, key):
+        value = self._cache.get(self._key(key))
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if self.backend == 'lru':
+            self._cache.set(key, value)
+        else:
+            self._cache.set(self._key(key), value, timeout=self.ttl)
+
+    def delete(self, key):
+        self._cache.delete(self._key(key))
+
+    def _new_generation(self):
+        return next(self._counter) if self.backend == 'lru' else uuid.uuid4().hex
+
+    def generation(self, tag):
+        """
+        :param tag: tuple, group of keys invalidated together
+        :return: current generation of tag, a part of keys of its values
+        """
+        if self.backend == 'lru':
+            with self._lock:
+                generation = self._generations.get(tag)
+                if generation is None:
+                    generation = self._new_generation()
+                    self._generations.set(tag, generation)
+                return generation
+        key = self._key(('generation',) + tag)
+        generation = self._cache.get(key)
+        if generation is None:
+            # another process can create it at the same time, the first one wins
+            self._cache.add(key, self._new_generation(), timeout=self.ttl * 2)
+            generation = self._cache.get(key)
+        return generation
+
+    def invalidate(self, tag):
+        """Moves tag to a new generation, values cached under previous ones are not read anymore"""
+        if self.backend == 'lru':
+            with self._lock:
+                self._generations.set(tag, self._new_generation())
+        else:
+            self._cache.set(self._key(('generation',) + tag), self._new_generation(), timeout=self.ttl * 2)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'backend': self.backend, 'hits': self.hits, 'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0
+        }
+
+
+def check_backend(config, workers=1):
+    """
+    :param config: response_cache_config like dictionary
+    :param workers: number of api processes
+    :raises ValueError: if enabled cache is per process and there are several processes,
+        they would serve values another process has invalidated
+    """
+    if config.get('enabled') and workers > 1 and config.get('backend', 'lru') not in shared_backends:
+        raise ValueError('Response cache backend {0} is per process, {1} workers need one of: {2}'.format(
+            config.get('backend', 'lru'), workers, ', '.join(shared_backends)
+        ))
+
+
+def from_config(config, workers=1):
+    """
+    :param config: response_cache_config like dictionary
+    :param workers: number of api processes
+    :return: ResponseCache or None if disabled
+    """
+    check_backend(config, workers)
+    if not config.get('enabled'):
+        return None
+    return ResponseCache(**{k: v for k, v in config.items() if k != 'enabled'})
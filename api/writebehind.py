@@ -0,0 +1,293 @@
+from datetime import datetime
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+import atexit
+import fcntl
+import json
+import os
+import re
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class ViewBuffer(object):
+    """
+    Collects view increments in memory, merges them per (uid, site, type, id) and writes them
+    to activity collection by bulk_write on a timer or when max_size keys are pending.
+    Without journal up to flush_interval of views can be lost on crash, with journal every increment
+    is appended to a local file first and replayed on start (a batch interrupted by crash in the middle
+    of bulk_write can be applied twice). Pending views are per process, so is the journal:
+    every process writes <journal>.<pid> holding an exclusive lock on <journal>.<pid>.lock,
+    journals of processes that are gone are taken over by the next started one
+    """
+
+    def __init__(self, collection, flush_interval=1.0, max_size=10000, max_pending=100000, journal=None):
+        """
+        :param collection: pymongo collection, statistics.activity
+        :param flush_interval: seconds between flushes
+        :param max_size: number of pending keys that triggers a flush
+        :param max_pending: increments beyond this number of keys are dropped if mongo is unavailable
+        :param journal: base path of local journal files, increments are not journaled if None
+        """
+        self.collection = collection
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.max_pending = max_pending
+        self.journal = journal
+        self.dropped = 0
+        self._pending = {}
+        # (uid, site) -> pending keys of the user
+        self._user_keys = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+        self._journal_file = None
+        self._journal_path = None
+        self._flushing_path = None
+        self._lock_path = None
+        self._lock_file = None
+
+    def start(self):
+        """Replays journals of this and finished processes and starts the flush thread"""
+        if self.journal is not None:
+            self._open_journal()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+        return self
+
+    def stop(self):
+        """Stops the flush thread and writes pending views, the journal is kept if they were not written"""
+        if self._stopped:
+            return
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error('View buffer flush failed: {0}'.format(e))
+        if self._journal_file is not None:
+            self._journal_file.close()
+            self._journal_file = None
+            if not self._pending:
+                self._remove(self._journal_path)
+                self._remove(self._lock_path)
+            self._lock_file.close()
+
+    def _files(self, pid):
+        """:return: journal, flushing journal and lock file paths of process pid"""
+        journal = '{0}.{1}'.format(self.journal, pid)
+        return journal, '{0}.flushing'.format(journal), '{0}.lock'.format(journal)
+
+    @staticmethod
+    def _try_lock(path):
+        """
+        :return: open file locked exclusively by this process, None if another process holds the lock
+        """
+        f = open(path, 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # the lock file could be removed by a process that took it over before us
+            if os.stat(path).st_ino == os.fstat(f.fileno()).st_ino:
+                return f
+        except (BlockingIOError, FileNotFoundError):
+            pass
+        f.close()
+        return None
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _open_journal(self):
+        pid = os.getpid()
+        self._journal_path, self._flushing_path, self._lock_path = self._files(pid)
+        self._lock_file = self._try_lock(self._lock_path)
+        if self._lock_file is None:
+            raise RuntimeError('View journal {0} is locked by another process'.format(self._journal_path))
+        # files of a previous process with the same pid are ours too
+        replayed = [self._flushing_path, self._journal_path]
+        orphans = []
+        directory, base = os.path.split(os.path.abspath(self.journal))
+        lock_format = re.compile(r'{0}\.(\d+)\.lock$'.format(re.escape(base)))
+        for name in os.listdir(directory):
+            m = lock_format.match(name)
+            if m is None or int(m.group(1)) == pid:
+                continue
+            journal, flushing, lock_path = self._files(m.group(1))
+            lock_file = self._try_lock(lock_path)
+            if lock_file is not None:
+                orphans.append((lock_path, lock_file))
+                replayed += [flushing, journal]
+        for filename in replayed:
+            self._replay(filename)
+        logger.info('Replayed {0} pending view keys from {1} journals'.format(len(self._pending), len(orphans) + 1))
+        # replayed views are stored in the own journal before replayed files are removed
+        temp_path = '{0}.tmp'.format(self._journal_path)
+        with open(temp_path, 'w') as f:
+            for key, (views, time) in self._pending.items():
+                f.write(self._journal_line(key, views, time))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self._journal_path)
+        for filename in replayed:
+            if filename != self._journal_path:
+                self._remove(filename)
+        for lock_path, lock_file in orphans:
+            self._remove(lock_path)
+            lock_file.close()
+        self._journal_file = open(self._journal_path, 'a')
+
+    @staticmethod
+    def _journal_line(key, views, time):
+        """views is None for removed objects"""
+        return json.dumps(list(key) + [views, time.timestamp()]) + '\n'
+
+    def _replay(self, filename):
+        try:
+            with open(filename, 'r') as f:
+                for line in f:
+                    try:
+                        uid, site, object_type, oid, views, ts = json.loads(line)
+                    except ValueError:
+                        continue
+                    key = (uid, site, object_type, oid)
+                    if views is None:
+                        self._discard(key)
+                    else:
+                        self._merge(key, views, datetime.fromtimestamp(ts))
+        except FileNotFoundError:
+            pass
+
+    def _merge(self, key, views, time):
+        entry = self._pending.get(key)
+        if entry is None:
+            self._pending[key] = [views, time]
+            self._user_keys.setdefault(key[:2], []).append(key)
+        else:
+            entry[0] += views
+            if time > entry[1]:
+                entry[1] = time
+
+    def _discard(self, key):
+        if self._pending.pop(key, None) is not None:
+            self._user_keys[key[:2]].remove(key)
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error('View buffer flush failed: {0}'.format(e))
+
+    def add(self, uid, site, object_type, object_id, time=None):
+        time = datetime.now() if time is None else time
+        with self._lock:
+            for oid in object_id:
+                self._merge((uid, site, object_type, oid), 1, time)
+                if self._journal_file is not None:
+                    self._journal_file.write(self._journal_line((uid, site, object_type, oid), 1, time))
+            if self._journal_file is not None:
+                self._journal_file.flush()
+            size = len(self._pending)
+        if size >= self.max_size:
+            self._wakeup.set()
+
+    def discard(self, uid, site, object_type, object_id):
+        """Drops pending views of removed objects, so merge_into doesn't bring them back"""
+        time = datetime.now()
+        with self._lock:
+            for oid in object_id:
+                self._discard((uid, site, object_type, oid))
+                if self._journal_file is not None:
+                    self._journal_file.write(self._journal_line((uid, site, object_type, oid), None, time))
+            if self._journal_file is not None:
+                self._journal_file.flush()
+
+    def pending(self, uid, site, object_type=None):
+        """
+        :return: {object id: pending views} of uid
+        """
+        result = {}
+        with self._lock:
+            for key in self._user_keys.get((uid, site), ()):
+                if object_type is None or key[2] == object_type:
+                    result[key[3]] = result.get(key[3], 0) + self._pending[key][0]
+        return result
+
+    def merge_into(self, objects, uid, site, object_type=None, limit=100):
+        """
+        Adds pending views to objects read from mongo, so a caller sees own views before flush
+        :param objects: list of {'id', 'views'} sorted by views
+        :return: new list sorted by views
+        """
+        pending = self.pending(uid, site, object_type)
+        if not pending:
+            return objects
+        for obj in objects:
+            views = pending.pop(obj.get('id'), None)
+            if views is not None:
+                obj['views'] = obj.get('views', 0) + views
+        objects.extend({'id': oid, 'views': views} for oid, views in pending.items())
+        objects.sort(key=lambda obj: obj.get('views', 0), reverse=True)
+        return objects[:limit]
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                batch = self._pending
+                self._pending = {}
+                self._user_keys = {}
+                if self._journal_file is not None:
+                    self._journal_file.close()
+                    os.replace(self._journal_path, self._flushing_path)
+                    self._journal_file = open(self._journal_path, 'a')
+            keys = []
+            operations = []
+            for (uid, site, object_type, oid), (views, time) in batch.items():
+                keys.append((uid, site, object_type, oid))
+                operations.append(UpdateOne(
+                    {'uid': uid, 'type': object_type, 'id': oid, 'method': 'views', 'site': site},
+                    {'$max': {'time': time}, '$inc': {'views': views}},
+                    upsert=True
+                ))
+            try:
+                self.collection.bulk_write(operations, ordered=False)
+            except BulkWriteError as e:
+                failed = [keys[err['index']] for err in e.details.get('writeErrors', [])]
+                self._restore({key: batch[key] for key in failed})
+                raise
+            except Exception:
+                self._restore(batch)
+                raise
+            finally:
+                if self._flushing_path is not None:
+                    self._remove(self._flushing_path)
+
+    def _restore(self, batch):
+        """Returns not written increments to pending ones and to the journal"""
+        with self._lock:
+            for key, (views, time) in batch.items():
+                if key in self._pending or len(self._pending) < self.max_pending:
+                    self._merge(key, views, time)
+                    if self._journal_file is not None:
+                        self._journal_file.write(self._journal_line(key, views, time))
+                else:
+                    self.dropped += views
+            if self._journal_file is not None:
+                self._journal_file.flush()
+        if self.dropped:
+            logger.warning('View buffer dropped {0} views'.format(self.dropped))
@@ -0,0 +1,39 @@
+"""
+Runs the same SELECT N times with ClickHouse one by one and with AsyncClickHouse concurrently.
+Needs ClickHouse from common.config: python -m benchmarks.bench_clickhouse_async -n 50
+"""
+from common.db import ClickHouse, AsyncClickHouse
+import argparse
+import asyncio
+import time
+
+
+async def run_async(q, n, concurrency):
+    async with AsyncClickHouse(concurrency=concurrency) as client:
+        return await asyncio.gather(*[client.query(q) for _ in range(n)])
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('-n', type=int, default=50, help='Number of queries')
+    arg_parser.add_argument('--concurrency', type=int, default=10)
+    arg_parser.add_argument('--query', default='SELECT sleep(0.1)')
+    args = arg_parser.parse_args()
+
+    client = ClickHouse()
+    started = time.time()
+    for _ in range(args.n):
+        client.query(args.query)
+    sync_time = time.time() - started
+
+    started = time.time()
+    asyncio.run(run_async(args.query, args.n, args.concurrency))
+    async_time = time.time() - started
+
+    print('{0} queries: sync {1:.2f}s, async {2:.2f}s (concurrency {3}), x{4:.1f}'.format(
+        args.n, sync_time, async_time, args.concurrency, sync_time / async_time
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Compares row by row conversion (convert_row + write_row) with convert_batch + write_columns,
+checks that both give the same TSV and RowBinary output.
+Run from repository root: python -m benchmarks.bench_columnar --lines 200000
+"""
+from benchmarks.fixtures import column_types
+from parse_nginx_logs import Clickstream, clickhouse
+from urllib.parse import quote
+import argparse
+import io
+import json
+import random
+import time
+
+user_agents = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/66.0 Safari/537.36',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 11_3 like Mac OS X) AppleWebKit/605.1.15 Mobile/15E148',
+    'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)',
+]
+
+
+def sample_lines(lines, seed=1):
+    """Log lines covering custom variables, events, content tracking, bulk and impression requests"""
+    rnd = random.Random(seed)
+    result = []
+    for i in range(lines):
+        cvar = {
+            '1': ['page_type', rnd.choice(['article', 'null', ''])],
+            '2': ['page_id', rnd.choice(['0', str(i), 'x'])],
+            '3': ['page_tags', rnd.choice(['1,2,0', 'a,3', '', 'undefined'])],
+            '4': ['mvt.name', rnd.choice(['["a","b"]', 'broken'])],
+        }
+        params = [
+            ('idsite', '1'), ('rec', '1'), ('_id', '%016x' % i), ('pv_id', 'pv%d' % i),
+            ('url', 'https://example.com/page?a=1&b=__2'), ('_idts', rnd.choice(['1526288400', '0', 'x'])),
+            ('_viewts', str(1526288400 + i)), ('_idvc', rnd.choice(['3', 'x'])), ('gt_ms', '-15'),
+            ('cvar', json.dumps(cvar)), ('res', '1920x1080'), ('dimension1', 'suid%d' % (i % 100)),
+        ]
+        kind = i % 5
+        if kind == 1:
+            params += [('e_c', 'auto-click'), ('e_v', 'pv%d' % i), ('e_a', 'link')]
+        elif kind == 2:
+            params += [('c_n', 'banner'), ('c_p', 'top'), ('link', 'https://example.com/out')]
+        elif kind == 3:
+            params += [('download', 'https://example.com/file.pdf'), ('ping', '1')]
+        query = '&'.join('{0}={1}'.format(k, quote(v, safe='')) for k, v in params)
+        record = {
+            'ip': '10.0.%d.%d' % (i % 256, i % 199), 'time': '2018-05-14T12:%02d:%02d+03:00' % (i // 60 % 60, i % 60),
+            'referrer': '-', 'user_agent': user_agents[i % len(user_agents)], 'country': 'RU', 'city': 'Москва'
+        }
+        if kind == 4:
+            body = {'requests': ['?' + query, '?' + query + '&e_c=auto-click&e_v=x']}
+            record.update(request='POST /piwik HTTP/1.1', body=json.dumps(body))
+        else:
+            record.update(request='GET /piwik?{0} HTTP/1.1'.format(query), body='-')
+        result.append(json.dumps(record, ensure_ascii=False))
+    return result
+
+
+def convert(lines, fmt, columnar_batch):
+    clickstream = Clickstream(columnar_batch=columnar_batch)
+    clickstream.column_types = column_types(clickstream.columns)
+    output = io.BytesIO() if fmt in clickhouse.binary_formats else io.StringIO()
+    cr = clickhouse.FileWriter(
+        output, 'clickstream_table_name', clickstream.columns, header=False, fmt=fmt, types=clickstream.column_types
+    )
+    started = time.perf_counter()
+    clickstream.parse_lines(lines, cr)
+    cr.flush()
+    return output.getvalue(), cr.rows, time.perf_counter() - started
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--lines', type=int, default=100000, help='Number of generated log lines')
+    arg_parser.add_argument('--batch', type=int, default=1000, help='Columnar batch size')
+    args = arg_parser.parse_args()
+    lines = sample_lines(args.lines)
+    for fmt in ('TSV', 'RowBinary'):
+        row_data, row_count, row_time = convert(lines, fmt, 0)
+        batch_data, batch_count, batch_time = convert(lines, fmt, args.batch)
+        assert row_count == batch_count and row_data == batch_data, '{0} output differs'.format(fmt)
+        print('{0}: {1} rows, row by row {2:.3f}s, columnar {3:.3f}s, x{4:.2f}'.format(
+            fmt, row_count, row_time, batch_time, row_time / batch_time
+        ))
+
+
+if __name__ == '__main__':
+    main()
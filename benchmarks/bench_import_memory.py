@@ -0,0 +1,67 @@
+"""
+Measures peak RSS of ClickHouse.import_file and import_dataframe against a local stub.
+Every case runs in a fresh process, so ru_maxrss belongs to that case only.
+tests/test_import_memory.py asserts that peak memory stays bounded, measured with tracemalloc.
+Run from repository root: python -m benchmarks.bench_import_memory --mb 500
+"""
+from benchmarks.clickhouse_stub import ClickHouseStub
+from multiprocessing import get_context
+import argparse
+import os
+import resource
+import tempfile
+
+
+def make_csv(file_name, mb):
+    line = '2018-05-14 12:00:00,site_name,1,https://example.com/page?id=12345,some action name\n'
+    with open(file_name, 'w') as f:
+        for _ in range(mb * 1024 * 1024 // len(line)):
+            f.write(line)
+
+
+def import_file_case(url, file_name):
+    from common.db import ClickHouse
+    client = ClickHouse()
+    client.url = url
+    client.import_file(file_name, 'test_table', ['event_time', 'site', 'is_mobile', 'url', 'action_name'])
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def import_dataframe_case(url, file_name):
+    import pandas as pd
+    from common.db import ClickHouse
+    df = pd.read_csv(file_name, header=None, names=['event_time', 'site', 'is_mobile', 'url', 'action_name'])
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    client = ClickHouse()
+    client.url = url
+    client.import_dataframe('test_table', df)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--mb', type=int, default=200, help='Size of generated csv')
+    args = arg_parser.parse_args()
+
+    file_name = os.path.join(tempfile.mkdtemp(), 'import.csv')
+    make_csv(file_name, args.mb)
+    context = get_context('spawn')
+    cases = [('import_file', import_file_case)]
+    try:
+        import pandas
+        cases.append(('import_dataframe', import_dataframe_case))
+    except ImportError:
+        print('import_dataframe: skipped, pandas is not installed')
+    with ClickHouseStub() as stub:
+        for name, case in cases:
+            with context.Pool(1) as pool:
+                peak = pool.apply(case, (stub.url, file_name))
+            print('{0}: {1} MB csv, peak RSS {2:.1f} MB{3}'.format(
+                name, args.mb, peak / 1024, ' above loaded dataframe' if name == 'import_dataframe' else ''
+            ))
+        print('stub received {0:.1f} MB in {1} requests'.format(stub.bytes_received / 1048576, stub.requests))
+    os.remove(file_name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Reading throughput of LogTail against the previous text mode readline/tell implementation.
+Run from repository root: python -m benchmarks.bench_logtail --mb 500
+"""
+import common.logparser
+from common.logparser import LogTail
+import argparse
+import os
+import tempfile
+import time
+
+line = ('{"ip":"10.0.0.1","time":"2018-05-14T12:30:15+03:00","request":"GET /piwik?idsite=1&rec=1&'
+        'url=https%3A%2F%2Fexample.com%2Fpage&_id=0123456789abcdef HTTP/1.1","body":"-",'
+        '"referrer":"https://example.com/","user_agent":"Mozilla/5.0 (Windows NT 10.0; Win64; x64)",'
+        '"country":"RU","city":"Москва"}\n')
+
+
+class LegacyLogTail(object):
+    """Iteration of the previous text mode LogTail: readline in __next__, tell() at the end"""
+
+    def __init__(self, filename, offset=0):
+        self._fh = open(filename, mode='r', encoding='utf8', errors='replace')
+        self._fh.seek(offset)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self._fh.readline()
+        if not line:
+            self._fh.tell()
+            self._fh.close()
+            raise StopIteration()
+        return line
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--mb', type=int, default=200, help='Size of generated log')
+    args = arg_parser.parse_args()
+
+    working_dir = tempfile.mkdtemp()
+    common.logparser.logs_path = working_dir
+    filename = os.path.join(working_dir, 'piwik_access.log')
+    with open(filename, 'w') as f:
+        for _ in range(args.mb * 1024 * 1024 // len(line.encode('utf8'))):
+            f.write(line)
+    size = os.stat(filename).st_size / 1048576
+
+    started = time.perf_counter()
+    legacy_lines = sum(1 for _ in LegacyLogTail(filename))
+    legacy_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    lines = sum(1 for _ in LogTail(filename))
+    new_time = time.perf_counter() - started
+
+    assert lines == legacy_lines
+    print('{0} lines, {1:.0f} MB: text mode LogTail {2:.1f} MB/s, binary LogTail {3:.1f} MB/s'.format(
+        lines, size, size / legacy_time, size / new_time
+    ))
+    for name in os.listdir(working_dir):
+        os.remove(os.path.join(working_dir, name))
+    os.rmdir(working_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Overhead of parse_nginx_logs instrumentation: parsing with metrics disabled and enabled,
+exports to a temporary Prometheus textfile and to a local UDP socket standing for StatsD.
+Run from repository root: python -m benchmarks.bench_metrics --lines 50000
+"""
+from benchmarks import fixtures
+from benchmarks.bench_post import CountingWriter
+from common.metrics import Metrics, NullMetrics
+from parse_nginx_logs import Clickstream
+import argparse
+import os
+import socket
+import tempfile
+import time
+
+
+def run(lines, make_metrics, repeat=3):
+    best = None
+    for _ in range(repeat):
+        clickstream = Clickstream(metrics=make_metrics())
+        cr = CountingWriter()
+        clickstream.instrument_writer(cr)
+        started = time.perf_counter()
+        clickstream.parse_lines(lines, cr)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, clickstream
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--lines', type=int, default=50000, help='Number of mixed fixture lines')
+    args = arg_parser.parse_args()
+    lines = fixtures.lines('mixed', args.lines)
+
+    statsd = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    statsd.bind(('127.0.0.1', 0))
+    statsd.settimeout(1)
+    textfile = os.path.join(tempfile.mkdtemp(), 'clickstream.prom')
+
+    disabled, _ = run(lines, NullMetrics)
+    enabled, clickstream = run(lines, lambda: Metrics(textfile=textfile, statsd=statsd.getsockname()))
+    clickstream.export_metrics()
+    print('metrics disabled {0:.3f}s, enabled {1:.3f}s, overhead {2:+.1f}%'.format(
+        disabled, enabled, (enabled / disabled - 1) * 100
+    ))
+    with open(textfile) as f:
+        print(f.read())
+    packets = 0
+    try:
+        while True:
+            statsd.recv(65536)
+            packets += 1
+    except socket.timeout:
+        pass
+    print('statsd stub received {0} packets'.format(packets))
+    os.remove(textfile)
+    os.rmdir(os.path.dirname(textfile))
+
+
+if __name__ == '__main__':
+    main()
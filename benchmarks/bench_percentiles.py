@@ -0,0 +1,65 @@
+"""
+Compares per-object find_one percentile lookups with TagViews.add_percentiles
+for 10, 50 and 100 objects. Needs MongoDB and PostgreSQL from common.config (api imports both),
+test data goes to a separate database which is dropped afterwards:
+python -m benchmarks.bench_percentiles --db benchmark_statistics
+"""
+from api import mongo_client
+from api.resources.activity import TagViews
+import argparse
+import copy
+import random
+import time
+
+
+def old_percentiles(view, objects):
+    for obj in objects:
+        try:
+            obj['percentile'] = view.mongo_percentiles.find_one(
+                {'site': view.site, 'id': obj['id'], 'value': {'$lte': obj['views']}},
+                {'_id': 0, 'percentile': 1}
+            )['percentile']
+        except (KeyError, TypeError):
+            obj['percentile'] = 0
+
+
+def timed(func, view, objects, repeat):
+    best = None
+    for _ in range(repeat):
+        data = copy.deepcopy(objects)
+        started = time.perf_counter()
+        func(view, data)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, data
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--db', default='benchmark_statistics')
+    arg_parser.add_argument('--repeat', type=int, default=20)
+    args = arg_parser.parse_args()
+
+    db = mongo_client[args.db]
+    db.activity_percentiles.insert_many([
+        {'site': 'common', 'id': oid, 'value': value * 10, 'percentile': value}
+        for oid in range(100) for value in range(1, 100)
+    ])
+    view = TagViews.__new__(TagViews)
+    view.site = 'common'
+    view.mongo_percentiles = db.activity_percentiles
+    try:
+        for n in (10, 50, 100):
+            objects = [{'id': oid, 'views': random.randint(0, 1000)} for oid in range(n)]
+            old_time, old_data = timed(old_percentiles, view, objects, args.repeat)
+            new_time, new_data = timed(TagViews.add_percentiles, view, objects, args.repeat)
+            assert old_data == new_data
+            print('{0} objects: find_one {1:.1f} ms, single query {2:.1f} ms'.format(
+                n, old_time * 1000, new_time * 1000
+            ))
+    finally:
+        mongo_client.drop_database(args.db)
+
+
+if __name__ == '__main__':
+    main()
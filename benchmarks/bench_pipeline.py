@@ -0,0 +1,208 @@
+"""
+Benchmark of the whole parse pipeline on a generated piwik_access.log, offline: ClickHouse is a local stub.
+Stages run separately on the first --stage-lines lines, end_to_end runs LogTail -> parse_lines -> StreamWriter
+over the whole file. For every stage prints lines/s and tracemalloc peak of a second, traced run.
+Results are compared with baselines.json, which is machine specific: --save-baseline stores current results,
+--check exits with 1 if a stage got slower than the tolerance allows.
+Run from repository root: python -m benchmarks.bench_pipeline --lines 1000000
+"""
+from benchmarks import fixtures
+from benchmarks.clickhouse_stub import ClickHouseStub
+import common.logparser
+from common.logparser import LogTail
+import parse_nginx_logs
+from parse_nginx_logs import Clickstream
+import argparse
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+baselines_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+
+
+class Pipeline:
+    """Stages of parse_nginx_logs, every stage returns number of processed items and keeps its output"""
+
+    def __init__(self, filename, stage_lines, stub_url):
+        self.filename = filename
+        self.stage_lines = stage_lines
+        self.stub_url = stub_url
+        self.clickstream = Clickstream()
+        self.lines = []
+        self.records = []
+        self.rows = []
+        self.tsv = []
+
+    def _writer(self, fmt, output):
+        return parse_nginx_logs.clickhouse.FileWriter(
+            output, 'clickstream_table_name', self.clickstream.columns, header=False, fmt=fmt,
+            types=fixtures.column_types(self.clickstream.columns)
+        )
+
+    def read(self):
+        self.lines = []
+        for line in LogTail(self.filename, offset_name='bench', autocommit=False):
+            self.lines.append(line)
+            if len(self.lines) >= self.stage_lines:
+                break
+        return len(self.lines)
+
+    def decode(self):
+        """json, body unescaping and query strings"""
+        self.records = []
+        for line in self.lines:
+            self.clickstream.parse_line(line, None, self.records)
+        return len(self.lines)
+
+    def convert(self):
+        """convert_row with user agent detection and time conversion"""
+        self.clickstream = Clickstream()
+        self.rows = [self.clickstream.convert_row(r) for r in self.records]
+        return len(self.rows)
+
+    def convert_batch(self):
+        columns = Clickstream().convert_batch(self.records)
+        return len(columns['event_time'])
+
+    def write_tsv(self):
+        with open(os.devnull, 'w') as f:
+            cr = self._writer('TSV', f)
+            for row in self.rows:
+                cr.write_row(row)
+        return len(self.rows)
+
+    def write_rowbinary(self):
+        with open(os.devnull, 'wb') as f:
+            cr = self._writer('RowBinary', f)
+            for row in self.rows:
+                cr.write_row(row)
+            cr.flush()
+        return len(self.rows)
+
+    def upload(self):
+        """sends TSV rows to the stub by StreamWriter batches"""
+        self.tsv = [parse_nginx_logs.clickhouse.tsv_row(self.clickstream.columns, row) for row in self.rows]
+        parse_nginx_logs.clickhouse.url = self.stub_url
+        cr = parse_nginx_logs.clickhouse.stream_writer('clickstream_table_name', self.clickstream.columns)
+        for data in self.tsv:
+            cr.write(data, 1)
+        cr.close()
+        return cr.rows_sent
+
+    def end_to_end(self):
+        """serial run of Clickstream.main without the lock and offset commits"""
+        self.lines = self.records = self.rows = self.tsv = []
+        parse_nginx_logs.clickhouse.url = self.stub_url
+        clickstream = Clickstream()
+        log = LogTail(self.filename, offset_name='bench', autocommit=False)
+        cr = parse_nginx_logs.clickhouse.stream_writer(
+            'clickstream_table_name', clickstream.columns
+        )
+        lines = [0]
+
+        def counted(log):
+            for line in log:
+                lines[0] += 1
+                yield line
+        clickstream.parse_lines(counted(log), cr)
+        cr.close()
+        return lines[0]
+
+    stages = ('read', 'decode', 'convert', 'convert_batch', 'write_tsv', 'write_rowbinary', 'upload', 'end_to_end')
+
+
+def measure(pipeline, stage, memory):
+    method = getattr(pipeline, stage)
+    gc.collect()
+    started = time.perf_counter()
+    items = method()
+    elapsed = time.perf_counter() - started
+    result = {'items': items, 'seconds': elapsed, 'per_second': items / elapsed if elapsed else 0.0}
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        method()
+        result['peak_mb'] = tracemalloc.get_traced_memory()[1] / 1048576
+        tracemalloc.stop()
+    return result
+
+
+def compare(results, baselines, tolerance):
+    """:return: stages slower than baseline by more than tolerance"""
+    regressions = []
+    for stage, result in results.items():
+        baseline = baselines.get(stage)
+        if not baseline or not baseline['per_second']:
+            continue
+        ratio = result['per_second'] / baseline['per_second']
+        result['vs_baseline'] = ratio
+        if ratio < 1 - tolerance:
+            regressions.append(stage)
+    return regressions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--lines', type=int, default=1000000, help='Lines in generated log')
+    arg_parser.add_argument('--kind', default='mixed', choices=('get', 'bulk', 'impressions', 'mixed'))
+    arg_parser.add_argument('--log', default=None, help='Use existing log instead of generating one')
+    arg_parser.add_argument('--stage-lines', type=int, default=100000, help='Lines used by separate stages')
+    arg_parser.add_argument('--stages', default=','.join(Pipeline.stages), help='Comma separated stages')
+    arg_parser.add_argument('--no-memory', action='store_true', help='Skip traced runs')
+    arg_parser.add_argument('--baselines', default=baselines_file, help='Baselines json')
+    arg_parser.add_argument('--save-baseline', action='store_true', help='Store results as baselines')
+    arg_parser.add_argument('--check', action='store_true', help='Exit with 1 on regressions')
+    arg_parser.add_argument('--tolerance', type=float, default=0.15, help='Allowed slowdown, fraction')
+    args = arg_parser.parse_args()
+
+    working_dir = tempfile.mkdtemp()
+    common.logparser.logs_path = working_dir
+    filename = args.log
+    if filename is None:
+        filename = os.path.join(working_dir, 'piwik_access.log')
+        started = time.perf_counter()
+        size = fixtures.write_log(filename, args.kind, args.lines)
+        print('generated {0} lines, {1:.1f} MB in {2:.1f}s'.format(
+            args.lines, size / 1048576, time.perf_counter() - started
+        ))
+
+    results = {}
+    with ClickHouseStub() as stub:
+        pipeline = Pipeline(filename, args.stage_lines, stub.url)
+        for stage in args.stages.split(','):
+            results[stage] = measure(pipeline, stage, not args.no_memory)
+        print('stub received {0:.1f} MB in {1} requests'.format(stub.bytes_received / 1048576, stub.requests))
+
+    try:
+        with open(args.baselines) as f:
+            baselines = json.load(f)
+    except FileNotFoundError:
+        baselines = {}
+    regressions = compare(results, baselines, args.tolerance)
+    for stage, result in results.items():
+        print('{0:16} {1:9d} items {2:8.2f}s {3:11.0f}/s{4}{5}'.format(
+            stage, result['items'], result['seconds'], result['per_second'],
+            '  peak {0:7.1f} MB'.format(result['peak_mb']) if 'peak_mb' in result else '',
+            '  x{0:.2f} of baseline'.format(result['vs_baseline']) if 'vs_baseline' in result else ''
+        ))
+    if args.save_baseline:
+        baselines.update(results)
+        with open(args.baselines, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+    if args.log is None:
+        os.remove(filename)
+    for name in os.listdir(working_dir):
+        os.remove(os.path.join(working_dir, name))
+    os.rmdir(working_dir)
+    if regressions:
+        print('slower than baseline: {0}'.format(', '.join(regressions)))
+        if args.check:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
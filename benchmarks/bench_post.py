@@ -0,0 +1,69 @@
+"""
+POST body handling: unescape_body against the unicode_escape round trip on fuzzed bodies,
+and parsing throughput on GET-only, POST bulk, impressions and mixed fixtures.
+Run from repository root: python -m benchmarks.bench_post --lines 20000
+"""
+from benchmarks import fixtures
+from common.querystring import unescape_body
+from parse_nginx_logs import Clickstream
+import argparse
+import json
+import random
+import time
+
+body_fragments = ['{"requests":["?e_c=a&e_n=b"]}', '\\\\', '\\"', '\\n', '\\u041c', '\\x41', 'Москва', 'é', '?', '&']
+
+
+class CountingWriter:
+    def __init__(self):
+        self.rows = 0
+
+    def write_row(self, d):
+        self.rows += 1
+
+    def write_columns(self, columns, rows):
+        self.rows += rows
+
+
+def legacy_unescape(body):
+    return bytes(body, 'utf-8').decode('unicode_escape')
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--lines', type=int, default=20000, help='Number of lines in every fixture')
+    args = arg_parser.parse_args()
+
+    rnd = random.Random(1)
+    for _ in range(100000):
+        body = ''.join(rnd.choice(body_fragments) for _ in range(rnd.randint(0, 8)))
+        try:
+            expected = legacy_unescape(body)
+        except UnicodeDecodeError:
+            continue
+        assert unescape_body(body) == expected, body
+
+    for kind in ('get', 'bulk', 'impressions', 'mixed'):
+        lines = fixtures.lines(kind, args.lines)
+        bodies = [json.loads(line)['body'] for line in lines]
+        started = time.perf_counter()
+        for body in bodies:
+            legacy_unescape(body)
+        legacy_time = time.perf_counter() - started
+        started = time.perf_counter()
+        for body in bodies:
+            unescape_body(body)
+        unescape_time = time.perf_counter() - started
+
+        clickstream = Clickstream()
+        cr = CountingWriter()
+        started = time.perf_counter()
+        clickstream.parse_lines(lines, cr)
+        elapsed = time.perf_counter() - started
+        print('{0}: {1} lines, {2} rows, {3:.0f} rows/s; body unescape {4:.3f}s -> {5:.3f}s'.format(
+            kind, len(lines), cr.rows, cr.rows / elapsed, legacy_time, unescape_time
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Differential check and timing of decode_query/split_url against urlparse + parse_qs + convert_qs.
+Run from repository root: python -m benchmarks.bench_querystring --cases 100000
+"""
+from common.querystring import split_url, decode_query
+from parse_nginx_logs import Clickstream
+from benchmarks.bench_columnar import sample_lines
+from urllib.parse import urlparse, parse_qs
+import argparse
+import json
+import random
+import timeit
+
+fragments = ['url', '_id', 'e_c', 'c_n', 'cvar', 'idsite', '%5Fid', 'e%5Fc', 'e+c', 'x', '', '=', '&', '&&',
+             '%', '%2', '%zz', '%D0%9C', '%FF', '+', '%2B', '%26', 'a=b', '#', ';', '?', 'Москва']
+
+
+def fuzz_query(rnd):
+    return ''.join(rnd.choice(fragments) for _ in range(rnd.randint(0, 12)))
+
+
+def old_decode(qs, keys):
+    return {k: v for k, v in Clickstream.convert_qs(parse_qs(qs)).items() if k in keys}
+
+
+def sample_queries(lines):
+    queries = []
+    for line in lines:
+        record = json.loads(line)
+        if record['request'].startswith('GET'):
+            queries.append(urlparse(record['request'].split(' ')[1]).query)
+        else:
+            queries.extend(item[1:] for item in json.loads(record['body'])['requests'])
+    return queries
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--cases', type=int, default=100000, help='Number of fuzzed query strings')
+    args = arg_parser.parse_args()
+    keys = Clickstream().query_keys
+    rnd = random.Random(1)
+
+    for _ in range(args.cases):
+        qs = fuzz_query(rnd)
+        assert decode_query(qs, keys) == old_decode(qs, keys), qs
+        url = rnd.choice(['/piwik', '/piwik?', '//host/piwik?', 'http://h/piwik?', '/piwik;p?', '/pi\twik?']) + qs
+        parsed_url = urlparse(url)
+        assert split_url(url) == (parsed_url.path, parsed_url.query), url
+
+    queries = sample_queries(sample_lines(20000))
+    assert all(decode_query(qs, keys) == old_decode(qs, keys) for qs in queries)
+    old_time = min(timeit.repeat(lambda: [old_decode(qs, keys) for qs in queries], number=1, repeat=3))
+    new_time = min(timeit.repeat(lambda: [decode_query(qs, keys) for qs in queries], number=1, repeat=3))
+    print('{0} fuzzed cases match, {1} queries: parse_qs {2:.3f}s, decode_query {3:.3f}s, x{4:.1f}'.format(
+        args.cases, len(queries), old_time, new_time, old_time / new_time
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Compares dateutil with TimeConverter on nginx timestamps.
+Run from repository root: python -m benchmarks.bench_timeparse
+"""
+from common.timeparse import TimeConverter
+from datetime import datetime, timedelta
+import dateutil.parser
+import timeit
+
+time_str = '%Y-%m-%d %H:%M:%S'
+
+
+def sample(lines=100000, lines_per_second=20):
+    start = datetime(2018, 5, 14, 12, 0, 0)
+    iso_times = [
+        (start + timedelta(seconds=i // lines_per_second)).strftime('%Y-%m-%dT%H:%M:%S+03:00')
+        for i in range(lines)
+    ]
+    timestamps = [1526288400 + (i * 7919) % 86400 for i in range(lines)]
+    return iso_times, timestamps
+
+
+def main():
+    iso_times, timestamps = sample()
+
+    def old_iso():
+        for s in iso_times:
+            dateutil.parser.parse(s).strftime(time_str)
+
+    def new_iso():
+        converter = TimeConverter(time_str)
+        for s in iso_times:
+            converter.iso(s)
+
+    def old_ts():
+        for tm in timestamps:
+            datetime.fromtimestamp(tm).strftime(time_str)
+
+    def new_ts():
+        converter = TimeConverter(time_str)
+        for tm in timestamps:
+            converter.timestamp(tm)
+
+    converter = TimeConverter(time_str)
+    assert all(converter.iso(s) == dateutil.parser.parse(s).strftime(time_str) for s in iso_times[:1000])
+
+    for name, old, new in (('iso8601', old_iso, new_iso), ('timestamp', old_ts, new_ts)):
+        old_time = min(timeit.repeat(old, number=1, repeat=3))
+        new_time = min(timeit.repeat(new, number=1, repeat=3))
+        print('{0}: old {1:.3f}s, new {2:.3f}s, x{3:.1f}'.format(name, old_time, new_time, old_time / new_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Local stand-in for ClickHouse HTTP interface: accepts any POST, reads and counts the body
+(plain or chunked), answers 200 with an empty body. Used by benchmarks to run offline.
+"""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import threading
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _read_body(self):
+        size = 0
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                chunk_size = int(self.rfile.readline().split(b';')[0], 16)
+                if chunk_size == 0:
+                    self.rfile.readline()
+                    break
+                while chunk_size > 0:
+                    data = self.rfile.read(min(chunk_size, 1048576))
+                    chunk_size -= len(data)
+                    size += len(data)
+                self.rfile.readline()
+        else:
+            length = int(self.headers.get('Content-Length', 0))
+            while length > 0:
+                data = self.rfile.read(min(length, 1048576))
+                length -= len(data)
+                size += len(data)
+        return size
+
+    def do_POST(self):
+        size = self._read_body()
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.bytes_received += size
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ClickHouseStub(object):
+    """Runs the stub in a background thread, use as context manager"""
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.server = ThreadingHTTPServer((host, port), StubHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = 0
+        self.server.bytes_received = 0
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}'.format(*self.server.server_address)
+
+    @property
+    def requests(self):
+        return self.server.requests
+
+    @property
+    def bytes_received(self):
+        return self.server.bytes_received
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+    import argparse
+    arg_parser = argparse.ArgumentParser(description='Local ClickHouse HTTP stub')
+    arg_parser.add_argument('--port', type=int, default=8123)
+    args = arg_parser.parse_args()
+    ClickHouseStub(port=args.port).server.serve_forever()
@@ -0,0 +1,127 @@
+"""
+Synthetic piwik_access.log lines for benchmarks: GET pageviews, POST bulk requests, POST impressions and mixes
+"""
+from urllib.parse import quote
+import json
+import os
+import random
+
+
+def dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+user_agents = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/66.0 Safari/537.36',
+    'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:59.0) Gecko/20100101 Firefox/59.0',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_13_4) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/11.1 Safari/605.1.15',
+    'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/65.0.3325.181 Safari/537.36',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 11_3 like Mac OS X) AppleWebKit/605.1.15 Mobile/15E148',
+    'Mozilla/5.0 (Linux; Android 8.0.0; SM-G950F) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/66.0 Mobile Safari/537.36',
+    'Mozilla/5.0 (Linux; Android 7.0; Redmi Note 4) AppleWebKit/537.36 (KHTML, like Gecko) YaBrowser/18.3.1 Mobile',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/64.0 YaBrowser/18.3.1',
+    'Opera/9.80 (Windows NT 6.1; WOW64) Presto/2.12.388 Version/12.18',
+    'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)',
+    'Mozilla/5.0 (compatible; YandexBot/3.0; +http://yandex.com/bots)',
+]
+sections = ['news', 'sport', 'auto', 'undefined', '']
+
+
+def column_types(columns):
+    """Example clickstream table schema for offline runs of binary formats, the parser reads the real one"""
+    types = dict.fromkeys(columns, 'Nullable(String)')
+    types.update({
+        'event_time': "DateTime('UTC')", 'site': 'String', 'is_mobile': 'UInt8', 'ping': 'UInt8',
+        'generation_speed': 'UInt32', 'first_visit_time': "Nullable(DateTime('UTC'))",
+        'last_visit_time': "Nullable(DateTime('UTC'))", 'visit_count': 'UInt32', 'new_visitor': 'UInt8',
+        'user_ip': 'String', 'user_is_mobile': 'UInt8', 'user_is_pc': 'UInt8', 'user_is_tablet': 'UInt8',
+        'user_is_touch': 'UInt8', 'user_is_bot': 'UInt8', 'referrer_time': "Nullable(DateTime('UTC'))",
+        'page_id': 'Nullable(UInt32)', 'page_tags': 'Array(UInt32)',
+        'mvt.name': 'Array(String)', 'mvt.value': 'Array(String)'
+    })
+    return types
+
+
+def query(i, rnd, **extra):
+    cvar = {
+        '1': ['page_type', rnd.choice(['article', 'main', 'null'])], '2': ['page_id', str(i)],
+        '3': ['page_tags', ','.join(str(rnd.randint(1, 500)) for _ in range(rnd.randint(0, 5)))],
+        '4': ['page_section', rnd.choice(sections)],
+    }
+    if rnd.random() < 0.2:
+        cvar['5'] = ['mvt.name', dumps(['exp{0}'.format(rnd.randint(1, 4))])]
+        cvar['6'] = ['mvt.value', dumps([rnd.choice(['a', 'b'])])]
+    params = [
+        ('idsite', '1'), ('rec', '1'), ('_id', '%016x' % (i % 5000)), ('pv_id', 'pv%d' % i),
+        ('url', 'https://example.com/{0}/{1}?utm_source=feed'.format(rnd.choice(sections) or 'main', i)),
+        ('urlref', 'https://example.com/'), ('_idts', '1526288400'), ('_viewts', str(1526288400 + i)),
+        ('_idvc', str(i % 7)), ('gt_ms', str(rnd.randint(20, 900))), ('cvar', dumps(cvar)),
+        ('res', rnd.choice(['1920x1080', '1366x768', '375x667'])), ('dimension1', 'suid%d' % (i % 5000)),
+        ('action_name', 'Новости / Статья {0}'.format(i)),
+    ]
+    params += sorted(extra.items())
+    return '&'.join('{0}={1}'.format(k, quote(v, safe='')) for k, v in params)
+
+
+def record(i, request, body='-'):
+    return dumps({
+        'ip': '10.0.{0}.{1}'.format(i % 256, i % 199),
+        'time': '2018-05-14T12:{0:02d}:{1:02d}+03:00'.format(i // 60 % 60, i % 60),
+        'request': request, 'body': body, 'referrer': 'https://example.com/',
+        'user_agent': user_agents[i * 7919 % len(user_agents)], 'country': 'RU', 'city': 'Москва'
+    })
+
+
+def get_line(i, rnd):
+    return record(i, 'GET /piwik?{0} HTTP/1.1'.format(query(i, rnd)))
+
+
+def bulk_line(i, rnd, events=None):
+    events = rnd.randint(2, 12) if events is None else events
+    requests = ['?' + query(i, rnd, e_c='scroll', e_a=str(n), e_v=str(n * 10)) for n in range(events)]
+    return record(i, 'POST /piwik HTTP/1.1', dumps({'requests': requests}))
+
+
+def impressions_line(i, rnd, impressions=None):
+    impressions = rnd.randint(5, 30) if impressions is None else impressions
+    body = {
+        'request': query(i, rnd),
+        'impressions': [{'c_n': 'teaser', 'c_p': 'news/{0}'.format(n), 'c_t': ''} for n in range(impressions)]
+    }
+    return record(i, 'POST /piwik HTTP/1.1', dumps(body))
+
+
+def iter_lines(kind, count, seed=1):
+    """
+    :param kind: get, bulk, impressions or mixed (85% get, 10% bulk, 5% impressions)
+    :param count: number of lines
+    """
+    rnd = random.Random(seed)
+    makers = {'get': get_line, 'bulk': bulk_line, 'impressions': impressions_line}
+    for i in range(count):
+        if kind == 'mixed':
+            roll = rnd.random()
+            maker = get_line if roll < 0.85 else bulk_line if roll < 0.95 else impressions_line
+        else:
+            maker = makers[kind]
+        yield maker(i, rnd)
+
+
+def lines(kind, count, seed=1):
+    return list(iter_lines(kind, count, seed))
+
+
+def write_log(filename, kind, count, unique=100000, seed=1):
+    """
+    Writes a log of count lines, lines are generated once for the first unique lines and repeated after that,
+    so logs of tens of millions of lines take minutes to generate
+    :return: size of the file in bytes
+    """
+    pool = lines(kind, min(count, unique), seed)
+    with open(filename, 'w', encoding='utf8') as f:
+        written = 0
+        while written < count:
+            part = pool[:count - written]
+            f.write('\n'.join(part))
+            f.write('\n')
+            written += len(part)
+    return os.stat(filename).st_size
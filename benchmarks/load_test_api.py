@@ -0,0 +1,70 @@
+"""
+Load test of TagViews endpoint: keeps N concurrent clients busy for D seconds,
+prints requests per second and latency percentiles for every concurrency level and
+throughput relative to the first level, a server that handles requests one at a time stays near x1.
+Compare both servers: python run_api.py / python run_asgi.py, then
+python -m benchmarks.load_test_api --url http://127.0.0.1:5000/api/common/activity/tagviews/ -c 1,50,200 -d 30
+"""
+import argparse
+import asyncio
+import random
+import time
+
+
+async def client(session, url, deadline, latencies, errors, ids):
+    suida = 'load{0}'.format(random.randint(0, 10000))
+    while time.monotonic() < deadline:
+        params = [('object_type', 'tag')] + [('object_id', str(random.choice(ids))) for _ in range(5)]
+        started = time.monotonic()
+        try:
+            async with session.get(url, params=params, cookies={'suida': suida}) as r:
+                await r.read()
+                if r.status != 200:
+                    errors.append(r.status)
+        except Exception as e:
+            errors.append(type(e).__name__)
+        latencies.append(time.monotonic() - started)
+
+
+async def run(url, concurrency, duration):
+    import aiohttp
+    latencies, errors = [], []
+    ids = list(range(1, 1000))
+    deadline = time.monotonic() + duration
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*[
+            client(session, url, deadline, latencies, errors, ids) for _ in range(concurrency)
+        ])
+    return latencies, errors
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--url', default='http://127.0.0.1:5000/api/common/activity/tagviews/')
+    arg_parser.add_argument('-c', '--concurrency', default='1,100', help='Comma separated numbers of clients')
+    arg_parser.add_argument('-d', '--duration', type=int, default=30, help='Seconds per concurrency level')
+    args = arg_parser.parse_args()
+
+    base_rps = None
+    for concurrency in [int(c) for c in args.concurrency.split(',')]:
+        latencies, errors = asyncio.run(run(args.url, concurrency, args.duration))
+        latencies.sort()
+        if not latencies:
+            print('c={0}: no requests made'.format(concurrency))
+            continue
+        rps = len(latencies) / args.duration
+        if base_rps is None:
+            base_rps = rps
+        print('c={0}: {1} requests, {2} errors, {3:.1f} rps (x{4:.1f}), p50 {5:.1f} ms, p99 {6:.1f} ms'.format(
+            concurrency, len(latencies), len(errors), rps, rps / base_rps,
+            percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000
+        ))
+
+
+if __name__ == '__main__':
+    main()
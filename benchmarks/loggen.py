@@ -0,0 +1,27 @@
+"""
+Generates piwik_access.log in the README json format: GET pageviews, POST bulk requests and impressions
+with varied user agents and custom variables.
+Run from repository root: python -m benchmarks.loggen --lines 10000000 --kind mixed --out /tmp/piwik_access.log
+"""
+from benchmarks import fixtures
+import argparse
+import time
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--lines', type=int, default=1000000, help='Number of lines')
+    arg_parser.add_argument('--kind', default='mixed', choices=('get', 'bulk', 'impressions', 'mixed'))
+    arg_parser.add_argument('--unique', type=int, default=100000, help='Number of distinct lines, repeated after')
+    arg_parser.add_argument('--seed', type=int, default=1)
+    arg_parser.add_argument('--out', default='piwik_access.log', help='Output file')
+    args = arg_parser.parse_args()
+    started = time.perf_counter()
+    size = fixtures.write_log(args.out, args.kind, args.lines, args.unique, args.seed)
+    print('{0}: {1} lines, {2:.1f} MB in {3:.1f}s'.format(
+        args.out, args.lines, size / 1048576, time.perf_counter() - started
+    ))
+
+
+if __name__ == '__main__':
+    main()
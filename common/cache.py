@@ -0,0 +1,122 @@
+import os
+import json
+import threading
+from time import monotonic
+from collections import OrderedDict
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class LRUCache(object):
+    """Bounded mapping that evicts the least recently used key, counts hits and misses"""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data), 'hits': self.hits, 'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0
+        }
+
+    def dump(self, filename):
+        """
+        Stores cache items as json, the file is replaced atomically
+        :param filename: path to json file
+        """
+        temp_filename = '{0}.tmp'.format(filename)
+        try:
+            with open(temp_filename, 'w') as f:
+                json.dump(list(self._data.items()), f, separators=(',', ':'))
+            os.replace(temp_filename, filename)
+        except (IOError, TypeError, ValueError) as e:
+            logger.warning('Unable to dump cache to {0}: {1}'.format(filename, e))
+
+    def load(self, filename):
+        """
+        Loads items stored by dump, keeps the most recent ones if file is bigger than maxsize
+        :param filename: path to json file
+        :return: number of loaded items
+        """
+        try:
+            with open(filename, 'r') as f:
+                items = json.load(f)
+        except FileNotFoundError:
+            return 0
+        except (IOError, ValueError) as e:
+            logger.warning('Unable to load cache from {0}: {1}'.format(filename, e))
+            return 0
+        for key, value in items[-self.maxsize:]:
+            self.set(key, tuple(value) if isinstance(value, list) else value)
+        return len(self._data)
+
+
+class TTLCache(LRUCache):
+    """Thread-safe LRUCache whose items expire ttl seconds after they are set"""
+
+    def __init__(self, maxsize=10000, ttl=600):
+        super(TTLCache, self).__init__(maxsize)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            return item is not None and item[0] > monotonic()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] <= monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        with self._lock:
+            super(TTLCache, self).set(key, (monotonic() + self.ttl, value))
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
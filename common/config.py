@@ -10,7 +10,12 @@ ch_config = {
     'port': 8123,
     'dbname': 'db_name',
     'user': 'default',
-    'password': 'password'
+    'password': 'password',
+    'pool_size': 10,
+    'compression': None,
+    'compress_response': False,
+    # timezone of DateTime values in RowBinary inserts, ClickHouse server timezone if None
+    'timezone': None
 }
 
 mg_config = {
@@ -18,5 +23,36 @@ mg_config = {
     'port': 27017
 }
 
+uid_cache_config = {
+    'size': 100000,
+    'ttl': 3600
+}
+
+# views are buffered in memory and flushed to mongo in bulk if enabled,
+# journal: base path of local journals, every api process keeps its own <journal>.<pid>
+write_behind_config = {
+    'enabled': False,
+    'flush_interval': 1.0,
+    'max_size': 10000,
+    'journal': None
+}
+
+# TagViews.get_data results, backend: lru, simple or redis, several api workers need redis
+response_cache_config = {
+    'enabled': False,
+    'backend': 'lru',
+    'size': 10000,
+    'ttl': 60
+}
+
+# parse_nginx_logs stage timings and counters, textfile: path to .prom file, statsd: [host, port]
+metrics_config = {
+    'enabled': False,
+    'prefix': 'clickstream',
+    'textfile': None,
+    'statsd': None,
+    'interval': 60
+}
+
 logs_path = '/var/log/nginx'
 working_path = '/tmp'
\ No newline at end of file
@@ -2,9 +2,18 @@
 
 from common.config import pg_config, ch_config, mg_config
 from common.helpers import encode
-from time import sleep
+from time import sleep, time
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+import calendar
 import requests
 import json
+import queue
+import threading
+import asyncio
+import re
+import struct
+import uuid
 
 import logging
 logger = logging.getLogger(__name__)
@@ -77,26 +86,126 @@ class PG(object):
 class ClickHouse:
     from common.decorators import retry
 
-    def __init__(self, connect_type='master'):
+    binary_formats = ('RowBinary',)
+    compressors = ('gzip', 'zstd', 'lz4')
+    # share of rows ClickHouse may skip in an insert instead of rejecting it, as for imports of clickstream3.csv
+    insert_errors_ratio = 0.005
+    # errors of parsing inserted data: text, number, date, datetime, assertion, range, conversion
+    data_error_codes = frozenset((6, 26, 27, 38, 41, 53, 69, 70, 72, 117, 321))
+
+    def __init__(self, connect_type='master', pool_size=None, compression=None, compress_response=None):
+        """
+        :param pool_size: number of kept-alive connections
+        :param compression: request body compression: gzip, zstd, lz4 or None
+        :param compress_response: ask ClickHouse to compress responses
+        """
         self.db_config = ch_config
         self.url = 'http://{host}:{port}'.format(host=self.db_config['host'], port=self.db_config['port'])
         self.params = {'user': self.db_config['user'], 'database': self.db_config['dbname'],
                        'password': self.db_config['password']}
+        pool_size = self.db_config.get('pool_size', 10) if pool_size is None else pool_size
+        self.compression = self.db_config.get('compression') if compression is None else compression
+        if compress_response is None:
+            compress_response = self.db_config.get('compress_response', False)
+        if compress_response:
+            # requests sends Accept-Encoding: gzip, deflate and decodes responses itself
+            self.params['enable_http_compression'] = 1
+        if self.compression is not None and self.compression not in self.compressors:
+            raise ValueError('Unknown compression {0}'.format(self.compression))
+        self.pool_size = pool_size
+        self.reset_session()
+        self.metrics = {'requests': 0, 'seconds': 0.0, 'bytes_sent': 0, 'bytes_raw': 0}
+
+    def reset_session(self):
+        """
+        Starts a new pool of kept-alive connections. A forked process calls it before its first request,
+        otherwise it sends requests over sockets of its parent
+        """
+        from requests.adapters import HTTPAdapter
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _compressor(self):
+        if self.compression == 'gzip':
+            import zlib
+            return zlib.compressobj(6, zlib.DEFLATED, 31)
+        elif self.compression == 'zstd':
+            import zstandard
+            return zstandard.ZstdCompressor().compressobj()
+        else:
+            import lz4.frame
+            return _LZ4Compressor(lz4.frame.LZ4FrameCompressor())
+
+    def _body(self, data, counter, chunk_size=1048576):
+        """
+        Yields request body pieces, compressed if compression is set, and counts bytes
+        :param data: bytes, file object or iterable of bytes
+        :param counter: dictionary to store raw and sent sizes
+        """
+        if isinstance(data, (bytes, bytearray)):
+            chunks = (data,)
+        elif hasattr(data, 'read'):
+            chunks = iter(lambda: data.read(chunk_size), b'')
+        else:
+            chunks = data
+        compressor = self._compressor() if self.compression is not None else None
+        for chunk in chunks:
+            counter['bytes_raw'] += len(chunk)
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                counter['bytes_sent'] += len(chunk)
+                yield chunk
+        if compressor is not None:
+            chunk = compressor.flush()
+            counter['bytes_sent'] += len(chunk)
+            yield chunk
 
     def _send(self, data, stream=False, **kwargs):
+        query_type = self.get_query_type(data) if isinstance(data, str) else None
         try:
             data = data.encode('utf-8')
         except AttributeError:
             pass
         params = dict(self.params, **kwargs)
-        r = requests.post(self.url, params=params, data=data, stream=stream)
+        counter = {'bytes_raw': 0, 'bytes_sent': 0}
+        headers = {}
+        if self.compression is not None:
+            headers['Content-Encoding'] = self.compression
+            body = b''.join(self._body(data, counter)) if isinstance(data, (bytes, bytearray)) else \
+                self._body(data, counter)
+        elif isinstance(data, (bytes, bytearray)):
+            counter['bytes_raw'] = counter['bytes_sent'] = len(data)
+            body = data
+        else:
+            body = self._body(data, counter)
+        started = time()
+        r = self.session.post(self.url, params=params, data=body, headers=headers, stream=stream)
+        elapsed = time() - started
+        self.metrics['requests'] += 1
+        self.metrics['seconds'] += elapsed
+        self.metrics['bytes_sent'] += counter['bytes_sent']
+        self.metrics['bytes_raw'] += counter['bytes_raw']
+        logger.debug('ClickHouse request: {0:.3f}s, {1} bytes sent ({2} raw)'.format(
+            elapsed, counter['bytes_sent'], counter['bytes_raw']
+        ))
         if r.status_code != 200:
-            if 'Code: 62' in r.text and self.get_query_type(data) in ('select', 'show'):
+            if 'Code: 62' in r.text and query_type in ('select', 'show'):
                 logger.warning('empty query')
             else:
                 raise Exception(r.text)
         return r
 
+    @staticmethod
+    def is_data_error(e):
+        """
+        :return: True if ClickHouse rejected inserted data itself, another insert of the same rows fails the same way
+        """
+        match = re.search(r'\bCode: (\d+)', str(e))
+        return match is not None and int(match.group(1)) in ClickHouse.data_error_codes
+
     @staticmethod
     def _merge_tree_parser(create_query):
         if 'mergetree' not in create_query.lower():
@@ -155,68 +264,1065 @@ class ClickHouse:
                 logger.warning('File not found')
 
 
+    stream_formats = {
+        'JSONEachRow': 'JSONEachRow', 'TSV': 'TSVWithNames', 'RowBinary': 'RowBinaryWithNamesAndTypes'
+    }
+
+    def iter_query(self, q, format_='JSONEachRow', batch_size=None, chunk_size=65536, **kwargs):
+        """
+        Yields result rows as dictionaries while response is being downloaded,
+        memory use doesn't depend on result size
+        :param q: select query without FORMAT
+        :param format_: transfer format: JSONEachRow, TSV (values are strings) or RowBinary (typed values)
+        :param batch_size: yield lists of up to batch_size rows instead of single rows
+        :param chunk_size: size of response chunks in bytes
+        """
+        q += ' FORMAT {fmt}'.format(fmt=self.stream_formats[format_])
+        result = self._send(q, True, **kwargs)
+        try:
+            if result.status_code != 200:
+                return
+            chunks = result.iter_content(chunk_size=chunk_size)
+            if format_ == 'JSONEachRow':
+                rows = (json.loads(line) for line in iter_lines(chunks))
+            elif format_ == 'TSV':
+                rows = self._tsv_rows(chunks)
+            else:
+                rows = self.RowBinaryReader(chunks).rows()
+            if batch_size is None:
+                yield from rows
+            else:
+                batch = []
+                for row in rows:
+                    batch.append(row)
+                    if len(batch) >= batch_size:
+                        yield batch
+                        batch = []
+                if batch:
+                    yield batch
+        finally:
+            result.close()
+
+    @staticmethod
+    def _tsv_rows(chunks):
+        lines = iter_lines(chunks)
+        try:
+            names = [tsv_unescape(n) for n in next(lines).decode('utf-8').split('\t')]
+        except StopIteration:
+            return
+        for line in lines:
+            yield dict(zip(names, (tsv_unescape(v) for v in line.decode('utf-8').split('\t'))))
+
     # @retry(5, 10)
     def import_file(self, file_name, table=None, columns=None, fmt='CSV'):
-        import codecs
+        """
+        Imports file to ClickHouse. The file is streamed from disk by chunks,
+        INSERT query is passed in url if table is set, otherwise the file must start with it
+        """
         if table is not None:
             cl = '' if columns is None else '({0})'.format(','.join(columns))
-            with codecs.open(file_name, mode='r') as csv_file:
-                q = 'INSERT INTO {table} {columns} FORMAT {fmt}\n {csv}'.format(
-                    table=table, columns=cl, fmt=fmt, csv=csv_file.read()
-                )
-                return self.query(q)
+            q = 'INSERT INTO {table} {columns} FORMAT {fmt}'.format(table=table, columns=cl, fmt=fmt)
+            with open(file_name, 'rb') as f:
+                return self._send(f, True, query=q).text
         else:
-            self.query(file_name, format_='file', input_format_allow_errors_ratio=0.005)
+            self.query(file_name, format_='file', input_format_allow_errors_ratio=self.insert_errors_ratio)
 
-    def import_dataframe(self, table, df):
-        data = df.to_csv(index=False).split('\n')
-        q = "INSERT INTO {table} ({fields}) FORMAT CSV \n".format(table=table, fields=data[0])
-        q += '\n'.join(data[1:])
-        return self.query(q)
+    def import_dataframe(self, table, df, chunk_rows=100000):
+        """
+        Streams dataframe to ClickHouse as CSV converting chunk_rows rows at a time
+        """
+        fields = df.iloc[:0].to_csv(index=False).rstrip('\r\n')
+        q = 'INSERT INTO {table} ({fields}) FORMAT CSV'.format(table=table, fields=fields)
+
+        def chunks():
+            for start in range(0, len(df), chunk_rows):
+                yield df.iloc[start:start + chunk_rows].to_csv(index=False, header=False).encode('utf-8')
+
+        return self._send(chunks(), True, query=q).text
 
     def optimize(self, table):
         q = 'OPTIMIZE TABLE {table}'.format(table=table)
         return self.query(q)
 
     def finalize(self, table):
-        """Работает только с движками *ingMergeTree, но не самим MergeTree"""
+        """
+        Работает только с движками *ingMergeTree, но не самим MergeTree.
+        Копирует всю таблицу, finalize_partitions обрабатывает только изменённые партиции
+        """
         logger.info('Finalizing table')
+        create_query = self.query('SHOW CREATE TABLE {table}'.format(table=table), format_='JSON').get(
+            'data', [])[0].get('statement')
+        queries = self._finalize_queries(table, self.db_config['dbname'], create_query)
+        if queries is None:
+            logger.warning('Bad table engine')
+            return
+        for q in queries:
+            self.query(q)
+
+    @classmethod
+    def _finalize_queries(cls, table, dbname, create_query):
+        """
+        Запросы finalize, общие для ClickHouse и AsyncClickHouse
+        :param create_query: SHOW CREATE TABLE таблицы
+        :return: список запросов или None, если движок не *ingMergeTree
+        """
         table_split = table.split('.')
         if len(table_split) == 1:
             table_name = table
-            schema = self.db_config['dbname']
+            schema = dbname
         else:
             schema = table_split[0]
             table_name = table_split[1]
         full_table = '{0}.{1}'.format(schema, table_name)
         temp_table = '{0}_temp'.format(full_table)
         old_table = '{0}_old'.format(full_table)
-        create_query = self.query('SHOW CREATE TABLE {table}'.format(table=table), format_='JSON').get(
-            'data', [])[0].get('statement').replace(full_table, temp_table)
-        table_params = self._merge_tree_parser(create_query)
-        if table_params is not None and table_params['engine'] != 'MergeTree':
-            self.query(create_query)
-            self.query('INSERT INTO {0} SELECT * FROM {1} FINAL'.format(temp_table, full_table))
-            self.query('RENAME TABLE {0} TO {1}'.format(full_table, old_table))
-            self.query('RENAME TABLE {0} TO {1}'.format(temp_table, full_table))
-            self.query('DROP TABLE {0}'.format(old_table))
+        create_query = create_query.replace(full_table, temp_table)
+        table_params = cls._merge_tree_parser(create_query)
+        if table_params is None or table_params['engine'] == 'MergeTree':
+            return None
+        return [
+            create_query,
+            'INSERT INTO {0} SELECT * FROM {1} FINAL'.format(temp_table, full_table),
+            'RENAME TABLE {0} TO {1}'.format(full_table, old_table),
+            'RENAME TABLE {0} TO {1}'.format(temp_table, full_table),
+            'DROP TABLE {0}'.format(old_table),
+        ]
+
+    def _split_table(self, table):
+        table_split = table.split('.')
+        if len(table_split) == 1:
+            return self.db_config['dbname'], table
+        return table_split[0], table_split[1]
+
+    @staticmethod
+    def _literal(s):
+        return "'{0}'".format(s.replace('\\', '\\\\').replace("'", "\\'"))
+
+    def table_schema(self, table):
+        """
+        Describes table by system.tables and system.columns
+        :param table: table or database.table
+        :return: {'database', 'table', 'engine', 'partition_key', 'sorting_key',
+            'columns': [{'name', 'type', 'default_kind'}]} or None if there is no such table
+        """
+        database, name = self._split_table(table)
+        tables = self.query(
+            'SELECT engine, partition_key, sorting_key FROM system.tables WHERE database = {0} AND name = {1}'.format(
+                self._literal(database), self._literal(name)
+            ), format_='JSON'
+        ).get('data', [])
+        if not tables:
+            return None
+        columns = self.query(
+            'SELECT name, type, default_kind FROM system.columns WHERE database = {0} AND table = {1} '
+            'ORDER BY position'.format(self._literal(database), self._literal(name)), format_='JSON'
+        ).get('data', [])
+        return dict(tables[0], database=database, table=name, columns=columns)
+
+    def timezone(self):
+        """
+        Timezone of DateTime values sent in binary formats to columns declared without one:
+        ch_config timezone or ClickHouse server timezone, TSV values of such columns are parsed in it
+        """
+        tz = self.db_config.get('timezone')
+        if tz is None:
+            tz = self.query('SELECT timezone() AS tz', format_='JSON')['data'][0]['tz']
+        return tz
+
+    def column_types(self, table, columns):
+        """
+        Types of columns for binary formats by table_schema, DateTime columns get explicit timezone
+        :param table: table or database.table
+        :param columns: column names
+        :return: {column: type}
+        :raises ValueError: if there is no such table or column
+        """
+        schema = self.table_schema(table)
+        if schema is None:
+            raise ValueError('Table {0} not found'.format(table))
+        types = {c['name']: c['type'] for c in schema['columns']}
+        missing = [c for c in columns if c not in types]
+        if missing:
+            raise ValueError('Table {0} has no columns {1}'.format(table, ', '.join(missing)))
+        result = {c: types[c] for c in columns}
+        if any(re.search(r'\bDateTime\b(?!\()', t) for t in result.values()):
+            tz = self._literal(self.timezone())
+            for c, t in result.items():
+                result[c] = re.sub(r'\bDateTime\b(?!\()', 'DateTime({0})'.format(tz), t)
+        return result
+
+    def deduplication_window(self, table):
+        """
+        Number of recent inserts whose insert_deduplication_token ClickHouse remembers for the table:
+        replicated_deduplication_window of Replicated engines, non_replicated_deduplication_window of others,
+        set in the table SETTINGS or the server default
+        :param table: table or database.table
+        :raises ValueError: if there is no such table
+        """
+        database, name = self._split_table(table)
+        tables = self.query(
+            'SELECT engine, engine_full FROM system.tables WHERE database = {0} AND name = {1}'.format(
+                self._literal(database), self._literal(name)
+            ), format_='JSON'
+        ).get('data', [])
+        if not tables:
+            raise ValueError('Table {0} not found'.format(table))
+        if tables[0]['engine'].startswith('Replicated'):
+            setting = 'replicated_deduplication_window'
         else:
+            setting = 'non_replicated_deduplication_window'
+        match = re.search(r'\b{0}\s*=\s*(\d+)'.format(setting), tables[0]['engine_full'])
+        if match:
+            return int(match.group(1))
+        settings = self.query(
+            'SELECT value FROM system.merge_tree_settings WHERE name = {0}'.format(self._literal(setting)),
+            format_='JSON'
+        ).get('data', [])
+        return int(settings[0]['value']) if settings else 0
+
+    def changed_partitions(self, table):
+        """
+        Partitions which can have not collapsed rows: with several active parts or with a part
+        that was inserted and not merged yet. A partition of one merged part is already final
+        :param table: table or database.table
+        :return: list of {'partition', 'partition_id', 'parts', 'rows', 'bytes'}
+        """
+        database, name = self._split_table(table)
+        partitions = self.query(
+            'SELECT partition, partition_id, count() AS parts, sum(rows) AS total_rows, '
+            'sum(bytes_on_disk) AS total_bytes '
+            'FROM system.parts WHERE database = {0} AND table = {1} AND active '
+            'GROUP BY partition, partition_id HAVING parts > 1 OR min(level) = 0 '
+            'ORDER BY partition_id'.format(self._literal(database), self._literal(name)), format_='JSON'
+        ).get('data', [])
+        # 64 bit integers are quoted in JSON format
+        return [{
+            'partition': p['partition'], 'partition_id': p['partition_id'], 'parts': int(p['parts']),
+            'rows': int(p['total_rows']), 'bytes': int(p['total_bytes'])
+        } for p in partitions]
+
+    def finalize_partitions(self, table, mode='optimize'):
+        """
+        Collapses rows of changed partitions only, the rest of the table is not read or copied.
+        Works only with *ingMergeTree engines, like finalize
+        :param table: table or database.table
+        :param mode: optimize - OPTIMIZE TABLE ... PARTITION ID ... FINAL, safe with concurrent inserts;
+            replace - partition is copied with FINAL to a temporary table and replaces the original one,
+            rows inserted into the partition meanwhile are lost, so use it only for partitions
+            that are not written anymore. Needs ClickHouse with _partition_id virtual column,
+            replicated tables are always optimized
+        :return: list of partitions from changed_partitions with 'seconds' spent on each,
+            'bytes' is the size of the partition rewritten, 'skipped' is True if OPTIMIZE did nothing
+            (a merge couldn't be assigned), such partitions are not rewritten
+        """
+        schema = self.table_schema(table)
+        engine = '' if schema is None else schema['engine'].replace('Replicated', '')
+        if not engine.endswith('MergeTree') or engine == 'MergeTree':
             logger.warning('Bad table engine')
+            return []
+        if mode == 'replace' and schema['engine'].startswith('Replicated'):
+            # a copy made by CREATE TABLE ... AS would share replication path with the table
+            logger.warning('Replace mode is not supported for replicated tables, partitions are optimized')
+            mode = 'optimize'
+        full_table = '{database}.{table}'.format(**schema)
+        partitions = self.changed_partitions(full_table)
+        logger.info('Finalizing {0} partitions of {1}'.format(len(partitions), full_table))
+        # every run copies to its own table, concurrent runs don't drop each other's copy
+        temp_table = '{0}_finalize_{1}'.format(full_table, uuid.uuid4().hex)
+        if mode == 'replace' and partitions:
+            columns = ','.join(
+                '`{0}`'.format(c['name']) for c in schema['columns']
+                if c['default_kind'] not in ('MATERIALIZED', 'ALIAS')
+            )
+            self.query('CREATE TABLE {0} AS {1}'.format(temp_table, full_table))
+        started = time()
+        try:
+            for partition in partitions:
+                partition_started = time()
+                partition_id = self._literal(partition['partition_id'])
+                if mode == 'replace':
+                    self.query('INSERT INTO {t} ({c}) SELECT {c} FROM {s} FINAL WHERE _partition_id = {p}'.format(
+                        t=temp_table, c=columns, s=full_table, p=partition_id
+                    ))
+                    self.query('ALTER TABLE {0} REPLACE PARTITION ID {1} FROM {2}'.format(
+                        full_table, partition_id, temp_table
+                    ))
+                    self.query('TRUNCATE TABLE {0}'.format(temp_table))
+                    partition['skipped'] = False
+                else:
+                    partition['skipped'] = not self._optimize_partition(full_table, partition_id)
+                partition['seconds'] = time() - partition_started
+                if partition['skipped']:
+                    logger.info('Partition {0}: {1} parts, {2} rows, skipped by OPTIMIZE'.format(
+                        partition['partition'], partition['parts'], partition['rows']
+                    ))
+                    continue
+                logger.info('Partition {0}: {1} parts, {2} rows, {3} bytes rewritten in {4:.1f}s'.format(
+                    partition['partition'], partition['parts'], partition['rows'], partition['bytes'],
+                    partition['seconds']
+                ))
+        finally:
+            if mode == 'replace' and partitions:
+                self.query('DROP TABLE IF EXISTS {0}'.format(temp_table))
+        rewritten = [p for p in partitions if not p['skipped']]
+        logger.info('Finalized {0}: {1} partitions, {2} bytes rewritten, {3} skipped in {4:.1f}s'.format(
+            full_table, len(rewritten), sum(p['bytes'] for p in rewritten), len(partitions) - len(rewritten),
+            time() - started
+        ))
+        return partitions
+
+    def _optimize_partition(self, table, partition_id):
+        """
+        :return: False if ClickHouse did nothing: the partition is merged already or a merge couldn't be assigned
+        """
+        try:
+            self.query('OPTIMIZE TABLE {0} PARTITION ID {1} FINAL'.format(table, partition_id),
+                       optimize_throw_if_noop=1)
+        except Exception as e:
+            # CANNOT_ASSIGN_OPTIMIZE
+            if re.search(r'\bCode: 388\b', str(e)):
+                logger.debug(e)
+                return False
+            raise
+        return True
 
     class FileWriter:
-        def __init__(self, fn, t, c):
+        """
+        Writes rows to a file object. TSV files start with INSERT header and can be imported as is,
+        binary formats need a binary file and are imported with import_file(..., table, columns, fmt)
+        """
+        def __init__(self, fn, t, c, header=True, fmt='TSV', types=None, buffer_size=65536):
             self.filename = fn
             self.table = t
             self.columns = c
-            self.filename.write('INSERT INTO {t} ({c}) FORMAT TSV\n'.format(t=self.table, c=','.join(self.columns)))
+            self.fmt = fmt
+            self.rows = 0
+            self.buffer_size = buffer_size
+            if fmt in ClickHouse.binary_formats:
+                self.encoder = ClickHouse.RowBinaryEncoder(self.columns, types)
+                self._buffer = bytearray()
+            else:
+                self.encoder = None
+                if header:
+                    self.filename.write(
+                        'INSERT INTO {t} ({c}) FORMAT TSV\n'.format(t=self.table, c=','.join(self.columns))
+                    )
+
+        def write_row(self, d):
+            if self.encoder is None:
+                self.filename.write(ClickHouse.tsv_row(self.columns, d))
+            else:
+                self.encoder.encode_row(d, self._buffer)
+                if len(self._buffer) >= self.buffer_size:
+                    self.flush()
+            self.rows += 1
+
+        def write(self, data, rows=None):
+            self.flush()
+            self.filename.write(data)
+
+        def hold(self):
+            """The same interface as StreamWriter, the file is imported as a whole"""
+
+        def release(self):
+            pass
+
+        def write_columns(self, columns, rows):
+            """
+            Writes rows given column by column
+            :param columns: {column: list of values}
+            :param rows: number of values in every list
+            """
+            if self.encoder is None:
+                self.filename.write(ClickHouse.tsv_columns(self.columns, columns))
+                self.rows += rows
+            else:
+                self.rows += self.encoder.encode_columns(columns, self._buffer)
+                if len(self._buffer) >= self.buffer_size:
+                    self.flush()
+
+        def flush(self):
+            if self.encoder is not None and self._buffer:
+                self.filename.write(self._buffer)
+                del self._buffer[:]
+
+    class StreamWriter:
+        """
+        Sends rows to ClickHouse in bounded batches while rows are still being written.
+        Every batch is a separate INSERT posted as a chunked request body by a background thread.
+        Rows ClickHouse can't parse are skipped and counted in rows_rejected: up to insert_errors_ratio
+        of a batch by ClickHouse itself, beyond it a TSV batch is split until rejected rows are found,
+        a RowBinary batch, whose values are checked by the encoder, is rejected whole
+        """
+        def __init__(self, client, t, c, batch_rows=100000, batch_bytes=16 * 1024 * 1024, queue_size=2,
+                     fmt='TSV', types=None, position=None, on_sent=None, dedup_token=None,
+                     retry_interval=0, max_retry_interval=60):
+            """
+            :param position: callable returning a checkpoint of the source taken when a batch is closed
+            :param on_sent: callable receiving that checkpoint after the batch is inserted
+            :param dedup_token: prefix of insert_deduplication_token, batch number is appended to it,
+                so the same input written with the same batch limits is inserted once
+            :param retry_interval: seconds before the first retry of a failed insert, doubled up to
+                max_retry_interval after every failure, 0 fails at once. Batches wait in the queue meanwhile,
+                a retried insert has insert_deduplication_token, so it is inserted once if the first
+                attempt has reached ClickHouse and the table deduplicates inserts
+            """
+            self.client = client
+            self.position = position
+            self.on_sent = on_sent
+            self.table = t
+            self.columns = c
+            self.batch_rows = batch_rows
+            self.batch_bytes = batch_bytes
+            self.fmt = fmt
+            self.header = 'INSERT INTO {t} ({c}) FORMAT {f}'.format(t=self.table, c=','.join(self.columns), f=fmt)
+            if fmt in ClickHouse.binary_formats:
+                self.encoder = ClickHouse.RowBinaryEncoder(self.columns, types)
+            else:
+                self.encoder = None
+            self.dedup_token = dedup_token
+            self.rows_sent = 0
+            self.bytes_sent = 0
+            self.rows_rejected = 0
+            self.retry_interval = retry_interval
+            self.max_retry_interval = max_retry_interval
+            self._stopping = threading.Event()
+            self._held = False
+            self._batches = 0
+            self._batch = []
+            self._buffer = bytearray()
+            self._batch_rows = 0
+            self._batch_bytes = 0
+            self._error = None
+            self._queue = queue.Queue(maxsize=queue_size)
+            self._thread = threading.Thread(target=self._sender, daemon=True)
+            self._thread.start()
+
+        def _body(self, batch, piece_size=1048576):
+            piece = []
+            size = 0
+            for data in batch:
+                if isinstance(data, str):
+                    data = data.encode('utf-8')
+                piece.append(data)
+                size += len(data)
+                if size >= piece_size:
+                    yield b''.join(piece)
+                    piece = []
+                    size = 0
+            if piece:
+                yield b''.join(piece)
+
+        def _sender(self):
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                batch, rows, size, checkpoint, token = item
+                if self._error is not None:
+                    continue
+                try:
+                    self._insert(batch, rows, size, token)
+                    if checkpoint is not None and self.on_sent is not None:
+                        self.on_sent(checkpoint)
+                except Exception as e:
+                    self._error = ClickHouse.SendError(str(e))
+                    self._error.__cause__ = e
+
+        def _insert(self, batch, rows, size, token):
+            settings = {'input_format_allow_errors_ratio': ClickHouse.insert_errors_ratio}
+            if token is not None:
+                settings['insert_deduplication_token'] = token
+            try:
+                r = self._post(batch, settings)
+            except Exception as e:
+                if not ClickHouse.is_data_error(e):
+                    raise
+                if self.encoder is not None or rows == 1:
+                    logger.warning('{0} rows rejected: {1}'.format(rows, e))
+                    self.rows_rejected += rows
+                    return
+                lines = [line + b'\n' for line in b''.join(self._body(batch)).split(b'\n')[:-1]]
+                half = len(lines) // 2
+                for i, part in enumerate((lines[:half], lines[half:])):
+                    part_token = None if token is None else '{0}-{1}'.format(token, i)
+                    self._insert(part, len(part), sum(len(line) for line in part), part_token)
+                return
+            skipped = max(rows - self._written_rows(r, rows), 0)
+            if skipped:
+                logger.warning('{0} rows skipped by ClickHouse'.format(skipped))
+            self.rows_rejected += skipped
+            self.rows_sent += rows - skipped
+            self.bytes_sent += size
+
+        def _post(self, batch, settings):
+            delay = self.retry_interval
+            if delay and 'insert_deduplication_token' not in settings:
+                settings = dict(settings, insert_deduplication_token=uuid.uuid4().hex)
+            while True:
+                try:
+                    # binary data can start with whitespace bytes, so query goes to url params
+                    return self.client._send(self._body(batch), True, query=self.header, **settings)
+                except Exception as e:
+                    if not delay or ClickHouse.is_data_error(e) or self._stopping.is_set():
+                        raise
+                    logger.warning('Insert failed, retry in {0}s: {1}'.format(delay, e))
+                    if self._stopping.wait(delay):
+                        raise
+                    delay = min(delay * 2, self.max_retry_interval)
+
+        def stop_retrying(self):
+            """Fails the insert being retried and skips the rest, can be called from a signal handler"""
+            self._stopping.set()
+
+        @staticmethod
+        def _written_rows(response, rows):
+            """Rows written by an insert, from X-ClickHouse-Summary if the server sends it"""
+            try:
+                return int(json.loads(response.headers['X-ClickHouse-Summary'])['written_rows'])
+            except (AttributeError, KeyError, TypeError, ValueError):
+                return rows
+
+        def _check(self):
+            if self._error is not None:
+                raise self._error
+
+        @property
+        def pending_rows(self):
+            return self._batch_rows
 
         def write_row(self, d):
-            row = []
-            for c in self.columns:
-                if isinstance(d[c], dict):
-                    d[c] = json.dumps(d[c], separators=(',', ':'))
-                row.append(encode(d[c]).replace('\\', '\\\\').replace('\\N', 'N'))
-            self.filename.write('\t'.join(row) + '\n')
+            if self.encoder is None:
+                self.write(ClickHouse.tsv_row(self.columns, d), 1)
+            else:
+                self._check()
+                size = len(self._buffer)
+                self.encoder.encode_row(d, self._buffer)
+                self._batch_rows += 1
+                self._batch_bytes += len(self._buffer) - size
+                self._flush_if_full()
+
+        def write(self, data, rows=None):
+            """
+            Adds encoded rows to the current batch
+            :param data: complete TSV lines or RowBinary rows
+            :param rows: number of rows in data, counted for TSV if omitted
+            """
+            self._check()
+            self._move_buffer()
+            self._batch.append(data)
+            self._batch_rows += data.count('\n') if rows is None else rows
+            self._batch_bytes += len(data)
+            self._flush_if_full()
+
+        def write_columns(self, columns, rows):
+            """
+            Adds rows given column by column to the current batch
+            :param columns: {column: list of values}
+            :param rows: number of values in every list
+            """
+            if self.encoder is None:
+                self.write(ClickHouse.tsv_columns(self.columns, columns), rows)
+            else:
+                self._check()
+                size = len(self._buffer)
+                self._batch_rows += self.encoder.encode_columns(columns, self._buffer)
+                self._batch_bytes += len(self._buffer) - size
+                self._flush_if_full()
+
+        def _move_buffer(self):
+            if self._buffer:
+                self._batch.append(self._buffer)
+                self._buffer = bytearray()
+
+        def hold(self):
+            """
+            Keeps the current batch open until release(), rows of one source line go to one batch,
+            so a checkpoint taken when the batch is closed covers the whole line
+            """
+            self._held = True
+
+        def release(self):
+            self._held = False
+            self._flush_if_full()
+
+        def _flush_if_full(self):
+            if self._held:
+                return
+            if self._batch_rows >= self.batch_rows or self._batch_bytes >= self.batch_bytes:
+                self.flush()
+
+        def flush(self):
+            """Hands the current batch to the sender thread, blocks if the queue is full"""
+            self._check()
+            self._move_buffer()
+            if self._batch:
+                checkpoint = self.position() if self.position is not None else None
+                token = None if self.dedup_token is None else '{0}-{1}'.format(self.dedup_token, self._batches)
+                self._batches += 1
+                self._queue.put((self._batch, self._batch_rows, self._batch_bytes, checkpoint, token))
+                self._batch = []
+                self._batch_rows = 0
+                self._batch_bytes = 0
+
+        def close(self):
+            """Sends the rest of rows and waits for all batches, raises the first send error"""
+            try:
+                self.flush()
+            finally:
+                self._queue.put(None)
+                self._thread.join()
+            self._check()
+
+    class EncodeError(Exception):
+        """Value can't be packed to its column type, ClickHouse would reject the row too"""
+
+    class SendError(Exception):
+        """Batch insert failed, rows written after it are not sent"""
+
+    class RowBinaryEncoder:
+        """Packs rows to ClickHouse RowBinary format using column types of the table"""
+        int_formats = {
+            'UInt8': '<B', 'UInt16': '<H', 'UInt32': '<I', 'UInt64': '<Q',
+            'Int8': '<b', 'Int16': '<h', 'Int32': '<i', 'Int64': '<q',
+            'Float32': '<f', 'Float64': '<d'
+        }
+
+        def __init__(self, columns, types, timezone=None):
+            """
+            :param types: {column: type}, see ClickHouse.column_types
+            :param timezone: timezone of DateTime columns declared without one
+            """
+            self.columns = columns
+            self.types = [types[c] for c in columns]
+            self.timezone = timezone
+            self.encoders = [self._compile(t) for t in self.types]
+
+        @staticmethod
+        def _is_null(v):
+            return v is None or v == '\\N'
+
+        def _compile(self, t):
+            is_null = self._is_null
+            if t.startswith('Nullable('):
+                inner = self._compile(t[9:-1])
+
+                def nullable(v, buf):
+                    if is_null(v):
+                        buf.append(1)
+                    else:
+                        buf.append(0)
+                        inner(v, buf)
+                return nullable
+            if t.startswith('LowCardinality('):
+                return self._compile(t[15:-1])
+            if t.startswith('Array('):
+                inner = self._compile(t[6:-1])
+
+                def array(v, buf):
+                    if is_null(v):
+                        v = []
+                    write_varint(len(v), buf)
+                    for item in v:
+                        inner(item, buf)
+                return array
+            if t in self.int_formats:
+                pack = struct.Struct(self.int_formats[t]).pack
+                cast = float if t.startswith('Float') else int
+
+                def number(v, buf):
+                    buf += pack(0 if is_null(v) else cast(v))
+                return number
+            if t == 'String':
+                def string(v, buf):
+                    if is_null(v):
+                        v = ''
+                    elif isinstance(v, dict):
+                        v = json.dumps(v, separators=(',', ':'))
+                    b = encode(v).encode('utf-8')
+                    write_varint(len(b), buf)
+                    buf += b
+                return string
+            if t == 'DateTime' or t.startswith('DateTime('):
+                tz = t[10:-2] if t != 'DateTime' else self.timezone
+                if tz is None:
+                    raise ValueError('DateTime without timezone needs RowBinaryEncoder timezone')
+                timestamp = self._timestamp_function(ZoneInfo(tz))
+                pack_datetime = struct.Struct('<I').pack
+
+                def date_time(v, buf):
+                    buf += pack_datetime(0 if is_null(v) else timestamp(v))
+                return date_time
+            if t == 'Date':
+                pack_date = struct.Struct('<H').pack
+                epoch = date(1970, 1, 1)
+
+                def date_value(v, buf):
+                    buf += pack_date(0 if is_null(v) else (date.fromisoformat(v[:10]) - epoch).days)
+                return date_value
+            raise ValueError('Unsupported RowBinary type {0}'.format(t))
+
+        @staticmethod
+        def _timestamp_function(tz, cache_size=100000):
+            """
+            :return: function converting '%Y-%m-%d %H:%M:%S' wall time in tz to unix timestamp
+            """
+            timestamps = {}
+
+            def timestamp(v):
+                try:
+                    return timestamps[v]
+                except KeyError:
+                    pass
+                wall = datetime.strptime(v, '%Y-%m-%d %H:%M:%S')
+                ts = calendar.timegm(wall.timetuple()) - int(tz.utcoffset(wall).total_seconds())
+                if len(timestamps) >= cache_size:
+                    timestamps.clear()
+                timestamps[v] = ts
+                return ts
+            return timestamp
+
+        def encode_row(self, d, buf):
+            """
+            Appends row to buffer, buffer is left untouched if any value can't be packed
+            :param d: row dictionary
+            :param buf: bytearray
+            :raises ClickHouse.EncodeError: if a value doesn't fit its column type
+            """
+            mark = len(buf)
+            for c, t, enc in zip(self.columns, self.types, self.encoders):
+                try:
+                    enc(d[c], buf)
+                except KeyError:
+                    del buf[mark:]
+                    raise
+                except Exception as e:
+                    del buf[mark:]
+                    raise ClickHouse.EncodeError('{0} {1}: {2!r}: {3}'.format(c, t, d[c], e))
+
+        def encode_columns(self, columns, buf):
+            """
+            Appends rows given column by column, buffer is left untouched if any value can't be packed
+            :param columns: {column: list of values}
+            :param buf: bytearray
+            :return: number of appended rows
+            :raises ClickHouse.EncodeError: if a value doesn't fit its column type
+            """
+            encoders = self.encoders
+            mark = len(buf)
+            rows = 0
+            for row in zip(*[columns[c] for c in self.columns]):
+                try:
+                    for enc, v in zip(encoders, row):
+                        enc(v, buf)
+                except Exception as e:
+                    del buf[mark:]
+                    i = encoders.index(enc)
+                    raise ClickHouse.EncodeError('{0} {1}: {2!r}: {3}'.format(self.columns[i], self.types[i], v, e))
+                rows += 1
+            return rows
+
+    class RowBinaryReader:
+        """Decodes RowBinaryWithNamesAndTypes from an iterable of byte chunks"""
+        int_formats = {
+            'UInt8': '<B', 'UInt16': '<H', 'UInt32': '<I', 'UInt64': '<Q',
+            'Int8': '<b', 'Int16': '<h', 'Int32': '<i', 'Int64': '<q',
+            'Float32': '<f', 'Float64': '<d'
+        }
+
+        def __init__(self, chunks):
+            self._chunks = iter(chunks)
+            self._buf = bytearray()
+            self._pos = 0
+
+        def _fill(self):
+            try:
+                chunk = next(self._chunks)
+            except StopIteration:
+                return False
+            if self._pos:
+                del self._buf[:self._pos]
+                self._pos = 0
+            self._buf += chunk
+            return True
+
+        def _ensure(self, n):
+            while len(self._buf) - self._pos < n:
+                if not self._fill():
+                    raise EOFError('Unexpected end of RowBinary stream')
+
+        def _at_end(self):
+            while self._pos >= len(self._buf):
+                if not self._fill():
+                    return True
+            return False
+
+        def _varint(self):
+            n = shift = 0
+            while True:
+                self._ensure(1)
+                b = self._buf[self._pos]
+                self._pos += 1
+                n |= (b & 0x7f) << shift
+                if b < 0x80:
+                    return n
+                shift += 7
+
+        def _string(self):
+            n = self._varint()
+            self._ensure(n)
+            value = bytes(self._buf[self._pos:self._pos + n]).decode('utf-8', 'replace')
+            self._pos += n
+            return value
+
+        def _unpacker(self, fmt):
+            st = struct.Struct(fmt)
+
+            def unpack():
+                self._ensure(st.size)
+                value = st.unpack_from(self._buf, self._pos)[0]
+                self._pos += st.size
+                return value
+            return unpack
+
+        def _compile(self, t):
+            if t.startswith('Nullable('):
+                inner = self._compile(t[9:-1])
+                is_null = self._unpacker('<B')
+                return lambda: None if is_null() else inner()
+            if t.startswith('LowCardinality('):
+                return self._compile(t[15:-1])
+            if t.startswith('Array('):
+                inner = self._compile(t[6:-1])
+                return lambda: [inner() for _ in range(self._varint())]
+            if t in self.int_formats:
+                return self._unpacker(self.int_formats[t])
+            if t == 'String':
+                return self._string
+            if t.startswith('DateTime('):
+                # wall time in column timezone
+                unpack = self._unpacker('<I')
+                tz = ZoneInfo(t[10:-2])
+                return lambda: datetime.fromtimestamp(unpack(), tz).replace(tzinfo=None)
+            if t == 'DateTime':
+                unpack = self._unpacker('<I')
+                return lambda: datetime.fromtimestamp(unpack())
+            if t == 'Date':
+                unpack = self._unpacker('<H')
+                epoch = date(1970, 1, 1)
+                return lambda: epoch + timedelta(days=unpack())
+            raise ValueError('Unsupported RowBinary type {0}'.format(t))
+
+        def rows(self):
+            if self._at_end():
+                return
+            n = self._varint()
+            names = [self._string() for _ in range(n)]
+            decoders = [self._compile(self._string()) for _ in range(n)]
+            while not self._at_end():
+                yield dict(zip(names, [decode() for decode in decoders]))
+
+    def stream_writer(self, t, c, **kwargs):
+        return self.StreamWriter(self, t, c, **kwargs)
+
+    @staticmethod
+    def tsv_row(columns, d):
+        row = []
+        for c in columns:
+            if isinstance(d[c], dict):
+                d[c] = json.dumps(d[c], separators=(',', ':'))
+            row.append(encode(d[c]).replace('\\', '\\\\').replace('\\N', 'N'))
+        return '\t'.join(row) + '\n'
+
+    @staticmethod
+    def tsv_columns(columns, data):
+        """
+        TSV lines of rows given column by column, each line is the same as tsv_row gives
+        :param data: {column: list of values}
+        """
+        encoded = []
+        for c in columns:
+            values = []
+            for v in data[c]:
+                if isinstance(v, dict):
+                    v = json.dumps(v, separators=(',', ':'))
+                values.append(encode(v).replace('\\', '\\\\').replace('\\N', 'N'))
+            encoded.append(values)
+        return ''.join(['\t'.join(row) + '\n' for row in zip(*encoded)])
+
+
+class AsyncClickHouse:
+    """
+    asyncio ClickHouse client with the same methods as ClickHouse, every method is a coroutine.
+    Use as async context manager or call close() to release connections
+    """
+
+    def __init__(self, connect_type='master', concurrency=10, tries=3, delay=1, backoff=2):
+        """
+        :param concurrency: max number of simultaneous requests
+        :param tries, delay, backoff: retry parameters of network errors, see common.decorators.retry.
+            Only select and show are retried: an insert or DDL may have been applied before the connection broke
+        """
+        import aiohttp
+        from common.decorators import async_retry
+        self.aiohttp = aiohttp
+        self.db_config = ch_config
+        self.url = 'http://{host}:{port}'.format(host=self.db_config['host'], port=self.db_config['port'])
+        self.params = {'user': self.db_config['user'], 'database': self.db_config['dbname'],
+                       'password': self.db_config['password']}
+        self.concurrency = concurrency
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._session = None
+        self._post_retry = async_retry(
+            tries, delay, backoff, exception=(aiohttp.ClientError, asyncio.TimeoutError)
+        )(self._post_once)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self):
+        if self._session is None:
+            self._session = self.aiohttp.ClientSession(
+                connector=self.aiohttp.TCPConnector(limit=self.concurrency)
+            )
+        return self._session
+
+    async def _post(self, data=None, file_name=None, output=None, query_type=None, **kwargs):
+        post = self._post_retry if query_type in ('select', 'show') else self._post_once
+        return await post(data, file_name, output, query_type, **kwargs)
+
+    async def _post_once(self, data=None, file_name=None, output=None, query_type=None, **kwargs):
+        params = dict(self.params, **{k: str(v) for k, v in kwargs.items()})
+        async with self._semaphore:
+            if file_name is not None:
+                with open(file_name, 'rb') as f:
+                    return await self._request(f, params, output, query_type)
+            return await self._request(data, params, output, query_type)
+
+    async def _request(self, data, params, output, query_type):
+        async with self._get_session().post(self.url, params=params, data=data) as r:
+            if r.status != 200:
+                text = await r.text()
+                if 'Code: 62' in text and query_type in ('select', 'show'):
+                    logger.warning('empty query')
+                    return text
+                raise Exception(text)
+            if output is None:
+                return await r.text()
+            with open(output, 'wb') as f:
+                async for chunk in r.content.iter_chunked(1048576):
+                    f.write(chunk)
+            return output
+
+    async def _send(self, data, output=None, **kwargs):
+        query_type = ClickHouse.get_query_type(data) if isinstance(data, str) else None
+        try:
+            data = data.encode('utf-8')
+        except AttributeError:
+            pass
+        return await self._post(data, output=output, query_type=query_type, **kwargs)
+
+    async def query(self, q, format_='CSV', output=None, **kwargs):
+        if format_ != 'file':
+            if ClickHouse.get_query_type(q) in ('select', 'show'):
+                q += ' FORMAT {fmt}'.format(fmt=format_)
+            result = await self._send(q, output, **kwargs)
+            if output is None and format_ == 'JSON':
+                return json.loads(result)
+            return result
+        else:
+            try:
+                await self._post(file_name=q, **kwargs)
+            except FileNotFoundError:
+                logger.warning('File not found')
+
+    async def import_file(self, file_name, table=None, columns=None, fmt='CSV'):
+        if table is not None:
+            cl = '' if columns is None else '({0})'.format(','.join(columns))
+            q = 'INSERT INTO {table} {columns} FORMAT {fmt}'.format(table=table, columns=cl, fmt=fmt)
+            return await self._post(file_name=file_name, query=q)
+        else:
+            return await self.query(
+                file_name, format_='file', input_format_allow_errors_ratio=ClickHouse.insert_errors_ratio
+            )
+
+    async def import_dataframe(self, table, df):
+        header, _, data = df.to_csv(index=False).partition('\n')
+        q = 'INSERT INTO {table} ({fields}) FORMAT CSV'.format(table=table, fields=header)
+        return await self._post(data.encode('utf-8'), query=q)
+
+    async def optimize(self, table):
+        q = 'OPTIMIZE TABLE {table}'.format(table=table)
+        return await self.query(q)
+
+    async def finalize(self, table):
+        """Работает только с движками *ingMergeTree, но не самим MergeTree"""
+        logger.info('Finalizing table')
+        create_query = (await self.query('SHOW CREATE TABLE {table}'.format(table=table), format_='JSON')).get(
+            'data', [])[0].get('statement')
+        queries = ClickHouse._finalize_queries(table, self.db_config['dbname'], create_query)
+        if queries is None:
+            logger.warning('Bad table engine')
+            return
+        for q in queries:
+            await self.query(q)
+
+
+class _LZ4Compressor(object):
+    """Gives lz4 frame compressor the same compress/flush interface as zlib"""
+    def __init__(self, compressor):
+        self.compressor = compressor
+        self.started = False
+
+    def compress(self, data):
+        if not self.started:
+            self.started = True
+            return self.compressor.begin() + self.compressor.compress(data)
+        return self.compressor.compress(data)
+
+    def flush(self):
+        if not self.started:
+            self.started = True
+            return self.compressor.begin() + self.compressor.flush()
+        return self.compressor.flush()
+
+
+def iter_lines(chunks):
+    """Splits iterable of byte chunks to lines by \\n only"""
+    pending = b''
+    for chunk in chunks:
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        yield from lines
+    if pending:
+        yield pending
+
+
+tsv_escapes = {'b': '\b', 'f': '\f', 'r': '\r', 'n': '\n', 't': '\t', '0': '\0', "'": "'", '\\': '\\'}
+tsv_escape_format = re.compile(r'\\(.)')
+
+
+def tsv_unescape(value):
+    if value == '\\N':
+        return None
+    if '\\' not in value:
+        return value
+    return tsv_escape_format.sub(lambda m: tsv_escapes.get(m.group(1), m.group(1)), value)
+
+
+def write_varint(n, buf):
+    while n > 0x7f:
+        buf.append((n & 0x7f) | 0x80)
+        n >>= 7
+    buf.append(n)
 
 
 class Mongo:
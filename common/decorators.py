@@ -45,3 +45,38 @@ def retry(tries, delay=1, backoff=2, exception=Exception):
         return wrapper
 
     return decorator
+
+
+def async_retry(tries, delay=1, backoff=2, exception=Exception):
+    """
+    The same as retry, but for coroutine functions, sleeps with asyncio.sleep
+    """
+    import asyncio
+    import math
+
+    if backoff <= 1:
+        raise ValueError("backoff must be greater than 1")
+
+    tries = math.floor(tries)
+    if tries < 0:
+        raise ValueError("tries must be 0 or greater")
+
+    if delay <= 0:
+        raise ValueError("delay must be greater than 0")
+
+    def decorator(func):
+        async def wrapper(*args, **kwargs):
+            _tries, _delay = tries, delay
+            _tries += 1  # ensure we call func at least once
+            while _tries > 0:
+                try:
+                    return await func(*args, **kwargs)
+                except exception:
+                    _tries -= 1
+                    if _tries == 0:
+                        raise
+                    await asyncio.sleep(_delay)
+                    _delay *= backoff
+        return wrapper
+
+    return decorator
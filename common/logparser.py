@@ -1,4 +1,10 @@
 import os
+import re
+import gzip
+import time
+import hashlib
+from datetime import date
+from operator import length_hint
 from common.helpers import path_joiner
 from common.config import logs_path
 
@@ -13,89 +19,400 @@ class WrongFormat(Exception):
     pass
 
 
+def offset_path(filename, offset_name='offset'):
+    return path_joiner(logs_path, "%s.%s" % (os.path.basename(filename), offset_name))
+
+
+def read_log_offset(offset_filename):
+    """
+    :return: (inode, offset) stored by LogTail, (None, 0) if there is no valid offset file
+    """
+    try:
+        f = open(offset_filename, "r")
+    except IOError as e:
+        return None, 0
+    try:
+        inode = int(f.readline())
+        offset = int(f.readline())
+    except ValueError as e:
+        return None, 0
+    finally:
+        f.close()
+    return inode, offset
+
+
 class LogTail(object):
-    def __init__(self, filename, offset_name='offset'):
+    """
+    Iterates over new lines (without line breaks) of a log since the stored offset, following
+    rotation to <file>.1. The file is read in binary blocks, offsets are byte positions. The offset file is replaced
+    atomically by commit(), at the end of the log if autocommit is set, or at checkpoints
+    given by position() after downstream flushes
+    """
+
+    def __init__(self, filename, offset_name='offset', autocommit=True, block_size=65536):
         self.filename = filename
-        self.offset_filename = path_joiner(
-            logs_path,
-            "%s.%s" % (os.path.basename(self.filename), offset_name)
-        )
+        self.autocommit = autocommit
+        self.block_size = block_size
+        self.offset_filename = offset_path(self.filename, offset_name)
         self._fh = None
         (self._log_inode, self._log_offset) = self._read_log_offset()
         self._read_rotated_log = False
+        self._pending_commit = None
+        self._buf = b''
+        self._lines = None
+        self._block_iter = None
+        self._line_start = self._log_offset
+        # checkpoint after the last range marked by range_done, None when lines are iterated
+        self._range_position = None
+        self._range_inodes = {}
 
         if self._log_inode != os.stat(self.filename).st_ino or os.stat(self.filename).st_size < self._log_offset:
             if not self._try_open_rotated_log():
                 self._log_offset = 0
 
         if not self._fh:
-            self._fh = open(self.filename, mode="r", encoding='utf8', errors='replace')
-            self._log_inode = os.stat(self.filename).st_ino
+            self._fh = open(self.filename, mode="rb")
+            self._log_inode = os.fstat(self._fh.fileno()).st_ino
         self._fh.seek(self._log_offset)
+        self._line_start = self._log_offset
 
     def __del__(self):
         if self._fh:
             self._fh.close()
 
     def __iter__(self):
-        return self
+        # the generator itself is iterated, so for loops don't pay for a python __next__ call per line
+        if self._lines is None:
+            self._lines = self._read_lines()
+        return self._lines
 
     def _read_log_offset(self):
+        return read_log_offset(self.offset_filename)
+
+    def _store_log_offset(self, inode, offset):
+        temp_filename = "%s.tmp" % self.offset_filename
         try:
-            f = open(self.offset_filename, "r")
-        except IOError as e:
-            return None, 0
-        try:
-            inode = int(f.readline())
-            offset = int(f.readline())
-        except ValueError as e:
-            return None, 0
-        finally:
-            f.close()
-        return inode, offset
-
-    def _write_log_offset(self):
-        try:
-            f = open(self.offset_filename, "w")
-        except IOError as e:
-            logger.info("Unable to write log offset file %s: %s" % (self.offset_filename, e.message))
-            return
-        try:
-            os.fchmod(f.fileno(), 0o600)
-            self._log_offset = self._fh.tell()
-            f.write("%s\n%s\n" % (self._log_inode, self._log_offset))
-        finally:
-            f.close()
+            with open(temp_filename, "w") as f:
+                os.fchmod(f.fileno(), 0o600)
+                f.write("%s\n%s\n" % (inode, offset))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_filename, self.offset_filename)
+        except (IOError, OSError) as e:
+            logger.info("Unable to write log offset file %s: %s" % (self.offset_filename, e))
+
+    def _write_log_offset(self, offset=None):
+        if offset is not None:
+            self._log_offset = offset
+        self._store_log_offset(self._log_inode, self._log_offset)
 
     def _try_open_rotated_log(self):
         rotated_filename = "%s.1" % self.filename
         if os.path.exists(rotated_filename) and \
                         self._log_inode == os.stat(rotated_filename).st_ino:
-            self._fh = open(rotated_filename, mode="r", encoding='utf8', errors='replace')
+            self._fh = open(rotated_filename, mode="rb")
             self._read_rotated_log = True
             return True
         return False
 
+    def _open_current_log(self):
+        self._fh.close()
+        self._read_rotated_log = False
+        self._fh = open(self.filename, mode="rb")
+        self._log_inode = os.fstat(self._fh.fileno()).st_ino
+        self._log_offset = 0
+        self._line_start = 0
+        self._buf = b''
+
+    @staticmethod
+    def _last_line_end(filename, start, end, block_size=65536):
+        """
+        Finds the position right after the last complete line in [start, end)
+        :return: byte offset, start if there is no complete line
+        """
+        with open(filename, mode="rb") as f:
+            pos = end
+            while pos > start:
+                block_start = max(start, pos - block_size)
+                f.seek(block_start)
+                block = f.read(pos - block_start)
+                idx = block.rfind(b'\n')
+                if idx != -1:
+                    return block_start + idx + 1
+                pos = block_start
+        return start
+
+    @staticmethod
+    def _split_range(filename, start, end, chunk_size):
+        chunks = []
+        with open(filename, mode="rb") as f:
+            pos = start
+            while pos < end:
+                if pos + chunk_size >= end:
+                    chunks.append((filename, pos, end))
+                    break
+                f.seek(pos + chunk_size)
+                f.readline()
+                next_pos = min(f.tell(), end)
+                chunks.append((filename, pos, next_pos))
+                pos = next_pos
+        return chunks
+
+    def ranges(self, chunk_size=8 * 1024 * 1024):
+        """
+        Splits the unread part of the log into line-aligned byte ranges.
+        Nothing is committed until commit() is called, position() gives the checkpoint
+        after the last range passed to range_done
+        :param chunk_size: approximate size of a range in bytes
+        :return: list of (filename, start, end) tuples in log order
+        """
+        chunks = []
+        self._range_inodes = {}
+        if self._read_rotated_log:
+            rotated_filename = self._fh.name
+            self._range_inodes[rotated_filename] = os.fstat(self._fh.fileno()).st_ino
+            chunks.extend(self._split_range(
+                rotated_filename, self._log_offset, os.stat(rotated_filename).st_size, chunk_size
+            ))
+            start = 0
+        else:
+            start = self._log_offset
+        inode = os.stat(self.filename).st_ino
+        self._range_inodes[self.filename] = inode
+        end = self._last_line_end(self.filename, start, os.stat(self.filename).st_size)
+        chunks.extend(self._split_range(self.filename, start, end, chunk_size))
+        self._pending_commit = (inode, end)
+        self._range_position = (self._log_inode, self._log_offset)
+        return chunks
+
+    def range_done(self, chunk):
+        """
+        Marks a range from ranges() as handed downstream, ranges are marked in log order
+        :param chunk: (filename, start, end) tuple
+        """
+        self._range_position = (self._range_inodes[chunk[0]], chunk[2])
+
+    def position(self):
+        """
+        :return: (inode, offset) checkpoint after the last returned line, it is taken when every
+            returned line is written downstream. After ranges() it is the end of the last range
+            marked by range_done
+        """
+        if self._range_position is not None:
+            return self._range_position
+        if self._block_iter is None:
+            return self._log_inode, self._line_start
+        # lines are counted only here, so iteration itself stays in C
+        returned = self._block_count - length_hint(self._block_iter)
+        if returned >= self._block_count:
+            return self._log_inode, self._log_offset
+        rest = self._block_raw.split(b'\n', returned)[-1]
+        return self._log_inode, self._block_start + len(self._block_raw) - len(rest)
+
+    def commit(self, position=None):
+        """
+        Stores the offset: given checkpoint, reached by the last ranges() call or by iteration
+        :param position: (inode, offset) from position()
+        """
+        if position is not None:
+            self._store_log_offset(*position)
+            return
+        if self._pending_commit is None:
+            self._write_log_offset()
+            return
+        inode, offset = self._pending_commit
+        self._pending_commit = None
+        self._range_position = None
+        if self._read_rotated_log:
+            self._open_current_log()
+        self._log_inode = inode
+        self._fh.seek(offset)
+        self._buf = b''
+        self._lines = None
+        self._block_iter = None
+        self._line_start = offset
+        self._write_log_offset(offset)
+
     def __next__(self):
-        line = self._fh.readline()
-        if not line:
+        if self._lines is None:
+            self._lines = self._read_lines()
+        return next(self._lines)
+
+    def _start_block(self, raw, lines):
+        self._block_start = self._log_offset
+        self._block_raw = raw
+        self._block_count = len(lines)
+        self._block_iter = iter(lines)
+        return self._block_iter
+
+    def _read_lines(self):
+        while True:
+            data = self._fh.read(self.block_size)
+            if data:
+                data = self._buf + data
+                end = data.rfind(b'\n') + 1
+                self._buf = data[end:]
+                if not end:
+                    continue
+                raw = data[:end - 1]
+                lines = raw.decode('utf8', errors='replace').split('\n')
+                block = self._start_block(raw, lines)
+                self._log_offset += end
+                yield from block
+                continue
+
             if self._read_rotated_log:
-                self._fh.close()
-                self._read_rotated_log = False
-                self._fh = open(self.filename, mode="r", encoding='utf8', errors='replace')
-                self._log_offset = 0
-                self._log_inode = os.stat(self.filename).st_ino
-                line = self._fh.readline()
-                if not line:
-                    self._write_log_offset()
-                    raise StopIteration()
-            else:
+                # rotated file is complete, its last line may have no line break
+                if self._buf:
+                    raw = self._buf
+                    self._buf = b''
+                    block = self._start_block(raw, [raw.decode('utf8', errors='replace')])
+                    self._log_offset += len(raw)
+                    yield from block
+                self._block_iter = None
+                self._open_current_log()
+                continue
+
+            # incomplete last line of the current file is left for the next run,
+            # iterating again continues from here
+            self._lines = None
+            self._block_iter = None
+            self._line_start = self._log_offset
+            self._fh.seek(self._log_offset)
+            self._buf = b''
+            if self.autocommit:
                 self._write_log_offset()
-                raise StopIteration()
+            return
+
+    def rotated(self):
+        """
+        :return: True if log file was replaced by a new one after the current file was opened
+            or truncated in place (copytruncate), then it is shorter than the read part
+        """
+        try:
+            stat = os.stat(self.filename)
+        except FileNotFoundError:
+            return False
+        return stat.st_ino != self._log_inode or stat.st_size < self._log_offset
 
-        return line
+    def follow_rotation(self):
+        """
+        Treats the open file as the rotated one: next iteration reads the rest of it
+        and continues with the new log file from the beginning. A truncated file has no rest,
+        it is read again from the beginning
+        """
+        self._read_rotated_log = True
+        self._lines = None
 
     def skip_rest(self):
-        self._fh.seek(-1, 2)
-        self._fh.readline()
-        self._write_log_offset()
+        self._fh.seek(0, 2)
+        self._buf = b''
+        self._lines = None
+        self._block_iter = None
+        self._write_log_offset(self._fh.tell())
+        self._line_start = self._log_offset
+
+
+def rotated_logs(filename, since=None, until=None):
+    """
+    Finds rotated copies of a log: <file>.1, <file>.2.gz and so on
+    :param since: datetime.date, files last modified before it are skipped
+    :param until: datetime.date, files last modified after it are skipped
+    :return: paths, oldest rotation first
+    """
+    directory = os.path.dirname(filename) or '.'
+    pattern = re.compile(r'^%s\.(\d+)(\.gz)?$' % re.escape(os.path.basename(filename)))
+    found = []
+    for name in os.listdir(directory):
+        match = pattern.match(name)
+        if match is None:
+            continue
+        path = os.path.join(directory, name)
+        modified = date.fromtimestamp(os.stat(path).st_mtime)
+        if (since is not None and modified < since) or (until is not None and modified > until):
+            continue
+        found.append((int(match.group(1)), path))
+    return [path for _, path in sorted(found, reverse=True)]
+
+
+def open_log(path):
+    """Opens a plain or gzip compressed log for binary reading, gzip is decompressed while reading"""
+    if path.endswith('.gz'):
+        return gzip.open(path, mode="rb")
+    return open(path, mode="rb")
+
+
+def read_log_lines(path, block_size=1024 * 1024):
+    """
+    Iterates over all lines (without line breaks) of a complete log file, plain or gzip compressed
+    """
+    with open_log(path) as f:
+        buf = b''
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            data = buf + data
+            end = data.rfind(b'\n') + 1
+            buf = data[end:]
+            if end:
+                yield from data[:end - 1].decode('utf8', errors='replace').split('\n')
+        if buf:
+            yield buf.decode('utf8', errors='replace')
+
+
+def tailed_logs(filename, offset_name='offset'):
+    """
+    Files the regular run of LogTail still reads: the log itself and <file>.1 if the stored offset is in it.
+    Their lines before the offset are already sent, the rest is sent by the next run
+    :return: paths
+    """
+    inode, _ = read_log_offset(offset_path(filename, offset_name))
+    paths = [filename]
+    rotated_filename = "%s.1" % filename
+    if inode is not None and os.path.exists(rotated_filename) and os.stat(rotated_filename).st_ino == inode:
+        paths.append(rotated_filename)
+    return paths
+
+
+def log_fingerprint(path, size=65536):
+    """
+    Identifies log content regardless of its name and compression, rotation renames .2.gz to .3.gz
+    :return: hex digest of the first size bytes of uncompressed content
+    """
+    with open_log(path) as f:
+        return hashlib.sha1(f.read(size)).hexdigest()
+
+
+class LogWatcher(object):
+    """Waits for changes of a log file using inotify (inotify_simple package) or by polling"""
+
+    def __init__(self, filename, poll_interval=1.0):
+        self.filename = os.path.basename(filename)
+        self.poll_interval = poll_interval
+        try:
+            from inotify_simple import INotify, flags
+            self._inotify = INotify()
+            self._inotify.add_watch(
+                os.path.dirname(filename) or '.',
+                flags.MODIFY | flags.CREATE | flags.MOVED_TO | flags.MOVED_FROM | flags.CLOSE_WRITE
+            )
+        except (ImportError, OSError) as e:
+            logger.info("inotify is not available, polling %s: %s" % (filename, e))
+            self._inotify = None
+
+    def wait(self, timeout):
+        """
+        Returns after the log (or its rotated file) changes or after timeout seconds
+        """
+        if self._inotify is None:
+            time.sleep(min(timeout, self.poll_interval))
+            return
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            for event in self._inotify.read(timeout=int(remaining * 1000) + 1):
+                if event.name.startswith(self.filename):
+                    return
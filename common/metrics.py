@@ -0,0 +1,156 @@
+import os
+import socket
+from time import perf_counter, time
+from collections import defaultdict
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Metrics(object):
+    """
+    Counters and cumulative stage timings of a process, exported to a Prometheus textfile
+    (node_exporter textfile collector) or to StatsD. Stages are measured by wrapping methods of
+    existing objects, so nothing is measured and nothing is wrapped when metrics are disabled
+    """
+    enabled = True
+    label_names = {'stage_seconds': 'stage', 'stage_calls': 'stage', 'rows_dropped': 'reason'}
+
+    def __init__(self, prefix='clickstream', textfile=None, statsd=None, interval=60):
+        """
+        :param prefix: metric names prefix
+        :param textfile: path to .prom file, replaced atomically on every export
+        :param statsd: (host, port) of StatsD server, counters are sent as deltas since the previous export
+        :param interval: seconds between exports of long running processes
+        """
+        self.prefix = prefix
+        self.interval = interval
+        self.textfile = textfile
+        self.statsd = statsd
+        # (name, label) -> value
+        self.counters = defaultdict(float)
+        self._sent = {}
+        self._socket = None
+
+    def incr(self, name, label=None, value=1):
+        self.counters[(name, label)] += value
+
+    def set(self, name, value, label=None):
+        """Sets a counter to a total kept elsewhere, like ClickHouse.metrics"""
+        self.counters[(name, label)] = value
+
+    def timed(self, stage, func):
+        """
+        :return: func counting its calls and cumulative time as stage
+        """
+        counters = self.counters
+        calls_key = ('stage_calls', stage)
+        seconds_key = ('stage_seconds', stage)
+
+        def wrapper(*args, **kwargs):
+            started = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                counters[seconds_key] += perf_counter() - started
+                counters[calls_key] += 1
+        return wrapper
+
+    def wrap(self, obj, method, stage):
+        """Replaces obj.method by its timed version"""
+        setattr(obj, method, self.timed(stage, getattr(obj, method)))
+
+    def export(self):
+        if self.textfile is not None:
+            self.write_textfile(self.textfile)
+        if self.statsd is not None:
+            self.send_statsd(*self.statsd)
+
+    def write_textfile(self, filename):
+        names = defaultdict(list)
+        for (name, label), value in sorted(self.counters.items(), key=lambda item: (item[0][0], str(item[0][1]))):
+            names[name].append((label, value))
+        lines = []
+        for name, values in names.items():
+            metric = '{0}_{1}_total'.format(self.prefix, name)
+            lines.append('# TYPE {0} counter'.format(metric))
+            label_name = self.label_names.get(name, 'label')
+            for label, value in values:
+                lines.append('{0}{1} {2}'.format(
+                    metric, '' if label is None else '{{{0}="{1}"}}'.format(label_name, label), repr(float(value))
+                ))
+        lines.append('# TYPE {0}_last_export_timestamp_seconds gauge'.format(self.prefix))
+        lines.append('{0}_last_export_timestamp_seconds {1}'.format(self.prefix, time()))
+        temp_filename = '{0}.{1}.tmp'.format(filename, os.getpid())
+        try:
+            with open(temp_filename, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(temp_filename, filename)
+        except (IOError, OSError) as e:
+            logger.warning('Unable to write metrics to {0}: {1}'.format(filename, e))
+
+    def send_statsd(self, host, port):
+        if self._socket is None:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        lines = []
+        for key, value in self.counters.items():
+            delta = value - self._sent.get(key, 0)
+            if not delta:
+                continue
+            self._sent[key] = value
+            name, label = key
+            if name == 'stage_seconds':
+                lines.append('{0}.stage_ms.{1}:{2:.3f}|c'.format(self.prefix, label, delta * 1000))
+            else:
+                lines.append('{0}.{1}{2}:{3:g}|c'.format(
+                    self.prefix, name, '' if label is None else '.' + label, delta
+                ))
+        # packets are kept below common MTU
+        packet = []
+        size = 0
+        for line in lines + [None]:
+            if line is None or size + len(line) > 1400:
+                if packet:
+                    try:
+                        self._socket.sendto('\n'.join(packet).encode('utf-8'), (host, port))
+                    except OSError as e:
+                        logger.warning('Unable to send metrics to statsd {0}:{1}: {2}'.format(host, port, e))
+                packet = []
+                size = 0
+            if line is not None:
+                packet.append(line)
+                size += len(line) + 1
+
+
+class NullMetrics(Metrics):
+    """Disabled metrics, timed and wrap leave functions as they are"""
+    enabled = False
+
+    def incr(self, name, label=None, value=1):
+        pass
+
+    def set(self, name, value, label=None):
+        pass
+
+    def timed(self, stage, func):
+        return func
+
+    def wrap(self, obj, method, stage):
+        pass
+
+    def export(self):
+        pass
+
+
+def from_config(config):
+    """
+    :param config: metrics_config like dictionary
+    :return: Metrics if enabled else NullMetrics
+    """
+    if not config.get('enabled'):
+        return NullMetrics()
+    statsd = config.get('statsd')
+    return Metrics(
+        prefix=config.get('prefix', 'clickstream'), textfile=config.get('textfile'),
+        statsd=tuple(statsd) if statsd else None, interval=config.get('interval', 60)
+    )
@@ -0,0 +1,71 @@
+"""
+Single pass decoder of piwik tracking requests. Gives the same values as
+convert_qs(parse_qs(qs)) but only for requested parameter names, other parameters are not unquoted.
+POST bodies are unescaped only if they have escapes
+"""
+from urllib.parse import urlparse, parse_qs, unquote
+
+_unsafe_url_chars = ('\t', '\r', '\n')
+
+
+def split_url(url):
+    """
+    :param url: url from request line
+    :return: (path, query) as urlparse gives them
+    """
+    if url[:1] == '/' and url[1:2] != '/' and not any(c in url for c in _unsafe_url_chars):
+        path, _, query = url.partition('#')[0].partition('?')
+        if ';' not in path:
+            return path, query
+    parsed_url = urlparse(url)
+    return parsed_url.path, parsed_url.query
+
+
+def decode_query(qs, keys):
+    """
+    :param qs: query string without leading ?
+    :param keys: set of parameter names to decode, names must not need unquoting
+    :return: {name: value}, list of values for repeated parameters, blank values are skipped like parse_qs does
+    """
+    if not isinstance(qs, str):
+        return {k: v if len(v) > 1 else v[0] for k, v in parse_qs(qs).items() if k in keys}
+    result = {}
+    repeated = None
+    for field in qs.split('&'):
+        name, _, value = field.partition('=')
+        if not value:
+            continue
+        if name not in keys:
+            if '%' not in name and '+' not in name:
+                continue
+            name = unquote(name.replace('+', ' '))
+            if name not in keys:
+                continue
+        if '+' in value:
+            value = value.replace('+', ' ')
+        if '%' in value:
+            value = unquote(value)
+        if name in result:
+            if repeated is None:
+                repeated = set()
+            if name in repeated:
+                result[name].append(value)
+            else:
+                repeated.add(name)
+                result[name] = [result[name], value]
+        else:
+            result[name] = value
+    return result
+
+
+def unescape_body(body):
+    """
+    The same as bytes(body, 'utf-8').decode('unicode_escape'), bodies without backslashes are not re-decoded
+    :param body: request body string
+    """
+    if '\\' in body:
+        return bytes(body, 'utf-8').decode('unicode_escape')
+    if body.isascii():
+        return body
+    # unicode_escape decodes bytes other than escapes as latin-1
+    return body.encode('utf-8').decode('latin-1')
@@ -0,0 +1,52 @@
+import re
+from datetime import datetime
+import dateutil.parser
+
+# nginx $time_iso8601, e.g. 2018-05-14T12:30:15+03:00
+iso8601_format = re.compile(r'\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(?:[+-]\d\d:?\d\d|Z)?$')
+
+
+class TimeConverter(object):
+    """
+    Converts log timestamps to '%Y-%m-%d %H:%M:%S' strings.
+    Consecutive log lines share seconds, so last results are cached
+    """
+
+    def __init__(self, time_str='%Y-%m-%d %H:%M:%S', cache_size=100000):
+        self.time_str = time_str
+        self.cache_size = cache_size
+        self._iso_key = None
+        self._iso_value = None
+        self._timestamps = {}
+
+    def iso(self, s):
+        """
+        Converts nginx $time_iso8601 keeping local wall time like dateutil.parser does
+        :param s: time string
+        :return: formatted time string
+        """
+        if s == self._iso_key:
+            return self._iso_value
+        if isinstance(s, str) and self.time_str == '%Y-%m-%d %H:%M:%S' and iso8601_format.match(s):
+            value = s[:10] + ' ' + s[11:19]
+        else:
+            value = dateutil.parser.parse(s).strftime(self.time_str)
+        self._iso_key = s
+        self._iso_value = value
+        return value
+
+    def timestamp(self, tm):
+        """
+        Converts unix timestamp to local time string
+        :param tm: integer timestamp
+        :return: formatted time string
+        """
+        try:
+            return self._timestamps[tm]
+        except KeyError:
+            pass
+        value = datetime.fromtimestamp(tm).strftime(self.time_str)
+        if len(self._timestamps) >= self.cache_size:
+            self._timestamps.clear()
+        self._timestamps[tm] = value
+        return value
@@ -1,15 +1,24 @@
 from common.helpers import path_joiner, path_basename, encode
-from common.config import working_path, logs_path
-from common.logparser import LogTail
+from common.config import working_path, logs_path, metrics_config
+from common.logparser import LogTail, LogWatcher, rotated_logs, read_log_lines, log_fingerprint, tailed_logs
 from common.db import ClickHouse
-from urllib.parse import urlparse, parse_qs
+from common.cache import LRUCache
+from common.metrics import NullMetrics, from_config
+from common.timeparse import TimeConverter
+from common.querystring import split_url, decode_query, unescape_body
+from urllib.parse import urlparse
 import rapidjson
 import codecs
+import io
+import os
 import re
 import fasteners
-import httpagentparser
+import signal
+import threading
+from time import monotonic
 from datetime import datetime
-import dateutil.parser
+import httpagentparser
+from concurrent.futures import ProcessPoolExecutor
 
 import logging
 logger = logging.getLogger('parse_nginx_logs')
@@ -19,7 +28,19 @@ lock_name = path_joiner(working_path, path_basename(__file__) + '.lock')
 
 
 class Clickstream:
-    def __init__(self):
+    def __init__(self, ua_cache_size=50000, ua_cache_file=None, columnar_batch=0, metrics=None):
+        """
+        :param ua_cache_size: number of user agents kept in memoized classification cache
+        :param ua_cache_file: json file to keep the cache between runs, not persisted if None.
+            Worker processes return entries they learn and their hits and misses with every chunk or file,
+            so the file and stats of the parent process include them
+        :param columnar_batch: number of records converted at once by convert_batch, 0 converts row by row
+        :param metrics: common.metrics.Metrics, stages are timed only if it is enabled
+        """
+        self.columnar_batch = columnar_batch
+        # stages called through instance attributes, so metrics can replace them by timed versions
+        self.json_loads = rapidjson.loads
+        self.parse_query = decode_query
         self.custom_keys = (
             'page_type', 'page_id', 'page_section', 'page_tags', 'event_name',
             'event_value', 'event_category', 'event_label', 'mvt.name', 'mvt.value'
@@ -30,6 +51,13 @@ class Clickstream:
         }
         self.time_str = '%Y-%m-%d %H:%M:%S'
         self.date_str = '%Y-%m-%d'
+        self.time_converter = TimeConverter(self.time_str)
+        # tracking request parameters read by convert_row, the rest are not decoded
+        self.query_keys = frozenset((
+            'url', '_id', '_ref', 'gt_ms', '_idts', '_viewts', '_idvc', '_idn', 'urlref', '_refts', 'res',
+            'pv_id', 'dimension1', 'dimension2', 'cvar', 'action_name', 'ping', 'link', 'download',
+            'e_c', 'e_n', 'e_v', 'e_a', 'c_n', 'c_p'
+        ))
         # определяются на уровне JS piwik
         self.columns = [
             'event_time', 'site', 'is_mobile', 'url', 'action_name', 'pageview_id',
@@ -43,6 +71,20 @@ class Clickstream:
             'event_category', 'event_name', 'event_value', 'event_label',
             'mvt.name', 'mvt.value'
         ]
+        # clickstream table column types, read by table_types for binary output formats
+        self.column_types = None
+        self.ua_cache = LRUCache(ua_cache_size)
+        self.ua_cache_file = ua_cache_file
+        # (user agent, fields) classified since the last ua_cache_delta, collected by worker processes only
+        self.ua_learned = None
+        if ua_cache_file is not None:
+            self.ua_cache.load(ua_cache_file)
+        self.metrics = NullMetrics() if metrics is None else metrics
+        if self.metrics.enabled:
+            for method, stage in (('parse_line', 'parse_line'), ('json_loads', 'json_decode'),
+                                  ('parse_query', 'query_parse'), ('detect_user_agent', 'user_agent'),
+                                  ('convert_row', 'convert_row'), ('convert_batch', 'convert_batch')):
+                self.metrics.wrap(self, method, stage)
 
     @staticmethod
     def convert_qs(query_string):
@@ -125,6 +167,62 @@ class Clickstream:
         else:
             return url
 
+    def table_types(self, fmt):
+        """
+        :param fmt: output format
+        :return: {column: type} of clickstream table for binary formats, read once, None for text formats
+        """
+        if fmt not in clickhouse.binary_formats:
+            return None
+        if self.column_types is None:
+            self.column_types = clickhouse.column_types('clickstream_table_name', self.columns)
+        return self.column_types
+
+    def detect_user_agent(self, ua):
+        """
+        Classifies user agent, results are memoized by raw string
+        :param ua: user agent string
+        :return: (browser name, browser version, os name, os version, is mobile, is pc, is bot)
+        """
+        fields = self.ua_cache.get(ua)
+        if fields is None:
+            user_agent = httpagentparser.detect(ua)
+            os_name = self.str2none(user_agent['platform']['name'])
+            is_mobile = self.user_is_mobile(os_name)
+            fields = (
+                self.str2none(user_agent.get('browser', {}).get('name')),
+                self.str2none(user_agent.get('browser', {}).get('version')),
+                os_name,
+                self.str2none(user_agent['platform']['version']),
+                self.var2bool(is_mobile),
+                self.var2bool(not is_mobile),
+                self.var2bool(user_agent.get('bot', False))
+            )
+            self.ua_cache.set(ua, fields)
+            if self.ua_learned is not None:
+                self.ua_learned.append((ua, fields))
+        return fields
+
+    def ua_cache_delta(self):
+        """
+        Takes user agent cache changes of a worker process since the previous call
+        :return: (learned entries, hits, misses) for merge_ua_cache of the parent process
+        """
+        learned, self.ua_learned = self.ua_learned, []
+        hits, misses = self.ua_cache.hits, self.ua_cache.misses
+        self.ua_cache.hits = self.ua_cache.misses = 0
+        return learned, hits, misses
+
+    def merge_ua_cache(self, delta):
+        """
+        :param delta: ua_cache_delta result of a worker process
+        """
+        learned, hits, misses = delta
+        for ua, fields in learned:
+            self.ua_cache.set(ua, fields)
+        self.ua_cache.hits += hits
+        self.ua_cache.misses += misses
+
     def convert_row(self, r):
         """
         Converts access.log parsed row for clickhouse's clickstream table format
@@ -136,7 +234,7 @@ class Clickstream:
         except TypeError:
             parsed_url = ''
         result = dict()
-        result['event_time'] = dateutil.parser.parse(r['time']).strftime(self.time_str)
+        result['event_time'] = self.time_converter.iso(r['time'])
         result['site'], result['is_mobile'] = self.get_site(parsed_url)
         result['piwik_id'] = r['query_dict'].get('_id')
         result['source'] = self.encode_qs(r['query_dict'].get('_ref'))
@@ -156,18 +254,12 @@ class Clickstream:
         result['referrer'] = self.encode_qs(r['query_dict'].get('urlref'))
         result['referrer_time'] = r['query_dict'].get('_refts')
         result['user_ip'] = r.get('ip', '')
-        user_agent = httpagentparser.detect(r['user_agent'])
-        result['user_browser_name'] = self.str2none(user_agent.get('browser', {}).get('name'))
-        result['user_browser_version'] = self.str2none(user_agent.get('browser', {}).get('version'))
+        (result['user_browser_name'], result['user_browser_version'], result['user_os_name'],
+         result['user_os_version'], result['user_is_mobile'], result['user_is_pc'],
+         result['user_is_bot']) = self.detect_user_agent(r['user_agent'])
         result['user_browser_resolution'] = r['query_dict'].get('res')
-        result['user_os_name'] = self.str2none(user_agent['platform']['name'])
-        result['user_os_version'] = self.str2none(user_agent['platform']['version'])
-        is_mobile = self.user_is_mobile(result['user_os_name'])
-        result['user_is_mobile'] = self.var2bool(is_mobile)
-        result['user_is_pc'] = self.var2bool(not is_mobile)
         result['user_is_tablet'] = 0
         result['user_is_touch'] = 0
-        result['user_is_bot'] = self.var2bool(user_agent.get('bot', False))
         result['user_device_brand'] = None
         result['user_device_model'] = None
         result['pageview_id'] = r['query_dict'].get('pv_id')
@@ -238,9 +330,7 @@ class Clickstream:
         for k in ('first_visit_time', 'last_visit_time', 'referrer_time'):
             try:
                 tm = int(result[k]) if result[k] is not None else 0
-                result[k] = datetime.fromtimestamp(
-                    tm
-                ).strftime(self.time_str) if tm > 0 else None
+                result[k] = self.time_converter.timestamp(tm) if tm > 0 else None
             except ValueError:
                 result[k] = None
         # defines all unused variables as None
@@ -255,80 +345,619 @@ class Clickstream:
             result[k] = self.null_chars['common'] if v in ('undefined', 'null') or v is None else result[k]
         return result
 
-    @fasteners.interprocess_locked(lock_name)
-    def main(self):
-        clickstream_file = path_joiner(working_path, 'clickstream3.csv')
-        log_path = path_joiner(logs_path, 'piwik_access.log')
+    # convert_row fields assigned before custom variables, so a custom variable with the same name replaces them
+    cvar_overridable = (
+        'event_time', 'site', 'is_mobile', 'piwik_id', 'source', 'url', 'user_country', 'user_city',
+        'generation_speed', 'first_visit_time', 'last_visit_time', 'visit_count', 'new_visitor', 'referrer',
+        'referrer_time', 'user_ip', 'user_browser_name', 'user_browser_version', 'user_os_name',
+        'user_os_version', 'user_is_mobile', 'user_is_pc', 'user_is_bot', 'user_browser_resolution',
+        'user_is_tablet', 'user_is_touch', 'user_device_brand', 'user_device_model', 'pageview_id',
+        'suid', 'suida'
+    )
 
-        with codecs.open(clickstream_file, mode='w') as cl:
-            log = LogTail(log_path)
-            logger.info('Start parsing')
-            cr = clickhouse.FileWriter(cl, 'clickstream_table_name', self.columns)
+    def custom_vars(self, cvar):
+        """
+        Parses page-level custom variables the way convert_row does
+        :param cvar: json string from cvar parameter
+        :return: dictionary of variables
+        """
+        custom = {}
+        try:
+            for k, v in rapidjson.loads(cvar).values():
+                if k.startswith('mvt'):
+                    try:
+                        custom[k] = [str(itm) for itm in rapidjson.loads(v)]
+                    except ValueError:
+                        custom[k] = self.null_chars['array']
+                else:
+                    custom[k] = self.str2none(v)
+        except ValueError:
+            pass
+        return custom
 
-            for line in log:
+    def convert_batch(self, records):
+        """
+        Columnar version of convert_row, every field is computed for the whole batch at once
+        :param records: dictionaries after rapidjson with query_dict
+        :return: {column: list of values}, values are the same convert_row gives for each record
+        """
+        null = self.null_chars['common']
+        qds = [r['query_dict'] for r in records]
+        columns = dict()
+
+        netlocs = []
+        for qd in qds:
+            try:
+                netlocs.append(urlparse(qd.get('url', '')).netloc)
+            except TypeError:
+                netlocs.append('')
+        sites = [self.get_site(h) for h in netlocs]
+        columns['event_time'] = [self.time_converter.iso(r['time']) for r in records]
+        columns['site'] = [site for site, _ in sites]
+        columns['is_mobile'] = [is_mobile for _, is_mobile in sites]
+        columns['piwik_id'] = [qd.get('_id') for qd in qds]
+        columns['source'] = [self.encode_qs(qd.get('_ref')) for qd in qds]
+        columns['url'] = [self.encode_qs(qd.get('url')) for qd in qds]
+        columns['user_country'] = [r.get('country') for r in records]
+        columns['user_city'] = [r.get('city') for r in records]
+        columns['generation_speed'] = [abs(self.var2int(qd.get('gt_ms', 0), True)) for qd in qds]
+        columns['first_visit_time'] = [qd.get('_idts') for qd in qds]
+        columns['last_visit_time'] = [qd.get('_viewts') for qd in qds]
+        columns['visit_count'] = [self.var2int(qd.get('_idvc', 0), True) for qd in qds]
+        columns['new_visitor'] = [self.var2bool(self.var2int(qd.get('_idn', 1), True)) for qd in qds]
+        columns['referrer'] = [self.encode_qs(qd.get('urlref')) for qd in qds]
+        columns['referrer_time'] = [qd.get('_refts') for qd in qds]
+        columns['user_ip'] = [r.get('ip', '') for r in records]
+        (columns['user_browser_name'], columns['user_browser_version'], columns['user_os_name'],
+         columns['user_os_version'], columns['user_is_mobile'], columns['user_is_pc'],
+         columns['user_is_bot']) = (list(c) for c in zip(*[self.detect_user_agent(r['user_agent']) for r in records]))
+        columns['user_browser_resolution'] = [qd.get('res') for qd in qds]
+        columns['user_is_tablet'] = [0] * len(records)
+        columns['user_is_touch'] = [0] * len(records)
+        columns['user_device_brand'] = [None] * len(records)
+        columns['user_device_model'] = [None] * len(records)
+        columns['pageview_id'] = [qd.get('pv_id') for qd in qds]
+        columns['suid'] = [qd.get('dimension1') for qd in qds]
+        columns['suida'] = [qd.get('dimension2') for qd in qds]
+
+        customs = [self.custom_vars(qd.get('cvar', '{}')) for qd in qds]
+        overridable = set(self.cvar_overridable)
+        for i, custom in enumerate(customs):
+            for k in overridable.intersection(custom):
+                columns[k][i] = custom[k]
+
+        page_ids = []
+        for custom in customs:
+            page_id = custom.get('page_id')
+            try:
+                page_ids.append(int(page_id) if page_id != '0' and page_id is not None else None)
+            except ValueError:
+                page_ids.append(None)
+        columns['page_id'] = page_ids
+        page_tags = []
+        for custom in customs:
+            tags = custom.get('page_tags')
+            new_tags = []
+            for tag in tags.split(',') if tags is not None else ():
                 try:
-                    data = rapidjson.loads(line)
-                    method, url, http = data['request'].split(' ')
-                except:
-                    logger.warning(line)
-                    continue
+                    t = int(tag)
+                    if t != 0:
+                        new_tags.append(t)
+                except ValueError:
+                    pass
+            page_tags.append(new_tags if len(new_tags) > 0 else self.null_chars['array'])
+        columns['page_tags'] = page_tags
+        columns['action_name'] = [qd.get('action_name') for qd in qds]
+        columns['ping'] = [self.var2int(qd.get('ping', 0), True) for qd in qds]
+        columns['link'] = [
+            qd['link'] if 'link' in qd else qd['download'] if 'download' in qd else None for qd in qds
+        ]
+        event_category = [qd.get('e_c') for qd in qds]
+        event_name = [qd.get('e_n') for qd in qds]
+        event_value = [qd.get('e_v') for qd in qds]
+        event_label = [qd.get('e_a') for qd in qds]
+        pageview_id = columns['pageview_id']
+        for i, qd in enumerate(qds):
+            if event_category[i] == 'auto-click':
+                pageview_id[i] = event_value[i]
+                event_value[i] = 'click'
+            if 'c_n' in qd or 'c_p' in qd:
+                event_category[i] = 'auto-view'
+                event_label[i] = qd.get('c_n')
+                event_name[i] = qd.get('c_p')
+                event_value[i] = 'view'
+        columns['event_category'] = event_category
+        columns['event_name'] = event_name
+        columns['event_value'] = event_value
+        columns['event_label'] = event_label
+        for k in ('first_visit_time', 'last_visit_time', 'referrer_time'):
+            values = []
+            for v in columns[k]:
+                try:
+                    tm = int(v) if v is not None else 0
+                    values.append(self.time_converter.timestamp(tm) if tm > 0 else None)
+                except ValueError:
+                    values.append(None)
+            columns[k] = values
+        for k in ('page_type', 'page_section'):
+            columns[k] = [custom.get(k) for custom in customs]
+        for k in ('mvt.name', 'mvt.value'):
+            columns[k] = [custom.get(k, self.null_chars['array']) for custom in customs]
+        for k, values in columns.items():
+            columns[k] = [null if v is None or v in ('undefined', 'null') else v for v in values]
+        return columns
 
-                parsed_url = urlparse(url)
-                if parsed_url.path != '/piwik':
-                    continue
-                if method == 'GET':
-                    qs = parse_qs(parsed_url.query)
-                    data['query_dict'] = self.convert_qs(qs)
+    def write_row(self, res, cr):
+        """
+        Writes converted row, rows the writer fails on are skipped, rows with values that don't fit
+        column types of a binary format too. A failed insert of an earlier batch stops parsing
+        """
+        try:
+            cr.write_row(res)
+        except ClickHouse.SendError:
+            raise
+        except ClickHouse.EncodeError as e:
+            logger.warning(e)
+            self.metrics.incr('rows_dropped', 'encode_error')
+        except Exception as e:
+            logger.warning(e)
+            self.metrics.incr('rows_dropped', 'write_error')
+
+    def write_batch(self, records, cr):
+        """
+        Converts records by convert_batch and writes them as columns. If the batch can't be converted
+        or written it is converted and written row by row, records convert_row fails on
+        and rows the writer fails on are skipped
+        :param records: dictionaries after rapidjson with query_dict
+        :param cr: writer with write_columns method
+        """
+        try:
+            columns = self.convert_batch(records)
+        except Exception:
+            columns = None
+        if columns is not None:
+            try:
+                cr.write_columns(columns, len(records))
+                return
+            except ClickHouse.EncodeError:
+                # nothing of the batch is written, rows are written one by one to drop only bad ones
+                pass
+        # records can come from several lines, the batch goes to one insert like write_columns does
+        cr.hold()
+        try:
+            for data in records:
+                try:
                     res = self.convert_row(data)
-                    try:
-                        cr.write_row(res)
-                    except Exception as e:
-                        logger.warning(e)
-                elif method == 'POST':
-                    post_data = bytes(data['body'], 'utf-8').decode('unicode_escape')
+                except Exception as e:
+                    logger.warning(e)
+                    self.metrics.incr('rows_dropped', 'convert_error')
+                    continue
+                self.write_row(res, cr)
+        finally:
+            cr.release()
+
+    def parse_lines(self, lines, cr):
+        """
+        Parses access.log lines, by batches of columnar_batch records if it is set
+        :param lines: iterable of raw json lines
+        :param cr: writer with write_row and write_columns methods
+        """
+        if not self.columnar_batch:
+            for line in lines:
+                self.parse_line(line, cr)
+            return
+        records = []
+        for line in lines:
+            self.parse_line(line, cr, records)
+            if len(records) >= self.columnar_batch:
+                self.write_batch(records, cr)
+                records = []
+        if records:
+            self.write_batch(records, cr)
 
+    def parse_line(self, line, cr, records=None):
+        """
+        Parses one access.log line and writes converted rows
+        :param line: raw json line from piwik_access.log
+        :param cr: writer with write_row, hold and release methods
+        :param records: list to collect parsed records for convert_batch instead of writing rows
+        """
+        try:
+            data = self.json_loads(line)
+            method, url, http = data['request'].split(' ')
+        except:
+            logger.warning(line)
+            self.metrics.incr('rows_dropped', 'bad_line')
+            return
+
+        path, query = split_url(url)
+        if path != '/piwik':
+            self.metrics.incr('rows_dropped', 'not_tracker')
+            return
+        if method == 'GET':
+            data['query_dict'] = self.parse_query(query, self.query_keys)
+            if records is not None:
+                records.append(data)
+                return
+            try:
+                res = self.convert_row(data)
+            except Exception as e:
+                logger.warning(e)
+                self.metrics.incr('rows_dropped', 'convert_error')
+                return
+            self.write_row(res, cr)
+        elif method == 'POST':
+            post_data = unescape_body(data['body'])
+
+            try:
+                body = self.json_loads(post_data)
+                if 'requests' in body:
+                    key = 'request'
+                    body[key] = body.pop('requests')
+                else:
+                    key = 'impressions'
                     try:
-                        body = rapidjson.loads(post_data)
-                        if 'requests' in body:
-                            key = 'request'
-                            body[key] = body.pop('requests')
+                        d = self.parse_query(body['request'], self.query_keys)
+                    except TypeError:
+                        self.metrics.incr('rows_dropped', 'bad_request')
+                        return
+
+                if records is not None:
+                    for item in body[key]:
+                        if key == 'impressions':
+                            data['query_dict'] = {**d, **item}
+                        else:
+                            data['query_dict'] = self.parse_query(item[1:], self.query_keys)
+                        records.append(dict(data))
+                    return
+                # rows of a bulk line go to one insert, the checkpoint after the line covers all of them
+                cr.hold()
+                try:
+                    for item in body[key]:
+                        if key == 'impressions':
+                            data['query_dict'] = {**d, **item}
                         else:
-                            key = 'impressions'
-                            try:
-                                qs = parse_qs(body['request'])
-                            except TypeError:
-                                continue
-                            d = self.convert_qs(qs)
-
-                        for item in body[key]:
-                            if key == 'impressions':
-                                data['query_dict'] = dict(d, **item)
-                            else:
-                                qs = parse_qs(item[1:])
-                                data['query_dict'] = self.convert_qs(qs)
-                            try:
-                                res = self.convert_row(data)
-                                try:
-                                    cr.write_row(res)
-                                except Exception as e:
-                                    logger.warning(e)
-                            except ValueError as e:
-                                logger.warning(e)
-                    except (ValueError, KeyError, TypeError):
-                        qs = parse_qs(post_data)
-                        data['query_dict'] = self.convert_qs(qs)
+                            data['query_dict'] = self.parse_query(item[1:], self.query_keys)
                         try:
                             res = self.convert_row(data)
-                            try:
-                                cr.write_row(res)
-                            except ValueError as e:
-                                logger.warning(e)
                         except Exception as e:
                             logger.warning(e)
+                            self.metrics.incr('rows_dropped', 'convert_error')
+                            continue
+                        self.write_row(res, cr)
+                finally:
+                    cr.release()
+            except (ValueError, KeyError, TypeError):
+                data['query_dict'] = self.parse_query(post_data, self.query_keys)
+                if records is not None:
+                    records.append(data)
+                    return
+                try:
+                    res = self.convert_row(data)
+                except Exception as e:
+                    logger.warning(e)
+                    self.metrics.incr('rows_dropped', 'convert_error')
+                    return
+                self.write_row(res, cr)
+
+    def convert_chunk(self, chunk, fmt='TSV'):
+        """
+        Converts a line-aligned byte range of the log to encoded rows
+        :param chunk: (filename, start, end) tuple from LogTail.ranges
+        :param fmt: output format, TSV or RowBinary
+        :return: (TSV string without INSERT header or RowBinary bytes, number of rows)
+        """
+        filename, start, end = chunk
+        with open(filename, mode='rb') as f:
+            f.seek(start)
+            data = f.read(end - start)
+        output = io.BytesIO() if fmt in clickhouse.binary_formats else io.StringIO()
+        cr = clickhouse.FileWriter(
+            output, 'clickstream_table_name', self.columns, header=False, fmt=fmt, types=self.table_types(fmt)
+        )
+        self.parse_lines((line for line in data.decode('utf8', errors='replace').splitlines() if line), cr)
+        cr.flush()
+        return output.getvalue(), cr.rows
+
+    def instrument_writer(self, cr):
+        """Times writing of rows, for StreamWriter it includes waiting for ClickHouse when the sender is behind"""
+        self.metrics.wrap(cr, 'write_row', 'write')
+        self.metrics.wrap(cr, 'write_columns', 'write')
 
-        logger.info('Update tables')
-        clickhouse.import_file(clickstream_file)
+    def export_metrics(self):
+        """Adds ClickHouse upload and user agent cache totals and exports metrics if they are enabled"""
+        if not self.metrics.enabled:
+            return
+        self.metrics.set('stage_seconds', clickhouse.metrics['seconds'], 'clickhouse_upload')
+        self.metrics.set('stage_calls', clickhouse.metrics['requests'], 'clickhouse_upload')
+        self.metrics.set('clickhouse_bytes_sent', clickhouse.metrics['bytes_sent'])
+        self.metrics.set('clickhouse_bytes_raw', clickhouse.metrics['bytes_raw'])
+        self.metrics.set('user_agent_cache_hits', self.ua_cache.hits)
+        self.metrics.set('user_agent_cache_misses', self.ua_cache.misses)
+        self.metrics.export()
+
+    @fasteners.interprocess_locked(lock_name)
+    def main(self, workers=1, chunk_size=8 * 1024 * 1024, staging_file=False,
+             batch_rows=100000, batch_bytes=16 * 1024 * 1024, fmt='TSV'):
+        """
+        :param workers: number of processes converting the log, 1 parses it in place
+        :param chunk_size: approximate size of a log chunk given to a process, bytes
+        :param staging_file: write rows to clickstream3.csv and import it at the end
+            instead of streaming batches to ClickHouse
+        :param batch_rows: streaming batch limit, rows
+        :param batch_bytes: streaming batch limit, bytes
+        :param fmt: format of rows sent to ClickHouse, TSV or RowBinary
+        """
+        log_path = path_joiner(logs_path, 'piwik_access.log')
+        log = LogTail(log_path, autocommit=False)
+        logger.info('Start parsing')
+
+        if staging_file:
+            clickstream_file = path_joiner(working_path, 'clickstream3.csv')
+            is_binary = fmt in clickhouse.binary_formats
+            with codecs.open(clickstream_file, mode='wb' if is_binary else 'w') as cl:
+                cr = clickhouse.FileWriter(
+                    cl, 'clickstream_table_name', self.columns, fmt=fmt, types=self.table_types(fmt)
+                )
+                self.instrument_writer(cr)
+                self._parse_log(log, cr, workers, chunk_size, fmt)
+                cr.flush()
+            log.commit()
+            self.metrics.incr('rows_written', value=cr.rows)
+            self.metrics.incr('bytes_written', value=os.path.getsize(clickstream_file))
+            logger.info('Update tables')
+            if is_binary:
+                clickhouse.import_file(clickstream_file, 'clickstream_table_name', self.columns, fmt=fmt)
+            else:
+                clickhouse.import_file(clickstream_file)
+        else:
+            # log offset is committed after every inserted batch: the last line of the batch
+            # or, with workers, the end of the last log range in it
+            cr = clickhouse.stream_writer(
+                'clickstream_table_name', self.columns, batch_rows=batch_rows, batch_bytes=batch_bytes,
+                fmt=fmt, types=self.table_types(fmt), position=log.position, on_sent=log.commit
+            )
+            self.instrument_writer(cr)
+            self._parse_log(log, cr, workers, chunk_size, fmt)
+            cr.close()
+            log.commit()
+            self.metrics.incr('rows_written', value=cr.rows_sent)
+            self.metrics.incr('bytes_written', value=cr.bytes_sent)
+            self.metrics.incr('rows_dropped', 'rejected', value=cr.rows_rejected)
+            logger.info('Sent {0} rows, {1} bytes of {2}, {3} rows rejected'.format(
+                cr.rows_sent, cr.bytes_sent, fmt, cr.rows_rejected
+            ))
+        logger.info('User agent cache: {0}'.format(self.ua_cache.stats()))
+        if self.ua_cache_file is not None:
+            self.ua_cache.dump(self.ua_cache_file)
+        self.export_metrics()
+
+    @fasteners.interprocess_locked(lock_name)
+    def run_daemon(self, flush_interval=5.0, poll_interval=1.0, batch_rows=100000,
+                   batch_bytes=16 * 1024 * 1024, fmt='TSV', ua_cache_dump_interval=600, retry_interval=1.0):
+        """
+        Follows the log continuously keeping warm state and one ClickHouse writer.
+        Waits for file growth with inotify where available, follows rotation and truncation like LogTail does,
+        sends a batch when it is full or flush_interval seconds after the previous one.
+        Log offset is committed after every inserted batch. Failed inserts are retried with backoff
+        starting at retry_interval seconds, parsing waits for them. Stops on SIGTERM/SIGINT,
+        rows not inserted by then are read again after restart
+        """
+        log_path = path_joiner(logs_path, 'piwik_access.log')
+        log = LogTail(log_path, autocommit=False)
+        watcher = LogWatcher(log_path, poll_interval)
+        cr = clickhouse.stream_writer(
+            'clickstream_table_name', self.columns, batch_rows=batch_rows, batch_bytes=batch_bytes,
+            fmt=fmt, types=self.table_types(fmt), position=log.position, on_sent=log.commit,
+            retry_interval=retry_interval
+        )
+        self.instrument_writer(cr)
+        stop = threading.Event()
+
+        def on_signal(signum, frame):
+            stop.set()
+            cr.stop_retrying()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, on_signal)
+
+        logger.info('Start following {0}'.format(log_path))
+        try:
+            self._follow(log, watcher, cr, stop, flush_interval, ua_cache_dump_interval)
+            cr.close()
+        except ClickHouse.SendError as e:
+            if not stop.is_set():
+                raise
+            logger.warning('Stopped before rows were inserted, they are read again after restart: {0}'.format(e))
+        else:
+            log.commit(log.position())
+        logger.info('Stopped')
+        if self.ua_cache_file is not None:
+            self.ua_cache.dump(self.ua_cache_file)
+        self.metrics.set('rows_written', cr.rows_sent)
+        self.metrics.set('bytes_written', cr.bytes_sent)
+        self.metrics.set('rows_dropped', cr.rows_rejected, 'rejected')
+        self.export_metrics()
+
+    def _follow(self, log, watcher, cr, stop, flush_interval, ua_cache_dump_interval):
+        last_flush = last_dump = last_export = monotonic()
+        while not stop.is_set():
+            for line in log:
+                self.parse_line(line, cr)
+                if monotonic() - last_flush >= flush_interval:
+                    cr.flush()
+                    last_flush = monotonic()
+                # checked after the line is written, position() points right after it
+                if stop.is_set():
+                    break
+            if stop.is_set():
+                break
+            if log.rotated():
+                log.follow_rotation()
+                continue
+            now = monotonic()
+            if cr.pending_rows and now - last_flush >= flush_interval:
+                cr.flush()
+                last_flush = now
+            if self.ua_cache_file is not None and now - last_dump >= ua_cache_dump_interval:
+                self.ua_cache.dump(self.ua_cache_file)
+                last_dump = now
+            if self.metrics.enabled and now - last_export >= self.metrics.interval:
+                self.metrics.set('rows_written', cr.rows_sent)
+                self.metrics.set('bytes_written', cr.bytes_sent)
+                self.metrics.set('rows_dropped', cr.rows_rejected, 'rejected')
+                self.export_metrics()
+                last_export = now
+            timeout = flush_interval - (now - last_flush) if cr.pending_rows else flush_interval
+            watcher.wait(max(timeout, 0.01))
+        logger.info('Stopping')
+
+    def backfill(self, files, workers=1, batch_rows=100000, batch_bytes=16 * 1024 * 1024, fmt='TSV'):
+        """
+        Reprocesses complete log files, rotated and gzip compressed ones are read as streams.
+        Files are parsed in parallel, every file by its own writer. Batches carry
+        insert_deduplication_token made of file content fingerprint, batch limits, columnar batch size
+        and batch number, so running backfill again with the same options doesn't duplicate rows
+        (ClickHouse deduplicates inserts into Replicated*MergeTree, MergeTree needs non_replicated_deduplication_window).
+        Tokens don't cover rows sent by the regular run, files it still reads (the log and the rotated file
+        its offset is in) are skipped, their copies too. Log offset of the regular run is not touched
+        :param files: log paths
+        :param workers: number of processes, one file per process at a time
+        :raises ValueError: if the table doesn't remember insert tokens
+        """
+        window = clickhouse.deduplication_window('clickstream_table_name')
+        if not window:
+            raise ValueError('Backfill needs insert deduplication, set non_replicated_deduplication_window '
+                             'of clickstream_table_name')
+        tailed = {log_fingerprint(path) for path in tailed_logs(path_joiner(logs_path, 'piwik_access.log'))
+                  if os.path.exists(path)}
+        tasks = []
+        for path in files:
+            if log_fingerprint(path) in tailed:
+                logger.warning('{0} is read by the regular run, skipped'.format(path))
+                continue
+            tasks.append((path, batch_rows, batch_bytes, fmt))
+        logger.info('Backfill {0} files'.format(len(tasks)))
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(self.ua_cache.maxsize, self.ua_cache_file,
+                                               self.columnar_batch, self.table_types(fmt))) as executor:
+                results = []
+                for path, rows, size, ua_delta in executor.map(_backfill_file, tasks):
+                    self.merge_ua_cache(ua_delta)
+                    results.append((path, rows, size))
+        else:
+            results = [self.backfill_file(*task) for task in tasks]
+        for path, rows, size in results:
+            logger.info('{0}: sent {1} rows, {2} bytes'.format(path, rows, size))
+        if self.ua_cache_file is not None:
+            self.ua_cache.dump(self.ua_cache_file)
+        self.metrics.incr('rows_written', value=sum(rows for _, rows, _ in results))
+        self.metrics.incr('bytes_written', value=sum(size for _, _, size in results))
+        self.export_metrics()
+        return results
+
+    def backfill_file(self, path, batch_rows=100000, batch_bytes=16 * 1024 * 1024, fmt='TSV'):
+        """
+        :return: (path, rows, bytes) sent to ClickHouse
+        """
+        # everything batch boundaries depend on, a rerun with other limits must not reuse tokens of other rows
+        token = '{0}-{1}-{2}-{3}-{4}'.format(
+            log_fingerprint(path), fmt, batch_rows, batch_bytes, self.columnar_batch
+        )
+        cr = clickhouse.stream_writer(
+            'clickstream_table_name', self.columns, batch_rows=batch_rows, batch_bytes=batch_bytes,
+            fmt=fmt, types=self.table_types(fmt), dedup_token=token
+        )
+        self.instrument_writer(cr)
+        self.parse_lines(read_log_lines(path), cr)
+        cr.close()
+        if cr.rows_rejected:
+            logger.warning('{0}: {1} rows rejected by ClickHouse'.format(path, cr.rows_rejected))
+        return path, cr.rows_sent, cr.bytes_sent
+
+    def _parse_log(self, log, cr, workers, chunk_size, fmt):
+        if workers > 1:
+            chunks = log.ranges(chunk_size)
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(self.ua_cache.maxsize, self.ua_cache_file,
+                                               self.columnar_batch, self.table_types(fmt))) as executor:
+                # map keeps chunks order, any failed chunk raises here before commit
+                results = executor.map(_convert_chunk, [(chunk, fmt) for chunk in chunks])
+                for chunk, (data, rows, ua_delta) in zip(chunks, results):
+                    # marked before write, a batch closed by this write includes the chunk
+                    log.range_done(chunk)
+                    cr.write(data, rows)
+                    self.merge_ua_cache(ua_delta)
+        else:
+            self.parse_lines(log, cr)
+
+
+_worker_clickstream = None
+
+
+def _init_worker(ua_cache_size, ua_cache_file, columnar_batch=0, column_types=None):
+    global _worker_clickstream
+    # pooled connections are inherited by fork, concurrent inserts of workers must not share them
+    clickhouse.reset_session()
+    _worker_clickstream = Clickstream(ua_cache_size, ua_cache_file, columnar_batch)
+    _worker_clickstream.column_types = column_types
+    _worker_clickstream.ua_learned = []
+
+
+def _convert_chunk(args):
+    return _worker_clickstream.convert_chunk(*args) + (_worker_clickstream.ua_cache_delta(),)
+
+
+def _backfill_file(args):
+    return _worker_clickstream.backfill_file(*args) + (_worker_clickstream.ua_cache_delta(),)
 
 
 if __name__ == '__main__':
-    Clickstream().main()
+    import argparse
+
+    def parse_date(s):
+        return datetime.strptime(s, '%Y-%m-%d').date()
+
+    arg_parser = argparse.ArgumentParser(description='Parses piwik nginx log to ClickHouse')
+    arg_parser.add_argument('--workers', type=int, default=1, help='Number of parsing processes')
+    arg_parser.add_argument('--chunk-size', type=int, default=8 * 1024 * 1024, help='Log chunk size in bytes')
+    arg_parser.add_argument('--staging-file', action='store_true', help='Import rows via clickstream3.csv')
+    arg_parser.add_argument('--batch-rows', type=int, default=100000, help='Streaming batch size in rows')
+    arg_parser.add_argument('--batch-bytes', type=int, default=16 * 1024 * 1024, help='Streaming batch size in bytes')
+    arg_parser.add_argument('--daemon', action='store_true', help='Follow the log continuously instead of cron runs')
+    arg_parser.add_argument('--flush-interval', type=float, default=5.0, help='Daemon: max seconds between inserts')
+    arg_parser.add_argument('--backfill', nargs='*', metavar='FILE',
+                            help='Reprocess given log files, rotated logs if no file is given')
+    arg_parser.add_argument('--since', type=parse_date, help='Backfill: rotated logs modified since YYYY-MM-DD')
+    arg_parser.add_argument('--until', type=parse_date, help='Backfill: rotated logs modified until YYYY-MM-DD')
+    arg_parser.add_argument('--format', default='TSV', choices=('TSV', 'RowBinary'), help='Insert format')
+    arg_parser.add_argument('--columnar-batch', type=int, default=0,
+                            help='Convert records by batches of this size column by column, 0 converts row by row')
+    arg_parser.add_argument('--metrics-textfile', default=None, help='Export metrics to this Prometheus .prom file')
+    arg_parser.add_argument('--statsd', default=None, metavar='HOST:PORT', help='Send metrics to StatsD')
+    arg_parser.add_argument('--ua-cache-size', type=int, default=50000, help='User agent cache size')
+    arg_parser.add_argument('--ua-cache-file', default=None, help='Keep user agent cache in this json file')
+    args = arg_parser.parse_args()
+    if args.metrics_textfile is not None or args.statsd is not None:
+        metrics_config = dict(metrics_config, enabled=True)
+        if args.metrics_textfile is not None:
+            metrics_config['textfile'] = args.metrics_textfile
+        if args.statsd is not None:
+            host, port = args.statsd.rsplit(':', 1)
+            metrics_config['statsd'] = (host, int(port))
+    clickstream = Clickstream(args.ua_cache_size, args.ua_cache_file, args.columnar_batch, from_config(metrics_config))
+    if args.backfill is not None:
+        clickstream.backfill(
+            args.backfill or rotated_logs(path_joiner(logs_path, 'piwik_access.log'), args.since, args.until),
+            workers=args.workers, batch_rows=args.batch_rows, batch_bytes=args.batch_bytes, fmt=args.format
+        )
+    elif args.daemon:
+        clickstream.run_daemon(
+            flush_interval=args.flush_interval, batch_rows=args.batch_rows, batch_bytes=args.batch_bytes,
+            fmt=args.format
+        )
+    else:
+        clickstream.main(
+            workers=args.workers, chunk_size=args.chunk_size, staging_file=args.staging_file,
+            batch_rows=args.batch_rows, batch_bytes=args.batch_bytes, fmt=args.format
+        )
@@ -3,7 +3,10 @@ from flask_restful import Api
 from flask_cors import CORS
 from flask_caching import Cache
 import importlib
-from api import is_debug, flask_jsonify
+import os
+from api import is_debug, flask_jsonify, caches, mongo_client
+from api.indexes import ensure_indexes
+from api.resources.activity import setup as setup_activity
 
 import logging
 logger = logging.getLogger('api')
@@ -50,8 +53,17 @@ def info():
     return flask_jsonify(func_list)
 
 
+@flask_app.route('/api/cache/', methods=['GET'])
+def cache_stats():
+    """Prints size and hit rate of in-process caches"""
+    return flask_jsonify({name: cache.stats() for name, cache in caches.items()})
+
+
 add_endpoint('activity', 'TagViews')
+# run_asgi sets number of worker processes
+setup_activity(workers=int(os.environ.get('API_WORKERS', 1)))
 
 
 if __name__ == '__main__':
+    ensure_indexes(mongo_client.statistics)
     flask_app.run(debug=is_debug, threaded=True)
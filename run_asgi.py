@@ -0,0 +1,37 @@
+"""
+Production serving mode of run_api: the same flask app, endpoints and cookies behind uvicorn.
+Flask views run in a2wsgi's thread pool of --threads threads per worker, so blocking pymongo calls
+of concurrent requests overlap and don't hold the event loop.
+Every uvicorn worker process creates its own db clients on import.
+
+python run_asgi.py --workers 4 --threads 32
+"""
+from a2wsgi import WSGIMiddleware
+from run_api import flask_app
+import os
+
+
+app = WSGIMiddleware(flask_app, workers=int(os.environ.get('API_THREADS', 32)))
+
+
+if __name__ == '__main__':
+    import argparse
+    import uvicorn
+    from api import mongo_client
+    from api.indexes import ensure_indexes
+    from api.response_cache import check_backend
+    from common.config import response_cache_config
+    arg_parser = argparse.ArgumentParser(description='Runs api with uvicorn')
+    arg_parser.add_argument('--host', default='127.0.0.1')
+    arg_parser.add_argument('--port', type=int, default=5000)
+    arg_parser.add_argument('--workers', type=int, default=os.cpu_count())
+    arg_parser.add_argument('--threads', type=int, default=32, help='Threads per worker for flask views')
+    args = arg_parser.parse_args()
+    try:
+        check_backend(response_cache_config, args.workers)
+    except ValueError as e:
+        arg_parser.error(str(e))
+    ensure_indexes(mongo_client.statistics)
+    os.environ['API_THREADS'] = str(args.threads)
+    os.environ['API_WORKERS'] = str(args.workers)
+    uvicorn.run('run_asgi:app', host=args.host, port=args.port, workers=args.workers, log_level='warning')
@@ -0,0 +1,9 @@
+import os
+import sys
+import types
+
+# api/__init__ connects to PostgreSQL and MongoDB on import, modules of api are tested without these connections
+if 'api' not in sys.modules:
+    api = types.ModuleType('api')
+    api.__path__ = [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api')]
+    sys.modules['api'] = api
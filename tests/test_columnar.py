@@ -0,0 +1,33 @@
+import json
+
+import pytest
+
+from benchmarks.bench_columnar import sample_lines, convert
+from parse_nginx_logs import Clickstream
+
+
+def cvar_lines(values=('7', 'abc', 'null', '')):
+    """Lines whose custom variables have names of every column, some of them replace convert_row fields"""
+    lines = []
+    for value in values:
+        # mvt variables are json arrays, a broken one makes the whole batch fall back to convert_row
+        cvar = {str(i): [column, '["a"]' if column.startswith('mvt') else value]
+                for i, column in enumerate(Clickstream().columns)}
+        record = json.loads(sample_lines(1)[0])
+        query = 'idsite=1&rec=1&url=https%3A%2F%2Fexample.com%2F&e_c=x&cvar={0}'.format(
+            json.dumps(cvar).replace(' ', '')
+        )
+        record['request'] = 'GET /piwik?{0} HTTP/1.1'.format(query)
+        lines.append(json.dumps(record))
+    return lines
+
+
+@pytest.mark.parametrize('fmt', ['TSV', 'RowBinary'])
+@pytest.mark.parametrize('columnar_batch', [1, 7, 1000])
+def test_columnar_output_is_row_by_row_output(fmt, columnar_batch):
+    lines = sample_lines(200) + cvar_lines()
+    row_data, row_count, _ = convert(lines, fmt, 0)
+    batch_data, batch_count, _ = convert(lines, fmt, columnar_batch)
+    assert row_count > len(lines) // 2
+    assert batch_count == row_count
+    assert batch_data == row_data
@@ -0,0 +1,333 @@
+import asyncio
+import calendar
+import struct
+import threading
+import time
+from datetime import date, datetime
+
+import pytest
+
+from common.db import ClickHouse, AsyncClickHouse, write_varint
+
+types = {
+    'event_time': "DateTime('Europe/Moscow')", 'visit_time': "Nullable(DateTime('Europe/Moscow'))",
+    'event_date': 'Date', 'site': 'LowCardinality(String)', 'url': 'Nullable(String)',
+    'visit_count': 'UInt32', 'generation_speed': 'Int32', 'score': 'Float64', 'page_tags': 'Array(UInt32)',
+    'mvt.name': 'Array(String)'
+}
+columns = list(types)
+
+
+def row(**values):
+    d = {
+        'event_time': '2018-05-14 12:30:15', 'visit_time': '\\N', 'event_date': '2018-05-14', 'site': 'site_name',
+        'url': 'https://example.com/?a=1', 'visit_count': 3, 'generation_speed': -15, 'score': 0.5,
+        'page_tags': [1, 2], 'mvt.name': ['a', 'б']
+    }
+    d.update(values)
+    return d
+
+
+def with_header(data):
+    """RowBinaryWithNamesAndTypes stream of encoded rows"""
+    header = bytearray()
+    write_varint(len(columns), header)
+    for value in columns + [types[c] for c in columns]:
+        b = value.encode('utf-8')
+        write_varint(len(b), header)
+        header += b
+    return bytes(header) + bytes(data)
+
+
+def chunks(data, size):
+    return (data[i:i + size] for i in range(0, len(data), size))
+
+
+def test_rowbinary_round_trip():
+    encoder = ClickHouse.RowBinaryEncoder(columns, types)
+    buf = bytearray()
+    encoder.encode_row(row(), buf)
+    encoder.encode_row(row(visit_time='2018-05-13 23:59:59', url=None, page_tags=[], site='other'), buf)
+    decoded = list(ClickHouse.RowBinaryReader(chunks(with_header(buf), 7)).rows())
+    assert decoded == [
+        {
+            'event_time': datetime(2018, 5, 14, 12, 30, 15), 'visit_time': None, 'event_date': date(2018, 5, 14),
+            'site': 'site_name', 'url': 'https://example.com/?a=1', 'visit_count': 3, 'generation_speed': -15,
+            'score': 0.5, 'page_tags': [1, 2], 'mvt.name': ['a', 'б']
+        },
+        {
+            'event_time': datetime(2018, 5, 14, 12, 30, 15), 'visit_time': datetime(2018, 5, 13, 23, 59, 59),
+            'event_date': date(2018, 5, 14), 'site': 'other', 'url': None, 'visit_count': 3,
+            'generation_speed': -15, 'score': 0.5, 'page_tags': [], 'mvt.name': ['a', 'б']
+        },
+    ]
+
+
+def test_columns_encode_as_rows():
+    encoder = ClickHouse.RowBinaryEncoder(columns, types)
+    rows = [row(), row(visit_count=4, url='\\N')]
+    by_rows = bytearray()
+    for d in rows:
+        encoder.encode_row(d, by_rows)
+    by_columns = bytearray()
+    assert encoder.encode_columns({c: [d[c] for d in rows] for c in columns}, by_columns) == 2
+    assert by_columns == by_rows
+
+
+@pytest.fixture
+def local_timezone(monkeypatch):
+    """Parser host timezone different from the one of ClickHouse columns"""
+    monkeypatch.setenv('TZ', 'America/New_York')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_datetime_is_packed_in_column_timezone(local_timezone):
+    encoder = ClickHouse.RowBinaryEncoder(['t'], {'t': "DateTime('Europe/Moscow')"})
+    buf = bytearray()
+    encoder.encode_row({'t': '2018-05-14 12:30:15'}, buf)
+    assert struct.unpack('<I', buf)[0] == calendar.timegm((2018, 5, 14, 9, 30, 15))
+
+
+def test_datetime_without_timezone_needs_one():
+    with pytest.raises(ValueError):
+        ClickHouse.RowBinaryEncoder(['t'], {'t': 'DateTime'})
+    encoder = ClickHouse.RowBinaryEncoder(['t'], {'t': 'DateTime'}, timezone='UTC')
+    buf = bytearray()
+    encoder.encode_row({'t': '1970-01-02 00:00:00'}, buf)
+    assert struct.unpack('<I', buf)[0] == 86400
+
+
+@pytest.mark.parametrize('values', [{'visit_count': -1}, {'page_tags': [2 ** 32]}, {'event_time': 'yesterday'}])
+def test_values_out_of_type_raise(values):
+    encoder = ClickHouse.RowBinaryEncoder(columns, types)
+    buf = bytearray(b'kept')
+    with pytest.raises(ClickHouse.EncodeError):
+        encoder.encode_row(row(**values), buf)
+    with pytest.raises(ClickHouse.EncodeError):
+        encoder.encode_columns({c: [v] for c, v in row(**values).items()}, buf)
+    assert buf == b'kept'
+
+
+@pytest.fixture
+def clickhouse(monkeypatch):
+    ch = ClickHouse()
+    monkeypatch.setattr(ch, 'db_config', dict(ch.db_config, timezone=None))
+    queries = []
+
+    def query(q, format_='CSV', **kwargs):
+        queries.append(q)
+        if 'system.tables' in q:
+            return {'data': [{'engine': 'ReplacingMergeTree', 'partition_key': 'toYYYYMM(event_date)',
+                              'sorting_key': 'site, event_time', 'engine_full': ch.engine_full}]}
+        if 'system.merge_tree_settings' in q:
+            return {'data': [{'value': '0'}]}
+        if 'system.columns' in q:
+            return {'data': [{'name': name, 'type': t, 'default_kind': ''} for name, t in (
+                ('event_date', 'Date'), ('event_time', 'DateTime'), ('visit_time', 'Nullable(DateTime)'),
+                ('sent_time', "DateTime('UTC')"), ('site', 'String')
+            )]}
+        if 'timezone()' in q:
+            return {'data': [{'tz': 'Europe/Moscow'}]}
+        if 'system.parts' in q:
+            return {'data': [{'partition': '201805', 'partition_id': '201805', 'parts': '3',
+                              'total_rows': '1000', 'total_bytes': '65536'}]}
+        return ''
+    monkeypatch.setattr(ch, 'query', query)
+    ch.queries = queries
+    ch.engine_full = 'ReplacingMergeTree PARTITION BY toYYYYMM(event_date) ORDER BY (site, event_time)'
+    return ch
+
+
+def test_column_types_come_from_table(clickhouse):
+    assert clickhouse.column_types('db.clicks', ['site', 'event_time', 'visit_time', 'sent_time']) == {
+        'site': 'String', 'event_time': "DateTime('Europe/Moscow')",
+        'visit_time': "Nullable(DateTime('Europe/Moscow'))", 'sent_time': "DateTime('UTC')"
+    }
+    clickhouse.db_config['timezone'] = 'Asia/Yekaterinburg'
+    assert clickhouse.column_types('db.clicks', ['event_time'])['event_time'] == "DateTime('Asia/Yekaterinburg')"
+    with pytest.raises(ValueError):
+        clickhouse.column_types('db.clicks', ['event_time', 'user_ip'])
+
+
+def test_deduplication_window_of_table_settings(clickhouse):
+    assert clickhouse.deduplication_window('db.clicks') == 0
+    assert 'non_replicated_deduplication_window' in clickhouse.queries[-1]
+    clickhouse.engine_full += ' SETTINGS index_granularity = 8192, non_replicated_deduplication_window = 100'
+    assert clickhouse.deduplication_window('db.clicks') == 100
+
+
+def test_changed_partitions_query(clickhouse):
+    assert clickhouse.changed_partitions("db.click's") == [
+        {'partition': '201805', 'partition_id': '201805', 'parts': 3, 'rows': 1000, 'bytes': 65536}
+    ]
+    q = clickhouse.queries[-1]
+    assert "FROM system.parts WHERE database = 'db' AND table = 'click\\'s' AND active" in q
+    assert 'HAVING parts > 1 OR min(level) = 0' in q
+
+
+def optimize_failing_with(clickhouse, monkeypatch, error):
+    query = clickhouse.query
+    settings = []
+
+    def optimize(q, format_='CSV', **kwargs):
+        if q.startswith('OPTIMIZE'):
+            settings.append(kwargs)
+            raise Exception(error)
+        return query(q, format_, **kwargs)
+    monkeypatch.setattr(clickhouse, 'query', optimize)
+    return settings
+
+
+def test_finalize_reports_partitions_optimize_skipped(clickhouse, monkeypatch):
+    settings = optimize_failing_with(
+        clickhouse, monkeypatch, 'Code: 388. DB::Exception: Cannot OPTIMIZE table: (CANNOT_ASSIGN_OPTIMIZE)'
+    )
+    partitions = clickhouse.finalize_partitions('db.clicks')
+    assert settings == [{'optimize_throw_if_noop': 1}]
+    assert [p['skipped'] for p in partitions] == [True]
+
+
+def test_finalize_optimize_errors_are_raised(clickhouse, monkeypatch):
+    optimize_failing_with(clickhouse, monkeypatch, 'Code: 241. DB::Exception: Memory limit exceeded')
+    with pytest.raises(Exception, match='Memory limit'):
+        clickhouse.finalize_partitions('db.clicks')
+
+
+def test_finalize_replace_runs_use_own_tables(clickhouse):
+    for _ in range(2):
+        partitions = clickhouse.finalize_partitions('db.clicks', mode='replace')
+        assert [p['skipped'] for p in partitions] == [False]
+    created = [q.split()[2] for q in clickhouse.queries if q.startswith('CREATE TABLE')]
+    dropped = [q.split()[4] for q in clickhouse.queries if q.startswith('DROP TABLE')]
+    assert len(set(created)) == 2 and dropped == created
+
+
+create_clicks = (
+    'CREATE TABLE db.clicks (site String,  event_date Date) '
+    'ENGINE = ReplacingMergeTree(event_date, (site, event_date), 8192)'
+)
+
+
+def recording_query(queries, create_query):
+    def query(q, format_='CSV', **kwargs):
+        queries.append(q)
+        if q.startswith('SHOW CREATE'):
+            return {'data': [{'statement': create_query}]}
+        return ''
+    return query
+
+
+@pytest.mark.parametrize('create_query', [create_clicks, create_clicks.replace('ReplacingMergeTree', 'MergeTree')])
+def test_finalize_queries_are_shared_by_async_client(monkeypatch, create_query):
+    pytest.importorskip('aiohttp')
+    ch, async_ch = ClickHouse(), AsyncClickHouse()
+    sync_queries, async_queries = [], []
+    monkeypatch.setattr(ch, 'query', recording_query(sync_queries, create_query))
+    query = recording_query(async_queries, create_query)
+
+    async def async_query(q, format_='CSV', **kwargs):
+        return query(q, format_, **kwargs)
+    monkeypatch.setattr(async_ch, 'query', async_query)
+    ch.finalize('db.clicks')
+    asyncio.run(async_ch.finalize('db.clicks'))
+    assert async_queries == sync_queries
+    if 'ReplacingMergeTree' in create_query:
+        assert sync_queries[1].startswith('CREATE TABLE db.clicks_temp ')
+        assert sync_queries[-1] == 'DROP TABLE db.clicks_old'
+    else:
+        assert len(sync_queries) == 1
+
+
+@pytest.mark.parametrize('q, attempts', [
+    ('SELECT 1', 3),
+    ('INSERT INTO db.clicks (site) VALUES', 1),
+])
+def test_async_client_retries_only_idempotent_queries(monkeypatch, q, attempts):
+    aiohttp = pytest.importorskip('aiohttp')
+    posts = []
+
+    async def post_once(self, data=None, file_name=None, output=None, query_type=None, **kwargs):
+        posts.append(data)
+        raise aiohttp.ClientConnectionError('Connection reset by peer')
+    monkeypatch.setattr(AsyncClickHouse, '_post_once', post_once)
+    client = AsyncClickHouse(tries=2, delay=0.01)
+    with pytest.raises(aiohttp.ClientError):
+        asyncio.run(client.query(q))
+    assert len(posts) == attempts
+
+
+class ParsingClient(object):
+    """Rejects inserts with a bad value like ClickHouse does, keeps accepted lines"""
+
+    def __init__(self):
+        self.lines = []
+        self.settings = []
+
+    def _send(self, data, stream=False, **kwargs):
+        self.settings.append(kwargs)
+        body = b''.join(data)
+        if b'abc' in body:
+            raise Exception('Code: 27. DB::Exception: Cannot parse input: expected \\t before: abc')
+        self.lines.extend(body.splitlines())
+
+
+def test_stream_writer_skips_rejected_rows():
+    client = ParsingClient()
+    cr = ClickHouse.StreamWriter(client, 't', ['site', 'visit_count'], batch_rows=10)
+    for i in range(25):
+        cr.write_row({'site': str(i), 'visit_count': 'abc' if i in (3, 17) else str(i)})
+    cr.close()
+    assert (cr.rows_sent, cr.rows_rejected) == (23, 2)
+    assert sorted(int(line.split(b'\t')[0]) for line in client.lines) == [i for i in range(25) if i not in (3, 17)]
+    assert all(s['input_format_allow_errors_ratio'] == ClickHouse.insert_errors_ratio for s in client.settings)
+
+
+def test_stream_writer_stops_on_other_errors():
+    class DownClient(object):
+        def _send(self, data, stream=False, **kwargs):
+            raise Exception('Code: 241. DB::Exception: Memory limit exceeded')
+    cr = ClickHouse.StreamWriter(DownClient(), 't', ['site'], batch_rows=1)
+    cr.write_row({'site': '1'})
+    with pytest.raises(ClickHouse.SendError):
+        cr.close()
+
+
+class DownClient(object):
+    """Fails the first inserts like an unavailable server"""
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.tokens = []
+        self.rows = 0
+
+    def _send(self, data, stream=False, **kwargs):
+        body = b''.join(data)
+        self.tokens.append(kwargs.get('insert_deduplication_token'))
+        if self.failures:
+            self.failures -= 1
+            raise Exception('Connection refused')
+        self.rows += body.count(b'\n')
+
+
+def test_stream_writer_retries_failed_inserts():
+    client = DownClient(failures=3)
+    cr = ClickHouse.StreamWriter(client, 't', ['site'], batch_rows=5, retry_interval=0.01)
+    for i in range(10):
+        cr.write_row({'site': str(i)})
+    cr.close()
+    assert client.rows == 10
+    # every attempt of the first batch has the same token
+    assert len(set(client.tokens[:4])) == 1 and None not in client.tokens
+
+
+def test_stream_writer_stops_retrying():
+    client = DownClient(failures=10 ** 6)
+    cr = ClickHouse.StreamWriter(client, 't', ['site'], batch_rows=1, retry_interval=0.01)
+    cr.write_row({'site': '1'})
+    threading.Timer(0.1, cr.stop_retrying).start()
+    with pytest.raises(ClickHouse.SendError):
+        cr.close()
+    assert client.rows == 0
@@ -0,0 +1,59 @@
+import tracemalloc
+
+import pytest
+
+from benchmarks.bench_import_memory import make_csv
+from benchmarks.clickhouse_stub import ClickHouseStub
+from common.db import ClickHouse
+
+columns = ['event_time', 'site', 'is_mobile', 'url', 'action_name']
+mb = 32
+
+
+@pytest.fixture
+def stub():
+    with ClickHouseStub() as stub:
+        yield stub
+
+
+@pytest.fixture
+def client(stub, monkeypatch):
+    client = ClickHouse(compression=None)
+    monkeypatch.setattr(client, 'url', stub.url)
+    return client
+
+
+@pytest.fixture(scope='module')
+def csv_file(tmp_path_factory):
+    file_name = str(tmp_path_factory.mktemp('import') / 'import.csv')
+    make_csv(file_name, mb)
+    return file_name
+
+
+def peak_memory(func, *args, **kwargs):
+    """Peak of python allocations while func runs, the stub answering in this process included"""
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.mark.parametrize('table', ['test_table', None])
+def test_import_file_is_streamed(client, stub, csv_file, table):
+    if table is None:
+        # the file itself starts with INSERT
+        peak = peak_memory(client.import_file, csv_file)
+    else:
+        peak = peak_memory(client.import_file, csv_file, table, columns)
+    assert stub.bytes_received >= mb * 1024 * 1024 * 0.99
+    assert peak < 8 * 1024 * 1024
+
+
+def test_import_dataframe_is_streamed(client, stub, csv_file):
+    pd = pytest.importorskip('pandas')
+    df = pd.read_csv(csv_file, header=None, names=columns)
+    peak = peak_memory(client.import_dataframe, 'test_table', df, chunk_rows=10000)
+    assert stub.bytes_received >= mb * 1024 * 1024 * 0.99
+    assert peak < 16 * 1024 * 1024
@@ -0,0 +1,71 @@
+import pytest
+
+from api.indexes import check_query_plans, find_shapes, update_shapes, QueryPlanError
+
+
+def explain(stage, rejected_stage='COLLSCAN'):
+    """explain() output of a plan with the scan under FETCH, the other candidate is rejected"""
+    return {
+        'queryPlanner': {
+            'winningPlan': {'stage': 'LIMIT', 'inputStage': {'stage': 'FETCH', 'inputStage': {'stage': stage}}},
+            'rejectedPlans': [{'stage': 'SORT', 'inputStage': {'stage': rejected_stage}}],
+        },
+    }
+
+
+class Cursor(object):
+    def __init__(self, plan):
+        self.plan = plan
+
+    def sort(self, sort):
+        return self
+
+    def limit(self, limit):
+        return self
+
+    def explain(self):
+        return self.plan
+
+
+class Collection(object):
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+
+    def find(self, filter_):
+        return Cursor(self.db.plan(self.name, filter_))
+
+
+class Database(object):
+    """Answers explain of a query shape with a collection scan if its collection and filter keys are listed"""
+
+    def __init__(self, collscans=()):
+        self.collscans = collscans
+
+    def plan(self, collection, filter_):
+        if (collection, tuple(sorted(filter_))) in self.collscans:
+            return explain('COLLSCAN', rejected_stage='IXSCAN')
+        return explain('IXSCAN')
+
+    def __getitem__(self, name):
+        return Collection(self, name)
+
+    def command(self, command, spec, verbosity=None):
+        assert command == 'explain'
+        return self.plan(spec['update'], spec['updates'][0]['q'])
+
+
+def shape(name):
+    collection, filter_ = next((s[1], s[2]) for s in find_shapes + update_shapes if s[0] == name)
+    return collection, tuple(sorted(filter_))
+
+
+def test_collscan_in_rejected_plans_is_ignored():
+    check_query_plans(Database())
+
+
+@pytest.mark.parametrize('names', [['cookies by suid'], ['top views by type', 'remove object']])
+def test_collscan_in_winning_plan_names_query_shapes(names):
+    with pytest.raises(QueryPlanError) as e:
+        check_query_plans(Database([shape(name) for name in names]))
+    assert str(e.value) == 'Collection scan in: {0}'.format(', '.join(names))
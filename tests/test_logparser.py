@@ -0,0 +1,124 @@
+import os
+
+import pytest
+
+import common.logparser
+from common.logparser import LogTail
+
+
+@pytest.fixture
+def log_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(common.logparser, 'logs_path', str(tmp_path))
+    return str(tmp_path / 'piwik_access.log')
+
+
+def write(path, data, mode='ab'):
+    with open(path, mode) as f:
+        f.write(data)
+
+
+def test_incomplete_line_is_left_for_next_run(log_path):
+    write(log_path, b'one\ntwo\nthr')
+    assert list(LogTail(log_path)) == ['one', 'two']
+    write(log_path, b'ee\n')
+    assert list(LogTail(log_path)) == ['three']
+    assert list(LogTail(log_path)) == []
+
+
+def test_position_is_after_returned_line(log_path):
+    lines = [b'one', b'two', b'three', b'', b'four']
+    write(log_path, b'\n'.join(lines) + b'\n')
+    inode = os.stat(log_path).st_ino
+    log = LogTail(log_path, autocommit=False, block_size=5)
+    assert log.position() == (inode, 0)
+    end = 0
+    for line, raw in zip(log, lines):
+        end += len(raw) + 1
+        assert line == raw.decode()
+        assert log.position() == (inode, end)
+
+
+def test_commit_resumes_from_checkpoint(log_path):
+    write(log_path, b'one\ntwo\nthree\n')
+    log = LogTail(log_path, autocommit=False)
+    assert next(log) == 'one'
+    assert next(log) == 'two'
+    log.commit(log.position())
+    # nothing is stored until commit
+    list(log)
+    assert list(LogTail(log_path, autocommit=False)) == ['three']
+
+
+def test_rest_of_rotated_log_is_read_first(log_path):
+    write(log_path, b'one\ntwo\n')
+    log = LogTail(log_path, autocommit=False)
+    next(log)
+    log.commit(log.position())
+    write(log_path, b'three\n')
+    os.rename(log_path, log_path + '.1')
+    write(log_path, b'four\n')
+    assert list(LogTail(log_path)) == ['two', 'three', 'four']
+    assert list(LogTail(log_path)) == []
+
+
+def test_ranges_cover_unread_lines(log_path):
+    lines = [('line %d' % i).encode() for i in range(100)]
+    write(log_path, b'\n'.join(lines) + b'\npartial')
+    log = LogTail(log_path, autocommit=False)
+    next(log)
+    log.commit(log.position())
+    log = LogTail(log_path, autocommit=False)
+    inode = os.stat(log_path).st_ino
+    chunks = log.ranges(chunk_size=64)
+    assert len(chunks) > 1
+    data = b''
+    with open(log_path, 'rb') as f:
+        for chunk in chunks:
+            filename, start, end = chunk
+            assert start == len(lines[0]) + 1 + len(data)
+            f.seek(start)
+            data += f.read(end - start)
+            log.range_done(chunk)
+            assert log.position() == (inode, end)
+    assert data == b'\n'.join(lines[1:]) + b'\n'
+    log.commit()
+    write(log_path, b'\n')
+    assert list(LogTail(log_path)) == ['partial']
+
+
+def test_follow_rotation_reads_rest_of_old_file(log_path):
+    write(log_path, b'one\n')
+    log = LogTail(log_path, autocommit=False)
+    assert list(log) == ['one']
+    assert not log.rotated()
+    # the writer keeps its descriptor of the old file for a while after rename
+    os.rename(log_path, log_path + '.1')
+    write(log_path + '.1', b'two')
+    assert not log.rotated()
+    write(log_path, b'three\nfour')
+    assert log.rotated()
+    log.follow_rotation()
+    assert list(log) == ['two', 'three']
+    assert not log.rotated()
+    assert log.position() == (os.stat(log_path).st_ino, len(b'three\n'))
+
+
+def test_log_removed_is_not_rotation(log_path):
+    write(log_path, b'one\n')
+    log = LogTail(log_path, autocommit=False)
+    list(log)
+    os.remove(log_path)
+    assert not log.rotated()
+
+
+def test_truncated_log_is_read_from_beginning(log_path):
+    write(log_path, b'one\ntwo\n')
+    log = LogTail(log_path, autocommit=False)
+    assert list(log) == ['one', 'two']
+    # copytruncate keeps the inode
+    write(log_path, b'three\n', mode='wb')
+    assert log.rotated()
+    log.follow_rotation()
+    assert list(log) == ['three']
+    assert not log.rotated()
+    assert log.position() == (os.stat(log_path).st_ino, len(b'three\n'))
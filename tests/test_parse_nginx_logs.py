@@ -0,0 +1,285 @@
+from datetime import datetime
+import io
+import json
+import multiprocessing
+import os
+import threading
+
+import fasteners
+import pytest
+
+import common.logparser
+from common.db import ClickHouse, write_varint
+from common.metrics import Metrics
+from common.logparser import LogTail
+import parse_nginx_logs
+from parse_nginx_logs import Clickstream
+
+
+def header(columns, types):
+    """RowBinaryWithNamesAndTypes header"""
+    buf = bytearray()
+    write_varint(len(columns), buf)
+    for value in list(columns) + [types[c] for c in columns]:
+        b = value.encode('utf-8')
+        write_varint(len(b), buf)
+        buf += b
+    return bytes(buf)
+
+
+def _hold_lock(acquired, release):
+    with fasteners.InterProcessLock(parse_nginx_logs.lock_name):
+        acquired.set()
+        release.wait(10)
+
+
+@pytest.fixture
+def held_lock():
+    """Interprocess lock of parse_nginx_logs held by another process until the returned event is set"""
+    acquired = multiprocessing.Event()
+    release = multiprocessing.Event()
+    process = multiprocessing.Process(target=_hold_lock, args=(acquired, release))
+    process.start()
+    assert acquired.wait(10)
+    yield release
+    release.set()
+    process.join()
+
+
+class Writer:
+    def write_row(self, d):
+        pass
+
+    def write_columns(self, columns, rows):
+        pass
+
+
+def test_main_waits_for_lock(held_lock, monkeypatch):
+    started = threading.Event()
+
+    def log_tail(*args, **kwargs):
+        started.set()
+        raise RuntimeError('stop')
+    monkeypatch.setattr(parse_nginx_logs, 'LogTail', log_tail)
+
+    def run():
+        with pytest.raises(RuntimeError):
+            Clickstream().main()
+    thread = threading.Thread(target=run)
+    thread.start()
+    assert not started.wait(0.5)
+    held_lock.set()
+    thread.join(10)
+    assert started.is_set()
+
+
+def test_instrument_writer_is_not_locked(held_lock):
+    thread = threading.Thread(target=Clickstream().instrument_writer, args=(Writer(),))
+    thread.start()
+    thread.join(5)
+    assert not thread.is_alive()
+
+
+def log_line(query='idsite=1&rec=1&_id=0123456789abcdef&url=https%3A%2F%2Fexample.com%2F&gt_ms=-15'):
+    return json.dumps({
+        'ip': '10.0.0.1', 'time': '2018-05-14T12:30:15+03:00', 'request': 'GET /piwik?{0} HTTP/1.1'.format(query),
+        'body': '-', 'referrer': '-', 'user_agent': 'Mozilla/5.0 (X11; Linux x86_64)', 'country': 'RU', 'city': '-'
+    })
+
+
+class FailingWriter(Writer):
+    def __init__(self, error):
+        self.error = error
+
+    def write_row(self, d):
+        raise self.error
+
+
+def test_rows_not_fitting_table_types_are_skipped():
+    clickstream = Clickstream(metrics=Metrics())
+    clickstream.parse_line(log_line(), FailingWriter(ClickHouse.EncodeError('visit_count UInt32: -1')))
+    assert clickstream.metrics.counters[('rows_dropped', 'encode_error')] == 1
+
+
+def test_failed_insert_stops_parsing():
+    with pytest.raises(ClickHouse.SendError):
+        Clickstream().parse_line(log_line(), FailingWriter(ClickHouse.SendError('Connection refused')))
+
+
+@pytest.mark.parametrize('columnar_batch', [0, 4])
+def test_only_rows_not_fitting_table_types_are_dropped(columnar_batch):
+    clickstream = Clickstream(columnar_batch=columnar_batch, metrics=Metrics())
+    clickstream.column_types = dict.fromkeys(clickstream.columns, 'Nullable(String)')
+    clickstream.column_types['visit_count'] = 'UInt32'
+    types = clickstream.table_types('RowBinary')
+    output = io.BytesIO()
+    cr = ClickHouse.FileWriter(output, 't', clickstream.columns, fmt='RowBinary', types=types)
+    lines = [log_line('idsite=1&rec=1&_id=0123456789abcdef&_idvc={0}'.format(v)) for v in ('1', '2', '-3', '4', '5')]
+    clickstream.parse_lines(lines, cr)
+    cr.flush()
+    rows = list(ClickHouse.RowBinaryReader([header(clickstream.columns, types) + output.getvalue()]).rows())
+    assert [row['visit_count'] for row in rows] == [1, 2, 4, 5]
+    assert clickstream.metrics.counters[('rows_dropped', 'encode_error')] == 1
+
+
+def test_rows_writer_fails_on_are_skipped():
+    Clickstream().parse_line(log_line(), FailingWriter(KeyError('page_id')))
+
+
+def test_rowbinary_rows_match_table_types():
+    clickstream = Clickstream()
+    output = io.BytesIO()
+    clickstream.column_types = dict.fromkeys(clickstream.columns, 'Nullable(String)')
+    clickstream.column_types.update({'event_time': "DateTime('Europe/Moscow')", 'generation_speed': 'Int32'})
+    types = clickstream.table_types('RowBinary')
+    cr = ClickHouse.FileWriter(output, 't', clickstream.columns, fmt='RowBinary', types=types)
+    clickstream.parse_line(log_line(), cr)
+    cr.flush()
+    rows = list(ClickHouse.RowBinaryReader([header(clickstream.columns, types) + output.getvalue()]).rows())
+    assert len(rows) == 1
+    assert rows[0]['event_time'] == datetime(2018, 5, 14, 12, 30, 15)
+    assert rows[0]['generation_speed'] == 15
+    assert rows[0]['piwik_id'] == '0123456789abcdef'
+
+
+def test_worker_user_agent_cache_is_merged(tmp_path, monkeypatch):
+    monkeypatch.setattr(common.logparser, 'logs_path', str(tmp_path))
+    user_agents = ['Mozilla/5.0 (X11; Linux x86_64)', 'Mozilla/5.0 (iPhone; CPU iPhone OS 11_3 like Mac OS X)']
+    log_path = tmp_path / 'piwik_access.log'
+    with open(log_path, 'w') as f:
+        for i in range(200):
+            record = json.loads(log_line())
+            record['user_agent'] = user_agents[i % 2]
+            f.write(json.dumps(record) + '\n')
+    cache_file = str(tmp_path / 'ua_cache.json')
+    clickstream = Clickstream(ua_cache_file=cache_file)
+    output = io.StringIO()
+    cr = ClickHouse.FileWriter(output, 't', clickstream.columns, header=False)
+    clickstream._parse_log(LogTail(str(log_path), autocommit=False), cr, 2, 4096, 'TSV')
+    assert output.getvalue().count('\n') == 200
+    assert all(ua in clickstream.ua_cache for ua in user_agents)
+    assert clickstream.ua_cache.hits + clickstream.ua_cache.misses == 200
+    clickstream.ua_cache.dump(cache_file)
+    restored = Clickstream(ua_cache_file=cache_file)
+    assert restored.ua_cache.get(user_agents[0]) == clickstream.ua_cache.get(user_agents[0])
+
+
+class FlakyClient(object):
+    """Accepts the first batches, fails on the rest"""
+
+    def __init__(self, accepted):
+        self.accepted = accepted
+        self.rows = 0
+
+    def _send(self, data, stream=False, **kwargs):
+        body = b''.join(data)
+        if not self.accepted:
+            raise Exception('Connection refused')
+        self.accepted -= 1
+        self.rows += body.count(b'\n')
+
+
+def bulk_line(rows):
+    requests = ['?idsite=1&rec=1&_id=0123456789abcdef&url=https%3A%2F%2Fexample.com%2F{0}'.format(i)
+                for i in range(rows)]
+    record = json.loads(log_line())
+    record.update(request='POST /piwik HTTP/1.1', body=json.dumps({'requests': requests}))
+    return json.dumps(record)
+
+
+@pytest.mark.parametrize('workers, lines, batch_rows, columnar_batch, accepted', [
+    (1, [log_line()] * 300, 50, 0, 2),
+    (2, [log_line()] * 300, 50, 0, 2),
+    (1, [bulk_line(10)] * 3, 15, 0, 1),
+    (1, [log_line(), bulk_line(10)] * 3, 4, 5, 1),
+], ids=['get', 'get-workers', 'bulk', 'columnar-fallback'])
+def test_rerun_after_failed_batch_sends_only_the_rest(workers, lines, batch_rows, columnar_batch, accepted,
+                                                      tmp_path, monkeypatch):
+    monkeypatch.setattr(common.logparser, 'logs_path', str(tmp_path))
+    log_path = str(tmp_path / 'piwik_access.log')
+    with open(log_path, 'w') as f:
+        for line in lines:
+            f.write(line + '\n')
+    output = io.StringIO()
+    clickstream = Clickstream(columnar_batch=columnar_batch)
+    clickstream._parse_log(LogTail(log_path, autocommit=False), ClickHouse.FileWriter(
+        output, 't', clickstream.columns, header=False
+    ), 1, 2048, 'TSV')
+    total = output.getvalue().count('\n')
+    if columnar_batch:
+        # records are written by the row by row fallback of write_batch
+        monkeypatch.setattr(Clickstream, 'convert_batch', lambda self, records: 1 / 0)
+    client = FlakyClient(accepted=accepted)
+    log = LogTail(log_path, autocommit=False)
+    cr = ClickHouse.StreamWriter(client, 't', clickstream.columns, batch_rows=batch_rows, position=log.position,
+                                 on_sent=log.commit)
+    with pytest.raises(Exception, match='Connection refused'):
+        clickstream._parse_log(log, cr, workers, 2048, 'TSV')
+        cr.close()
+    assert client.rows >= accepted * batch_rows
+    output = io.StringIO()
+    rerun = ClickHouse.FileWriter(output, 't', clickstream.columns, header=False)
+    clickstream._parse_log(LogTail(log_path, autocommit=False), rerun, 1, 2048, 'TSV')
+    assert client.rows + output.getvalue().count('\n') == total
+
+
+def test_backfill_skips_files_of_regular_run(tmp_path, monkeypatch):
+    monkeypatch.setattr(common.logparser, 'logs_path', str(tmp_path))
+    monkeypatch.setattr(parse_nginx_logs, 'logs_path', str(tmp_path))
+    monkeypatch.setattr(parse_nginx_logs.clickhouse, 'deduplication_window', lambda table: 100)
+    log_path = tmp_path / 'piwik_access.log'
+    for i, path in enumerate([tmp_path / 'piwik_access.log.2', tmp_path / 'piwik_access.log.1', log_path]):
+        path.write_text(log_line('idsite={0}&rec=1&_id=0123456789abcdef'.format(i)) + '\n')
+    # the regular run has read a part of the rotated file and not the new log yet
+    LogTail(str(log_path), autocommit=False).commit((os.stat(str(log_path) + '.1').st_ino, 10))
+    copy = tmp_path / 'copy.log'
+    copy.write_bytes((tmp_path / 'piwik_access.log.1').read_bytes())
+    sent = []
+    monkeypatch.setattr(Clickstream, 'backfill_file', lambda self, path, *args: sent.append(path) or (path, 1, 1))
+    files = [str(tmp_path / name) for name in ('piwik_access.log.2', 'piwik_access.log.1', 'copy.log',
+                                               'piwik_access.log')]
+    Clickstream().backfill(files)
+    assert sent == [str(tmp_path / 'piwik_access.log.2')]
+
+
+def test_backfill_needs_deduplication(monkeypatch):
+    monkeypatch.setattr(parse_nginx_logs.clickhouse, 'deduplication_window', lambda table: 0)
+    with pytest.raises(ValueError):
+        Clickstream().backfill([])
+
+
+def test_workers_use_own_clickhouse_connections(monkeypatch):
+    monkeypatch.setattr(parse_nginx_logs.clickhouse, 'session', parse_nginx_logs.clickhouse.session)
+    monkeypatch.setattr(parse_nginx_logs, '_worker_clickstream', None)
+    session = parse_nginx_logs.clickhouse.session
+    parse_nginx_logs._init_worker(100, None)
+    assert parse_nginx_logs.clickhouse.session is not session
+    assert parse_nginx_logs.clickhouse.session.get_adapter('http://').poolmanager is not \
+        session.get_adapter('http://').poolmanager
+
+
+class RecordingClient(object):
+    def __init__(self):
+        self.tokens = []
+
+    def _send(self, data, stream=False, **kwargs):
+        b''.join(data)
+        self.tokens.append(kwargs['insert_deduplication_token'])
+
+
+def test_backfill_tokens_depend_on_batch_boundaries(tmp_path, monkeypatch):
+    path = str(tmp_path / 'piwik_access.log.2')
+    with open(path, 'w') as f:
+        for i in range(10):
+            f.write(log_line() + '\n')
+
+    def tokens(columnar_batch):
+        client = RecordingClient()
+        monkeypatch.setattr(parse_nginx_logs.clickhouse, 'stream_writer',
+                            lambda t, c, **kwargs: ClickHouse.StreamWriter(client, t, c, **kwargs))
+        Clickstream(columnar_batch=columnar_batch).backfill_file(path, batch_rows=3)
+        return client.tokens
+
+    assert tokens(0) == tokens(0)
+    assert len(tokens(0)) == 4
+    assert not set(tokens(0)) & set(tokens(4))
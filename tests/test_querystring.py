@@ -0,0 +1,56 @@
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+from common.querystring import split_url, decode_query, unescape_body
+from parse_nginx_logs import Clickstream
+
+keys = Clickstream().query_keys
+
+query_strings = [
+    'idsite=1&rec=1&_id=0123456789abcdef&url=https%3A%2F%2Fexample.com%2F%3Fa%3D1%26b%3D2&gt_ms=15',
+    'idsite=1&action_name=%D0%93%D0%BB%D0%B0%D0%B2%D0%BD%D0%B0%D1%8F+%2B+news&urlref=',
+    'idsite=1&idsite=2&idsite=3&rec=1',
+    'idsite=&rec&=1&&url=%zz%&e_c=a%2',
+    'id%73ite=7&%75rl=x+y&unknown=%41',
+    'idsite=1&cvar=%7B%221%22%3A%5B%22page_type%22%2C%22news%22%5D%7D&res=1920x1080',
+    '',
+]
+
+
+@pytest.mark.parametrize('qs', query_strings)
+def test_decode_query_gives_parse_qs_values(qs):
+    expected = {k: v for k, v in Clickstream.convert_qs(parse_qs(qs)).items() if k in keys}
+    assert decode_query(qs, keys) == expected
+
+
+def test_decode_query_of_bytes():
+    qs = query_strings[0].encode()
+    assert decode_query(qs, keys) == {
+        k: v for k, v in Clickstream.convert_qs(parse_qs(qs)).items() if k in keys
+    }
+
+
+@pytest.mark.parametrize('url', [
+    '/piwik.php?idsite=1&rec=1',
+    '/piwik.php?idsite=1#fragment?x=1',
+    '/piwik.php',
+    '/a;params?idsite=1',
+    '//example.com/piwik.php?idsite=1',
+    'https://example.com/piwik.php?idsite=1',
+    '/piwik.php?url=a\tb',
+])
+def test_split_url_gives_urlparse_parts(url):
+    parsed_url = urlparse(url)
+    assert split_url(url) == (parsed_url.path, parsed_url.query)
+
+
+@pytest.mark.parametrize('body', [
+    'idsite=1&rec=1',
+    'requests=[\\"?idsite=1&rec=1\\"]',
+    '{\\"requests\\":[\\"?idsite=1\\u0026rec=1\\"]}',
+    'action_name=Главная',
+    'action_name=Главная\\n',
+])
+def test_unescape_body_gives_unicode_escape_decoding(body):
+    assert unescape_body(body) == bytes(body, 'utf-8').decode('unicode_escape')
@@ -0,0 +1,42 @@
+import pytest
+
+from api.response_cache import ResponseCache, check_backend, from_config
+
+
+@pytest.fixture(params=['lru', 'simple'])
+def cache(request):
+    return ResponseCache(backend=request.param, size=100, ttl=60)
+
+
+def test_value_is_cached_under_generation(cache):
+    tag = ('common', 'u1', 'tag')
+    key = tag + (False, cache.generation(tag))
+    assert cache.get(key) is None
+    cache.set(key, [{'id': 1, 'views': 1}])
+    assert cache.get(tag + (False, cache.generation(tag))) == [{'id': 1, 'views': 1}]
+    assert cache.stats()['hits'] == 1
+
+
+def test_value_loaded_before_invalidation_is_not_read(cache):
+    tag = ('common', 'u1', 'tag')
+    # a reader takes generation and loads data, a writer invalidates before the reader sets it
+    stale_key = tag + (False, cache.generation(tag))
+    cache.invalidate(tag)
+    cache.set(stale_key, [{'id': 1, 'views': 1}])
+    assert cache.get(tag + (False, cache.generation(tag))) is None
+
+
+def test_invalidation_keeps_other_tags(cache):
+    tag, other = ('common', 'u1', 'tag'), ('common', 'u2', 'tag')
+    cache.set(other + (False, cache.generation(other)), [])
+    cache.invalidate(tag)
+    assert cache.get(other + (False, cache.generation(other))) == []
+
+
+def test_local_backend_is_refused_for_several_workers():
+    config = {'enabled': True, 'backend': 'lru', 'size': 100, 'ttl': 60}
+    check_backend(config, workers=1)
+    with pytest.raises(ValueError):
+        from_config(config, workers=4)
+    check_backend(dict(config, backend='redis'), workers=4)
+    assert from_config(dict(config, enabled=False), workers=4) is None
@@ -0,0 +1,132 @@
+from datetime import datetime
+import fcntl
+import json
+import multiprocessing
+import os
+
+import pytest
+
+from api.writebehind import ViewBuffer
+
+
+class Collection:
+    """statistics.activity keeping only views of bulk_write upserts"""
+
+    def __init__(self):
+        self.views = {}
+        self.fail = False
+
+    def bulk_write(self, operations, ordered=True):
+        if self.fail:
+            raise ConnectionError('mongo is down')
+        for op in operations:
+            f = op._filter
+            key = (f['uid'], f['site'], f['type'], f['id'])
+            self.views[key] = self.views.get(key, 0) + op._doc['$inc']['views']
+
+
+def write_journal(path, entries):
+    with open(path, 'w') as f:
+        for uid, oid, views in entries:
+            f.write(json.dumps([uid, 'common', 'tag', oid, views, datetime(2018, 5, 14).timestamp()]) + '\n')
+
+
+def _crash_with_views(journal, uid, object_ids):
+    buffer = ViewBuffer(Collection(), flush_interval=3600, journal=journal).start()
+    buffer.add(uid, 'common', 'tag', object_ids)
+    os._exit(0)
+
+
+@pytest.fixture
+def journal(tmp_path):
+    return str(tmp_path / 'views')
+
+
+def test_flush_writes_merged_increments():
+    collection = Collection()
+    buffer = ViewBuffer(collection)
+    buffer.add('u1', 'common', 'tag', [1, 2])
+    buffer.add('u1', 'common', 'tag', [1])
+    assert buffer.pending('u1', 'common') == {1: 2, 2: 1}
+    buffer.flush()
+    assert collection.views == {('u1', 'common', 'tag', 1): 2, ('u1', 'common', 'tag', 2): 1}
+    assert buffer.pending('u1', 'common') == {}
+
+
+def test_failed_flush_keeps_views_pending():
+    collection = Collection()
+    collection.fail = True
+    buffer = ViewBuffer(collection)
+    buffer.add('u1', 'common', 'tag', [1])
+    with pytest.raises(ConnectionError):
+        buffer.flush()
+    assert buffer.pending('u1', 'common') == {1: 1}
+    collection.fail = False
+    buffer.flush()
+    assert collection.views == {('u1', 'common', 'tag', 1): 1}
+
+
+def test_discarded_views_are_not_merged():
+    buffer = ViewBuffer(Collection())
+    buffer.add('u1', 'common', 'tag', [1, 2])
+    buffer.discard('u1', 'common', 'tag', [1])
+    assert buffer.merge_into([{'id': 2, 'views': 5}], 'u1', 'common', 'tag') == [{'id': 2, 'views': 6}]
+
+
+def test_journal_of_crashed_processes_is_replayed_once(journal):
+    for uid in ('u1', 'u2'):
+        process = multiprocessing.Process(target=_crash_with_views, args=(journal, uid, [1, 2]))
+        process.start()
+        process.join()
+    collection = Collection()
+    buffer = ViewBuffer(collection, flush_interval=3600, journal=journal).start()
+    assert buffer.pending('u1', 'common') == {1: 1, 2: 1}
+    assert buffer.pending('u2', 'common') == {1: 1, 2: 1}
+    # replayed views are moved to the own journal, journals of crashed processes are removed
+    assert sorted(os.listdir(os.path.dirname(journal))) == [
+        'views.{0}'.format(os.getpid()), 'views.{0}.lock'.format(os.getpid())
+    ]
+    buffer.stop()
+    assert collection.views == {
+        ('u1', 'common', 'tag', 1): 1, ('u1', 'common', 'tag', 2): 1,
+        ('u2', 'common', 'tag', 1): 1, ('u2', 'common', 'tag', 2): 1,
+    }
+    assert os.listdir(os.path.dirname(journal)) == []
+
+
+def test_journal_of_running_process_is_not_touched(journal):
+    other = '{0}.{1}'.format(journal, os.getpid() + 1)
+    write_journal(other, [('u1', 1, 1)])
+    write_journal(other + '.flushing', [('u1', 2, 1)])
+    with open(other + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        collection = Collection()
+        buffer = ViewBuffer(collection, flush_interval=3600, journal=journal).start()
+        buffer.add('u2', 'common', 'tag', [3])
+        buffer.flush()
+        buffer.stop()
+        assert buffer.pending('u1', 'common') == {}
+        assert collection.views == {('u2', 'common', 'tag', 3): 1}
+        assert os.path.exists(other) and os.path.exists(other + '.flushing')
+
+
+def test_replayed_journal_drops_discarded_views(journal):
+    crashed = '{0}.{1}'.format(journal, os.getpid() + 1)
+    write_journal(crashed, [('u1', 1, 2), ('u1', 2, 1), ('u1', 1, None)])
+    open(crashed + '.lock', 'w').close()
+    buffer = ViewBuffer(Collection(), flush_interval=3600, journal=journal).start()
+    assert buffer.pending('u1', 'common') == {2: 1}
+    buffer.stop()
+
+
+def test_unwritten_views_stay_in_journal(journal):
+    collection = Collection()
+    collection.fail = True
+    buffer = ViewBuffer(collection, flush_interval=3600, journal=journal).start()
+    buffer.add('u1', 'common', 'tag', [1])
+    buffer.stop()
+    collection = Collection()
+    buffer = ViewBuffer(collection, flush_interval=3600, journal=journal).start()
+    assert buffer.pending('u1', 'common') == {1: 1}
+    buffer.stop()
+    assert collection.views == {('u1', 'common', 'tag', 1): 1}